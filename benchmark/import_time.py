@@ -0,0 +1,96 @@
+# 本方法为启动耗时检查: 用 python -X importtime 统计导入main的耗时, 并检查导入时没有加载较慢的依赖
+# pandas、pymongo、PIL等应在使用对应功能时才导入, 每次按城市运行的短任务都能减少启动时间
+#   python benchmark/import_time.py                          打印导入耗时和最慢的模块
+#   python benchmark/import_time.py --fail_on_heavy --max_ms 200
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+now_dir = os.path.dirname(os.path.abspath(__file__))
+path_code = os.path.dirname(now_dir)
+
+# 导入main时不应加载的依赖
+HEAVY_MODULES = ('pandas', 'numpy', 'pymongo', 'pyquery', 'PIL', 'requests', 'lxml', 'pyarrow', 'sklearn')
+RE_IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def parse_importtime(text) -> list:
+    """
+    解析 -X importtime 的输出
+
+    :return: [{'module': 模块名, 'self_us': 自身耗时, 'cumulative_us': 含子模块的耗时, 'depth': 嵌套层级}]
+    """
+    res = list()
+    for line in text.splitlines():
+        m = RE_IMPORT_TIME.match(line)
+        if m:
+            res.append({'module': m.group(4), 'self_us': int(m.group(1)), 'cumulative_us': int(m.group(2)),
+                        'depth': (len(m.group(3)) - 1) // 2})
+    return res
+
+
+def measure(module='main', repeat=5) -> dict:
+    """
+    在子进程中导入module repeat次, 取耗时中位数的一次
+
+    :return: {'module': 模块, 'total_ms': 导入耗时, 'runs_ms': 各次耗时, 'imports': parse_importtime的结果,
+              'heavy': 导入时加载的较慢依赖}
+    """
+    runs = list()
+    for _ in range(repeat):
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)], cwd=path_code,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if p.returncode != 0:
+            raise Exception('导入 {} 失败\n{}'.format(module, p.stderr[-2000:]))
+        imports = parse_importtime(p.stderr)
+        total = sum(i['cumulative_us'] for i in imports if i['depth'] == 0 and i['module'] == module)
+        runs.append((total, imports))
+    runs.sort(key=lambda x: x[0])
+    total, imports = runs[len(runs) // 2]
+    loaded = {i['module'].split('.')[0] for i in imports}
+    return {'module': module, 'total_ms': round(total / 1000, 1),
+            'runs_ms': [round(i[0] / 1000, 1) for i in runs], 'imports': imports,
+            'heavy': [i for i in HEAVY_MODULES if i in loaded]}
+
+
+def report(res: dict, top=15):
+    print('== 导入 {} 耗时 {} ms (各次 {}) =='.format(res['module'], res['total_ms'], res['runs_ms']))
+    print('-- 含子模块耗时最多的 {} 个模块 --'.format(top))
+    for i in sorted(res['imports'], key=lambda x: -x['cumulative_us'])[:top]:
+        print('{:>10.1f} ms  {}{}'.format(i['cumulative_us'] / 1000, '  ' * i['depth'], i['module']))
+    print('-- 自身耗时最多的 {} 个模块 --'.format(top))
+    for i in sorted(res['imports'], key=lambda x: -x['self_us'])[:top]:
+        print('{:>10.1f} ms  {}'.format(i['self_us'] / 1000, i['module']))
+    if res['heavy']:
+        print('==== 导入时加载了较慢的依赖 {} ===='.format(res['heavy']))
+
+
+def make_argsparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument('--module', type=str, default='main')  # 检查的模块
+    parse.add_argument('--repeat', type=int, default=5)  # 导入次数, 取中位数
+    parse.add_argument('--top', type=int, default=15)  # 打印最慢的模块数量
+    parse.add_argument('--max_ms', type=float)  # 导入耗时上限, 超过时返回非0
+    parse.add_argument('--fail_on_heavy', default=False, action='store_true')  # 加载了较慢的依赖时返回非0
+    parse.add_argument('--output', type=str)  # 结果的输出路径(json)
+    return parse.parse_args()
+
+
+if __name__ == '__main__':
+    args = make_argsparse()
+    res = measure(args.module, args.repeat)
+    report(res, args.top)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(res, f, ensure_ascii=False, indent=2)
+    failed = False
+    if args.max_ms is not None and res['total_ms'] > args.max_ms:
+        print('==== 导入耗时 {} ms 超过上限 {} ms ===='.format(res['total_ms'], args.max_ms))
+        failed = True
+    if args.fail_on_heavy and res['heavy']:
+        failed = True
+    if failed:
+        sys.exit(1)
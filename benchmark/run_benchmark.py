@@ -0,0 +1,238 @@
+# 本方法为离线基准测试: 使用fixtures中的页面和价格图片, 不访问网络
+# 测量解析、价格识别、数据整理和写入的单次耗时和吞吐, 并与baseline.json对比
+#   python benchmark/run_benchmark.py                     运行全部用例并与基线对比
+#   python benchmark/run_benchmark.py --save_baseline     运行并保存为新基线
+#   python benchmark/run_benchmark.py --cases parse_lj,parse_zr --fail_on_regression
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+now_dir = os.path.dirname(os.path.abspath(__file__))
+path_code = os.path.dirname(now_dir)
+if path_code not in sys.path:
+    sys.path.append(path_code)
+
+from PIL import Image
+
+from core.core_catching import RoomInfoCatching, RoomInfoCatchingLJ, RoomInfoCatchingZR, HouseDistrictCatching
+from core.core_pipeline import add_avg_price
+from utils.ocr_service import PricePredict, PriceDecoder, GlyphTable, load_model
+from utils.io_service import CsvChunkSink, ParquetChunkSink, save_info_to_local
+
+
+FIXTURE_PATH = os.path.join(now_dir, 'fixtures')
+BASELINE_PATH = os.path.join(now_dir, 'baseline.json')
+MODEL_PATH = os.path.join(path_code, 'utils', 'ocr', 'pre_trained_model', 'LR_0906.pickle')
+SPRITE_URL = 'https://static8.ziroom.com/phoenix/pc/images/price/new-list/{}'  # fixtures中价格图片对应的url
+URL_LJ = 'https://sh.lianjia.com/zufang/pudong/'
+URL_ZR = 'https://sh.ziroom.com/z/d310115-r0/'
+URL_HD = 'https://sh.lianjia.com/xiaoqu/5011000000000/'
+
+
+def read_fixture(file_name, mode='r'):
+    with open(os.path.join(FIXTURE_PATH, file_name), mode, **({'encoding': 'utf-8'} if mode == 'r' else {})) as f:
+        return f.read()
+
+
+def load_sprites() -> dict:
+    """ {价格图片url: (PIL Image, 图片中的10个数字)} """
+    digits = json.loads(read_fixture(os.path.join('sprites', 'digits.json')))
+    return {SPRITE_URL.format(k): (Image.open(BytesIO(read_fixture(os.path.join('sprites', k), 'rb'))), v)
+            for k, v in digits.items()}
+
+
+def timeit(func, repeat=5, min_time=0.2) -> dict:
+    """
+    自动确定每轮的执行次数, 使每轮耗时不少于min_time, 共repeat轮
+
+    :return: {'best_us': 最快一轮的单次耗时(微秒), 'median_us': 中位数, 'number': 每轮次数}
+    """
+    func()  # 预热
+    number = 1
+    while True:
+        time0 = time.perf_counter()
+        for _ in range(number):
+            func()
+        cost = time.perf_counter() - time0
+        if cost >= min_time:
+            break
+        number *= 2 if cost == 0 else max(2, min(10, int(min_time / cost) + 1))
+    costs = [cost]
+    for _ in range(repeat - 1):
+        time0 = time.perf_counter()
+        for _ in range(number):
+            func()
+        costs.append(time.perf_counter() - time0)
+    costs = [i / number * 1e6 for i in costs]
+    return {'best_us': round(min(costs), 2), 'median_us': round(statistics.median(costs), 2), 'number': number}
+
+
+def make_cases(tmp_path) -> dict:
+    """
+    基准用例 {名称: (被测方法, 每次调用处理的条数, 条数的单位)}
+    数据在此准备好, 被测方法内只包含需要测量的部分
+    """
+    html_lj = read_fixture('lj_listing_page.html')
+    html_zr = read_fixture('zr_listing_page.html')
+    html_hd = read_fixture('hd_page.html')
+    catcher_lj = RoomInfoCatchingLJ()
+    sprites = load_sprites()
+    model = load_model(MODEL_PATH)
+    image = next(iter(sprites.values()))[0]
+
+    rows_lj = catcher_lj.get_room_info_page(URL_LJ, html_lj)
+    rows_zr = RoomInfoCatchingZR.get_room_info_page(URL_ZR, html_zr)
+    decoder = PriceDecoder(MODEL_PATH)
+    decoder.decode_sprites({k: v[0] for k, v in sprites.items()})
+    for i in rows_zr:
+        i['price'] = decoder.decode_price(i['price_info'])
+        add_avg_price(i)
+    for i in rows_lj + rows_zr:
+        i['区域'] = '浦东'
+    records = RoomInfoCatching.normalize_info(rows_zr, 'ZR') * 20  # 600条, 相当于一个流水线块
+
+    def decode_prices():
+        d = PriceDecoder(MODEL_PATH)  # 不使用已识别的缓存
+        d.decode_sprites({k: v[0] for k, v in sprites.items()})
+        return [d.decode_price(i['price_info']) for i in rows_zr]
+
+    table = GlyphTable()  # 已填充的数字图像查找表, 稳定运行时全部查表命中, 不需要模型推理
+    PriceDecoder(MODEL_PATH, table).decode_sprites({k: v[0] for k, v in sprites.items()})
+
+    def decode_prices_table():
+        d = PriceDecoder(MODEL_PATH, table)
+        d.decode_sprites({k: v[0] for k, v in sprites.items()})
+        return [d.decode_price(i['price_info']) for i in rows_zr]
+
+    def sink_csv():
+        sink = CsvChunkSink(tmp_path, 'bench.csv')
+        sink.write(records)
+        sink.close()
+
+    def sink_parquet():
+        sink = ParquetChunkSink(tmp_path, 'ZR', 'sh', '20000101')
+        sink.write(records)
+        sink.close()
+
+    cases = {
+        'parse_lj': (lambda: catcher_lj.get_room_info_page(URL_LJ, html_lj), len(rows_lj), 'listings'),
+        'parse_zr': (lambda: RoomInfoCatchingZR.get_room_info_page(URL_ZR, html_zr), len(rows_zr), 'listings'),
+        'parse_hd': (lambda: HouseDistrictCatching.get_hd_info(URL_HD, html_hd), 1, 'communities'),
+        'ocr_digit': (lambda: PricePredict(image, model).predict(3), 1, 'digits'),
+        'ocr_sprite': (lambda: PricePredict(image, model).predict_all(), 10, 'digits'),
+        'ocr_decode_page': (decode_prices, len(rows_zr), 'listings'),
+        'ocr_decode_table': (decode_prices_table, len(rows_zr), 'listings'),
+        'update_info_lj': (lambda: RoomInfoCatching.update_info(rows_lj, 'LJ'), len(rows_lj), 'listings'),
+        'update_info_zr': (lambda: RoomInfoCatching.update_info(rows_zr, 'ZR'), len(rows_zr), 'listings'),
+        'sink_csv': (sink_csv, len(records), 'rows'),
+        'sink_excel': (lambda: save_info_to_local(records, tmp_path, 'bench.xlsx'), len(records), 'rows'),
+    }
+    try:
+        import pyarrow  # 可选依赖
+        cases['sink_parquet'] = (sink_parquet, len(records), 'rows')
+    except ImportError:
+        print('== 未安装pyarrow, 跳过sink_parquet ==')
+    return cases
+
+
+def check_fixtures():
+    """ 确认fixtures的解析和识别结果正确, 避免测到的是出错的路径 """
+    sprites = load_sprites()
+    model = load_model(MODEL_PATH)
+    for url, (image, digits) in sprites.items():
+        pred = PricePredict(image, model).predict_all()
+        if pred != digits:
+            raise Exception('价格图片 {} 识别结果 {} 与标注 {} 不一致'.format(url, pred, digits))
+    if len(RoomInfoCatchingZR.get_room_info_page(URL_ZR, read_fixture('zr_listing_page.html'))) != 30:
+        raise Exception('自如fixture解析结果不是30条')
+
+
+def run(case_names=None, repeat=5, min_time=0.2) -> dict:
+    """ 运行基准, 返回 {'env': 运行环境, 'results': {用例: 结果}} """
+    check_fixtures()
+    tmp_path = tempfile.mkdtemp(prefix='bench_')
+    try:
+        cases = make_cases(tmp_path)
+        results = dict()
+        for name, (func, n_items, unit) in cases.items():
+            if case_names and name not in case_names:
+                continue
+            res = timeit(func, repeat, min_time)
+            res['items'] = n_items
+            res['unit'] = unit
+            res['ops_per_s'] = round(1e6 / res['best_us'], 1)
+            res['items_per_s'] = round(n_items * 1e6 / res['best_us'], 1)
+            results[name] = res
+            print('{:<16} {:>12.1f} us/op {:>12.1f} ops/s {:>12.1f} {}/s'.format(
+                name, res['best_us'], res['ops_per_s'], res['items_per_s'], unit))
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    env = {'python': platform.python_version(), 'machine': platform.machine(), 'system': platform.system(),
+           'date': time.strftime('%Y%m%d')}
+    return {'env': env, 'results': results}
+
+
+def compare(current: dict, baseline: dict, tolerance=0.2) -> list:
+    """
+    与基线对比单次耗时
+
+    :param tolerance: 允许的变慢比例, 超过视为退化
+    :return: 退化的用例名list
+    """
+    regressions = list()
+    print('== 与基线对比 基线环境 {} =='.format(baseline.get('env')))
+    for name, res in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print('{:<16} 基线中无该用例'.format(name))
+            continue
+        ratio = res['best_us'] / base['best_us']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '退化'
+            regressions.append(name)
+        elif ratio < 1 / (1 + tolerance):
+            flag = '提升'
+        print('{:<16} {:>12.1f} -> {:>12.1f} us/op  x{:.2f} {}'.format(name, base['best_us'], res['best_us'],
+                                                                     ratio, flag))
+    return regressions
+
+
+def make_argsparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument('--cases', type=str)  # 只运行部分用例, 逗号分隔
+    parse.add_argument('--repeat', type=int, default=5)  # 每个用例的轮数
+    parse.add_argument('--min_time', type=float, default=0.2)  # 每轮最少耗时(秒)
+    parse.add_argument('--baseline', type=str, default=BASELINE_PATH)  # 基线文件路径
+    parse.add_argument('--save_baseline', default=False, action='store_true')  # 保存本次结果为基线
+    parse.add_argument('--tolerance', type=float, default=0.2)  # 允许的变慢比例
+    parse.add_argument('--fail_on_regression', default=False, action='store_true')  # 有退化时返回非0
+    parse.add_argument('--output', type=str)  # 本次结果的输出路径
+    return parse.parse_args()
+
+
+if __name__ == '__main__':
+    args = make_argsparse()
+    current = run(args.cases.split(',') if args.cases else None, args.repeat, args.min_time)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print('== 已保存基线 {} =='.format(args.baseline))
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(current, json.load(f), args.tolerance)
+        if regressions and args.fail_on_regression:
+            print('==== 退化的用例 {} ===='.format(regressions))
+            sys.exit(1)
+    else:
+        print('== 基线 {} 不存在, 可使用--save_baseline生成 =='.format(args.baseline))
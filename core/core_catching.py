@@ -1,13 +1,9 @@
 import os
 import sys
 import traceback
-from pyquery import PyQuery as pq
 import re
-import requests
-import numpy as np
 import time
-import pickle
-from typing import List
+from typing import Iterator, List
 
 now_dir = os.path.dirname(__file__)
 path_code = os.path.dirname(now_dir)
@@ -18,40 +14,121 @@ for path in [path_code, path_root, path_proj]:
         sys.path.append(path)
 
 from utils.common_utils import print_time, G_LJ, G_ZR
-from utils.html_service import get_one_page_html
+from utils.html_service import get_one_page_html, get_many_page_html, configure_fetcher, fetcher_config
 from utils.io_service import save_info_to_local, save_info_to_mongodb
-from utils.ocr_service import PricePredict
+from utils.ocr_service import get_price_decoder, configure_price_decoders, decoder_config, save_price_decoders
+from utils.metrics_service import get_metrics
+from utils.profile_service import profile_stage, profile_snapshot, merge_profile_snapshot
+from core.core_record import RoomRecord
+
+
+def pq(*args, **kwargs):
+    """ 延迟导入pyquery(连带导入requests等, 较慢), 只在解析区域、分页和小区页面时加载 """
+    from pyquery import PyQuery
+    return PyQuery(*args, **kwargs)
 
 
 class RoomInfoCatching:
     """ 基类 """
+    source = None  # 来源名, 用于指标和断点续抓
+    frontier = None  # 断点续抓的CrawlFrontier, 为空时不记录
+
     def __init__(self):
+        self.failed_areas = set()  # 有页面获取失败的区域, 增量模式下这些区域的房源不算下架
         print('== Hi U ==')
 
+    def get_area_page_urls(self, url_area, area) -> List[str]:
+        """ 区域的分页url list, 记录在frontier中, 续抓时不再请求区域页面 """
+        if self.frontier is None:
+            return self.find_page_url(url_area)
+        urls_pg = self.frontier.get(url_area, 'area')
+        if urls_pg is None:
+            urls_pg = self.find_page_url(url_area)
+            self.frontier.add(urls_pg, 'page', area)
+            self.frontier.done(url_area, urls_pg, 'area', area)
+        return urls_pg
+
+    def iter_room_info_page_list(self, urls_pg: List[str], area) -> Iterator[tuple]:
+        """
+        并发获取多个分页并解析, 按完成顺序产出 (分页url, 该页房源list)
+        有frontier时先产出已完成分页的记录结果, 其余分页每解析完一页就写入frontier
+        """
+        done = self.frontier.get_many(urls_pg, 'page') if self.frontier is not None else dict()
+        if done:
+            print('== 续抓 跳过已完成的页面 {} 个 =='.format(len(done)))
+        for url_pg, room_info_list in done.items():
+            for room_info in room_info_list:  # 同一分页可能出现在多个区域
+                room_info['区域'] = area
+            yield url_pg, room_info_list
+        for url_pg, html in get_many_page_html([i for i in urls_pg if i not in done]):
+            if html is None:
+                print('==== 页面 {} 获取失败, 该页房源缺失 ===='.format(url_pg))
+                self.failed_areas.add(area)
+                if self.frontier is not None:
+                    self.frontier.failed(url_pg, '页面获取失败', 'page', area)
+                yield url_pg, list()
+                continue
+            metrics = get_metrics()
+            with metrics.timer('parse_seconds', source=self.source), profile_stage('parse'):
+                room_info_list = self.get_room_info_page(url_pg, html)
+            metrics.inc('pages_total', source=self.source)
+            metrics.inc('listings_total', len(room_info_list), source=self.source)
+            for room_info in room_info_list:
+                room_info['区域'] = area
+            if self.frontier is not None:
+                self.frontier.done(url_pg, room_info_list, 'page', area)
+            yield url_pg, room_info_list
+
+    def get_room_info_pages(self, urls_pg: List[str], area) -> List[dict]:
+        """
+        并发获取多个分页的房源信息, 边下载边解析, 结果按urls_pg的顺序合并
+
+        :param urls_pg: 分页url list
+        :param area: 区域名, 写入每条房源的'区域'字段
+        :return:
+        """
+        info_pg = dict()
+        n = 0
+        for url_pg, room_info_list in self.iter_room_info_page_list(urls_pg, area):
+            n += 1
+            print('== 完成第 {} 个页面, 共 {} 个 =='.format(n, len(urls_pg)))
+            info_pg[url_pg] = room_info_list
+        room_info_total = list()
+        for i in urls_pg:
+            room_info_total += info_pg[i]
+        return room_info_total
+
+    def iter_room_info_pages(self, urls_pg: List[str], area) -> Iterator[dict]:
+        """ 流式获取多个分页的房源信息, 每下载完一个页面就产出该页的房源 """
+        for _, room_info_list in self.iter_room_info_page_list(urls_pg, area):
+            yield from room_info_list
+
+    def iter_room_info_total(self) -> Iterator[dict]:
+        """ 流式获取全部区域的房源信息, 用于流水线模式 """
+        for i in self.generate_area_urls():
+            urls_area_pg = self.get_area_page_urls(i['url'], i['area'])
+            print('== 该区域 {} 共有页面 {} 个'.format(i['area'], len(urls_area_pg)))
+            yield from self.iter_room_info_pages(urls_area_pg, i['area'])
+            print('== 完成 {} 区域'.format(i['area']))
+
     @staticmethod
-    def update_info(room_info: List[str], source='ZR'):
-        res = list()
-        tmp = dict()
-        for i in room_info:
-            if source == 'ZR':
-                tmp['小区'] = re.sub('\d居室', '', i['name'].split('·')[-1].split('-')[0])
-                tmp['朝向'] = i['name'].split('-')[-1] if len(i['name'].split('-')) > 1 else ''
-            else:
-                tmp['小区'] = i['name'].split('-')[-1]
-                tmp['朝向'] = i['orientation']
-            tmp['平米均价'] = i['avg_price']
-            tmp['房源链接'] = i['room_url']
-            tmp['区域'] = i['区域']
-            tmp['户型'] = i['room_types'].replace(' ', '')
-            tmp['价格'] = i.get('price')
-            tmp['面积'] = i['area']
-            tmp['楼层'] = i['floor']
-            res.append(tmp)
+    def normalize_info(room_info: List[dict], source='ZR') -> List[RoomRecord]:
+        """ 整理数据为RoomRecord, 写入前再转为dict """
+        with get_metrics().timer('normalize_seconds', source=source), profile_stage('merge'):
+            res = [RoomRecord.from_raw(i, source) for i in room_info]
+        get_metrics().inc('normalize_records_total', len(res), source=source)
         return res
 
+    @staticmethod
+    def update_info(room_info: List[dict], source='ZR') -> List[dict]:
+        """ 整理数据为中文字段的dict """
+        return [RoomRecord.from_raw(i, source).to_dict() for i in room_info]
+
 
 class RoomInfoCatchingLJ(RoomInfoCatching):
     """ 小区信息提取 """
+    source = 'LJ'
+
     def __init__(self, url_base=None):
         """ base_url: 链家首页 """
         self.url_base = url_base if url_base else 'https://sh.lianjia.com'
@@ -70,7 +147,7 @@ class RoomInfoCatchingLJ(RoomInfoCatching):
         else:
             raise Exception(f'城市{city}不在支持列表内')
 
-        res = cls(url)
+        res = cls(url.rstrip('/'))  # url_base不带结尾的/
         return res
 
     def generate_area_urls(self):
@@ -117,7 +194,7 @@ class RoomInfoCatchingLJ(RoomInfoCatching):
                         'url': room_url})
         return res
 
-    def get_room_info_page(self, url_pg) -> List[dict]:  # 获取一整个页面的房间信息
+    def get_room_info_page(self, url_pg, html=None) -> List[dict]:  # 获取一整个页面的房间信息
         """
         根据分页的页面获取房源信息
 
@@ -128,33 +205,14 @@ class RoomInfoCatchingLJ(RoomInfoCatching):
             types: 房间类型
             floor: 房间楼层
             updated_info: 房间维护信息
+
+        :param url_pg: 分页url
+        :param html: 已下载的页面html, 为空时按url_pg下载
         """
 
-        doc = pq(get_one_page_html(url_pg))  # doc
-        room_info = doc('.content__list--item--main').items()  # generator
-        res = []
-        for i in room_info:
-            room_url = self.url_base + i('.twoline').attr('href')
-            desc = i('.content__list--item--des').text()
-            price_str = i('.content__list--item-price').text()
-            updated_info = i('.content__list--item--time.oneline').text()
-            desc_vec = desc.replace(' ', '').split('/')
-            name = desc_vec[0]
-            area_str = desc_vec[1]
-            orientation = desc_vec[2]
-            types = desc_vec[3]
-            floor = desc_vec[4]
-            price = float(re.findall('(\d+).* +元/月', price_str)[0])
-            area = float(re.findall('(.*)㎡', area_str)[0])
-            avg_price = round(price / area, 2)
-            sub_area = name.split('-')[1]
-            dict_info = {'name': name, 'area_str': area_str, 'price_str': price_str,
-                         'area': area, 'price': price, 'avg_price': avg_price,
-                         'orientation': orientation, 'room_types': types, 'floor': floor,
-                         'updated_info': updated_info, '子区域': sub_area,
-                         'room_url': room_url}
-            res.append(dict_info)
-        return res
+        from core.core_parsing import parse_room_info_page_lj
+        html = html if html is not None else get_one_page_html(url_pg)
+        return parse_room_info_page_lj(html, self.url_base)
 
     @staticmethod
     def get_room_info(url_room) -> dict:
@@ -165,19 +223,11 @@ class RoomInfoCatchingLJ(RoomInfoCatching):
     def get_room_info_by_area(self, area):
         area_url = self.get_url_by_area(area)
         if not area_url:
-            return False, '未获取到该区 {} 的链接，支持的区域为 {}'.format(area, [i['area'] for i in self.generate_area_urls()])
+            return False, '未获取到该区 {} 的链接，支持的区域为 {}'.format(area, [i['area'] for i in self.urls_area])
 
-        urls_area_pg = self.find_page_url(area_url)
-        room_info_total = list()
+        urls_area_pg = self.get_area_page_urls(area_url, area)
         print('== 该区域 {} 共有页面 {} 个'.format(area, len(urls_area_pg)))
-        n = 0
-        for i in urls_area_pg:
-            n += 1
-            print('== 开始计算第 {} 个页面 =='.format(n))
-            room_info_list = self.get_room_info_page(i)
-            for room_info in room_info_list:
-                room_info['区域'] = area
-            room_info_total += room_info_list
+        room_info_total = self.get_room_info_pages(urls_area_pg, area)
         return room_info_total
 
     @print_time
@@ -189,6 +239,10 @@ class RoomInfoCatchingLJ(RoomInfoCatching):
             print('== 完成 {} 区域'.format(i['area']))
         return room_info_total
 
+    def crawl_area(self, area):
+        """ 多进程模式下单个区域的任务入口 """
+        return self.get_room_info_by_area(area)
+
     # def main_multiprocess(self, area):
     #     """ 子进程方法执行全量数据 """
     #     print('=== 子进程开始执行 {} 区域 ==='.format(area))
@@ -205,11 +259,12 @@ class RoomInfoCatchingLJ(RoomInfoCatching):
 
 
 class RoomInfoCatchingZR(RoomInfoCatching):
+    source = 'ZR'
+
     def __init__(self, base_url=None):
         self.url_base = 'https://sh.ziroom.com/' if not base_url else base_url
         self.url_selectoin = f'{self.url_base}z/z2-r0/?cp=4000TO8000'  # 4k-8k TODO 改成动态生成
         self.urls_area = None
-        self.url_pic = dict()
         super().__init__()
     
     @classmethod
@@ -267,7 +322,7 @@ class RoomInfoCatchingZR(RoomInfoCatching):
         return res
 
     @staticmethod
-    def get_room_info_page(url_pg) -> List[dict]:  # 获取一整个页面的房间信息
+    def get_room_info_page(url_pg, html=None) -> List[dict]:  # 获取一整个页面的房间信息
         """
         根据分页的页面获取房源信息
 
@@ -278,50 +333,23 @@ class RoomInfoCatchingZR(RoomInfoCatching):
             types: 房间类型
             floor: 房间楼层
             updated_info: 房间维护信息
+
+        :param url_pg: 分页url
+        :param html: 已下载的页面html, 为空时按url_pg下载
         """
 
-        doc = pq(get_one_page_html(url_pg))  # doc
-        room_info = doc('div.item').items()
-        res = list()
-        for i in room_info:
-            name = i('div.info-box a').text()  # 名称
-            url = 'https:' + i('div.info-box a').attr('href')
-            area_desc_str = i('div.desc div:nth-of-type(1)').text()
-            area_str = area_desc_str.split('|')[0]
-            area = float(re.findall('(.*)㎡', area_str)[0])  # 面积
-            tmp_types = area_desc_str.split('|')[1]
-            if len(tmp_types.split('/')) > 1:
-                types = re.findall('.*(\d+居室).*', name)[0]
-                floor = int(tmp_types.split('/')[0])
-            else:
-                types = tmp_types
-                floor = ''
-            locations = i('div.desc>div.location').text()
-            price_info = '||'.join([num.attr('style') for num in i('div.price span.num').items()])  # ||分割改list为str
-            tags = '||'.join([tag.text() for tag in i('div.tag span').items()])  # ||分割改list为str
-            dict_info = {'name': name, 'room_url': url, 'area_str': area_str, 'price_info': price_info,
-                         'area': area, 'room_types': types, 'locations': locations, 'tags': tags, 'floor': floor,
-                         }
-            res.append(dict_info)
-
-        return res
+        from core.core_parsing import parse_room_info_page_zr
+        html = html if html is not None else get_one_page_html(url_pg)
+        return parse_room_info_page_zr(html)
 
     def get_room_info_by_area(self, area):
         area_url = self.get_url_by_area(area)
         if not area_url:
-            return False, '未获取到该区 {} 的链接，支持的区域为 {}'.format(area, [i['area'] for i in self.generate_area_urls()])
+            return False, '未获取到该区 {} 的链接，支持的区域为 {}'.format(area, [i['area'] for i in self.urls_area])
 
-        urls_area_pg = self.find_page_url(area_url)
-        room_info_total = list()
+        urls_area_pg = self.get_area_page_urls(area_url, area)
         print('== 该区域 {} 共有页面 {} 个'.format(area, len(urls_area_pg)))
-        n = 0
-        for i in urls_area_pg:
-            n += 1
-            print('== 开始计算第 {} 个页面 =='.format(n))
-            room_info_list = self.get_room_info_page(i)
-            for room_info in room_info_list:
-                room_info['区域'] = area
-            room_info_total += room_info_list
+        room_info_total = self.get_room_info_pages(urls_area_pg, area)
         return room_info_total
 
     @print_time
@@ -333,64 +361,44 @@ class RoomInfoCatchingZR(RoomInfoCatching):
             print('== 完成 {} 区域'.format(i['area']))
         return room_info_total
 
-    @print_time
-    def get_price(self, s, model_path) -> int:
+    def crawl_area(self, area):
+        """ 多进程模式下单个区域的任务入口 """
+        return self.get_room_info_by_area(area)
+
+    @staticmethod
+    def get_price(s, model_path):
         """
-        根据图片的字符信息（price_info 字段）生成数值型价格
+        根据图片的字符信息（price_info 字段）生成数值型价格。模型和图片识别结果在进程内复用
 
         :param s: price_info 内容
         :param model_path: 模型文件路径
 
-        :return:
+        :return: 价格int, 价格图片获取失败时为''
         """
-        from io import BytesIO
-        from PIL import Image
-
-        # 拆分price_info内容为list
-        p_list = s.split('||')
-
-        # 计算第N位数字
-        num_str = str()
-        with open(model_path, 'rb') as f:
-            model = pickle.load(f)
-
-        for i in p_list:
-            ## 识别该位数字图片的url
-            i_url = 'https:' + re.findall('url\((.*)\)', i)[0]
-            if i_url not in self.url_pic:
-                ## 根据url获取图片
-                img = Image.open(BytesIO(requests.get(i_url).content))
-                self.url_pic[i_url] = img
-            else:
-                img = self.url_pic[i_url]
-            ## 图片分割并识别各个顺序位置的值
-            pre_obj = PricePredict(img, model)
-            p_str = ''
-            for j in range(10):
-                num_pre = pre_obj.predict(j)
-                p_str += str(num_pre)
-            # p_str = '1234567890'  # TODO 此处更换为正常数据
-            ## 识别该位数字在图片中px位置，并转换为顺序位置
-            px = re.findall('background-position: (.*)', i)[0]
-            ### px转换position字典 人工学习结果
-            px2pos = {'-0px': 0, '-21.4px': 1, '-42.8px': 2, '-64.2px': 3, '-85.6px': 4, '-107px': 5,
-                      '-128.4px': 6, '-149.8px': 7, '-171.2px': 8, '-192.6px': 9}
-            pos = px2pos.get(px)
-            ## 生成该位数字的值
-            num = p_str[pos]
-            num_str += num
-        # 拼接各位数字生成最终价格
-        price = int(num_str)
-        return price
+        return get_price_decoder(model_path).decode_price(s)
+
+    @staticmethod
+    def prefetch_prices(room_info: List[dict], model_path) -> int:
+        """
+        在逐条计算价格前, 并发下载全部房源用到的价格图片并批量识别
+
+        :param room_info: get_room_info_total的结果
+        :param model_path: 模型文件路径
+        :return: 识别的图片数量
+        """
+        return get_price_decoder(model_path).prefetch([i['price_info'] for i in room_info])
 
 
 class HouseDistrictCatching(RoomInfoCatching):
     """ 小区信息提取 """
+    source = 'HD'
+
     def __init__(self, base_url=None):
         """ base_url: 链家首页 """
         self.url_base = base_url if base_url else 'https://sh.lianjia.com/'
         self.url_selection = f'{self.url_base}xiaoqu/bp6ep10000/'  # 均价6w以上小区 TODO 修改为动态生成
         self.urls_area = None
+        self.failed_hd = list()  # 重试后仍获取失败的小区
         super().__init__()
     
     @classmethod
@@ -402,7 +410,7 @@ class HouseDistrictCatching(RoomInfoCatching):
         else:
             raise Exception(f'城市{city}不在支持列表内')
 
-        res = cls(url)
+        res = cls(url.rstrip('/') + '/')  # 小区的url_base带结尾的/
         return res
 
     def generate_area_urls(self):
@@ -422,15 +430,16 @@ class HouseDistrictCatching(RoomInfoCatching):
         return res
 
     @staticmethod
-    def generate_hd_urls(url) -> List[dict]:
+    def generate_hd_urls(url, html=None) -> List[dict]:
         """
         解析当前页面下的小区url
 
         :param url: 支持首页，区域页面，区域pg页等
+        :param html: 已下载的页面html, 为空时按url下载
         :return:
             [{'house': abc, 'url': 小区页面地址}]
         """
-        doc = pq(get_one_page_html(url))
+        doc = pq(html if html is not None else get_one_page_html(url))
         res = []
         for i in doc('div.title > a').items():
             res.append({'house_district': i.text(),
@@ -456,9 +465,9 @@ class HouseDistrictCatching(RoomInfoCatching):
         return int(house_num/num_one_pg)+1
 
     @staticmethod
-    def get_hd_info(url_house):
-        """ 获取小区基础信息 url_house: 房源的链接 """
-        html_house = get_one_page_html(url_house)
+    def get_hd_info(url_house, html=None):
+        """ 获取小区基础信息 url_house: 房源的链接 html: 已下载的页面html, 为空时按url下载 """
+        html_house = html if html is not None else get_one_page_html(url_house)
         doc = pq(html_house)
         # base info
         items_key = doc('div.xiaoquInfoItem > span.xiaoquInfoLabel').items()
@@ -472,6 +481,7 @@ class HouseDistrictCatching(RoomInfoCatching):
         items_house_desc = doc('li.fl')('div.goodSellItemDesc').items()
         list_desc = [float(re.findall(r"\d+\.?\d*", i.text().split('/')[0])[0]) for i in items_house_desc]
         list_avgprice = [i/j for i, j in zip(list_price, list_desc)]
+        import numpy as np
         base_info_dict['小区均价'] = round(np.mean(list_avgprice), 2) if list_avgprice else None
         return base_info_dict
 
@@ -499,34 +509,86 @@ class HouseDistrictCatching(RoomInfoCatching):
         """ 获取某个区的全部小区信息 """
         area_url = self.get_url_by_area(area)
         if not area_url:
-            return False, '未获取到该区 {} 的链接，支持的区域为 {}'.format(area, [i['area'] for i in self.generate_area_urls()])
+            return False, '未获取到该区 {} 的链接，支持的区域为 {}'.format(area, [i['area'] for i in self.urls_area])
 
         # 获取该区域全部小区的urls
         print('== 开始获取小区urls ==')
-        pg_num = self.calculate_pg_num(area)
-        urls_pg_list = [self.generate_pg_url(area_url, i) for i in range(pg_num)]
+        urls_pg_list = self.frontier.get(area_url, 'area') if self.frontier is not None else None
+        if urls_pg_list is None:
+            pg_num = self.calculate_pg_num(area)
+            urls_pg_list = [self.generate_pg_url(area_url, i) for i in range(pg_num)]
+            if self.frontier is not None:
+                self.frontier.add(urls_pg_list, 'hd_page', area)
+                self.frontier.done(area_url, urls_pg_list, 'area', area)
+        urls_hd_pg = self.frontier.get_many(urls_pg_list, 'hd_page') if self.frontier is not None else dict()
+        for url_pg, html in get_many_page_html([i for i in urls_pg_list if i not in urls_hd_pg]):  # 并发获取区域各分页
+            if html is None:  # 不在此处重新下载, 由frontier记录为失败, 之后的运行重新获取
+                print('==== 小区分页 {} 获取失败, 该页小区缺失 ===='.format(url_pg))
+                urls_hd_pg[url_pg] = list()
+                if self.frontier is not None:
+                    self.frontier.failed(url_pg, '页面获取失败', 'hd_page', area)
+                continue
+            urls_hd_pg[url_pg] = self.generate_hd_urls(url_pg, html)
+            if self.frontier is not None:
+                self.frontier.done(url_pg, urls_hd_pg[url_pg], 'hd_page', area)
         urls_hd_list = list()
-        for i in urls_pg_list:  # 区域循环
-            urls_hd_list += self.generate_hd_urls(i)
+        for i in urls_pg_list:
+            urls_hd_list += urls_hd_pg[i]
         print('== {} 区域总计 {} 个小区'.format(area, len(urls_hd_list)))  # TODO 改成logging方法
         # 分url获取
         print('== 开始获取各小区信息 ==')
-        hd_info_list = list()
+        hd_info_list, failed = self.get_hd_info_many(urls_hd_list, area)
+        if failed:  # 失败的小区重试一次
+            print('== {} 区域 {} 个小区获取失败, 开始重试 =='.format(area, len(failed)))
+            retry_info_list, failed = self.get_hd_info_many(failed, area)
+            hd_info_list += retry_info_list
+        self.failed_hd += failed
+        return hd_info_list
+
+    def get_hd_info_many(self, urls_hd_list: List[dict], area):
+        """
+        并发获取多个小区的信息, 并发数由抓取引擎控制。单个小区失败不影响其他小区
+
+        :param urls_hd_list: generate_hd_urls的结果 [{'house_district': 小区名, 'url': 小区页面地址}]
+        :param area: 区域名
+        :return: 小区信息list(与urls_hd_list顺序一致), 失败的小区list(格式同urls_hd_list, 附带error)
+        """
+        hd_by_url = {i.get('url'): i for i in urls_hd_list}
+        if self.frontier is not None:
+            info_by_url = self.frontier.get_many(hd_by_url, 'community')
+            self.frontier.add([i for i in hd_by_url if i not in info_by_url], 'community', area)
+        else:
+            info_by_url = dict()
+        failed = list()
         n = 0
-        for i in urls_hd_list:
+        time0 = time.time()
+        for url, html in get_many_page_html([i for i in hd_by_url if i not in info_by_url]):
+            i = hd_by_url[url]
+            n += 1
             try:
-                house_info = self.get_hd_info(i.get('url'))
+                if html is None:
+                    raise Exception('页面获取失败')
+                with get_metrics().timer('parse_seconds', source=self.source), profile_stage('parse'):
+                    house_info = self.get_hd_info(url, html)
+                get_metrics().inc('pages_total', source=self.source)
+                get_metrics().inc('listings_total', source=self.source)
                 house_info['小区'] = i.get('house_district')
                 house_info['区域'] = area
-                house_info['url'] = i.get('url')
-                hd_info_list.append(house_info)
-            except Exception as e:
+                house_info['url'] = url
+                info_by_url[url] = house_info
+                if self.frontier is not None:
+                    self.frontier.done(url, house_info, 'community', area)
+            except Exception:
                 print('==== {} 小区信息获取失败 ===='.format(i.get('house_district')))
-                print('==== 异常原因如下 =====', traceback.format_exc())
-            n += 1
+                error = traceback.format_exc(limit=1)
+                failed.append({'house_district': i.get('house_district'), 'url': url, 'error': error})
+                if self.frontier is not None:
+                    self.frontier.failed(url, error, 'community', area)
             if n % 100 == 0:
-                print('=== 完成 {} 个小区，共有 {} 个'.format(n, len(urls_hd_list)))
-        return hd_info_list
+                print('=== 完成 {} 个小区，共有 {} 个, {:.1f} 个/秒'.format(n, len(hd_by_url), n / (time.time() - time0)))
+        print('=== {} 区域完成 {} 个小区, 失败 {} 个, {:.1f} 个/秒'.format(
+            area, len(info_by_url), len(failed), n / max(time.time() - time0, 1e-6)))
+        return [info_by_url[i] for i in hd_by_url if i in info_by_url], failed
 
     @print_time
     def get_total_hd_info(self):
@@ -541,8 +603,14 @@ class HouseDistrictCatching(RoomInfoCatching):
             hd_info_list += self.get_area_hd_info(area)
             timedelta = int(time.time() - time1)
             print('== 区域 {} 已经完成，耗时 {} 秒'.format(area, timedelta))
+        if self.failed_hd:
+            print('= 共 {} 个小区重试后仍获取失败, 见failed_hd = '.format(len(self.failed_hd)))
         return hd_info_list
 
+    def crawl_area(self, area):
+        """ 多进程模式下单个区域的任务入口 """
+        return self.get_area_hd_info(area)
+
     # def main_multiprocess(self, area):
     #     """ 子进程方法执行全量数据 """
     #     print('=== 子进程开始执行 {} 区域 ==='.format(area))
@@ -556,3 +624,89 @@ class HouseDistrictCatching(RoomInfoCatching):
     #     save_info_to_mongodb(room_info_total, db_config)
     #     print('== {} 区域数据库写入完毕 =='.format(area))
     #     print('=== 子进程 {} 区域执行完毕 ==='.format(area))
+
+
+def init_worker_process(fetcher_cfg: dict, decoder_cfg: dict):
+    """
+    进程池子进程的初始化: 按主进程的配置重建抓取引擎(存储、回放、限速、重试)和价格解码器
+    spawn方式(Windows、macOS的默认方式)启动的子进程不继承主进程的模块状态, 不能依赖fork
+
+    :param fetcher_cfg: html_service.fetcher_config()的结果
+    :param decoder_cfg: ocr_service.decoder_config()的结果
+    """
+    configure_fetcher(**fetcher_cfg)
+    configure_price_decoders(decoder_cfg)
+
+
+def worker_initargs(workers=1) -> tuple:
+    """
+    init_worker_process的参数, 在主进程中调用
+
+    :param workers: 进程数, 每个进程的限速和并发为总量的1/workers, 各host的总请求速度不随进程数增加
+    """
+    fetcher_cfg = fetcher_config()
+    if workers > 1:
+        fetcher_cfg['rate'] = fetcher_cfg.get('rate', 5.0) / workers
+        fetcher_cfg['max_workers'] = max(fetcher_cfg.get('max_workers', 8) // workers, 1)
+    return fetcher_cfg, decoder_config()
+
+
+def _crawl_area(catcher, area):
+    """ 子进程执行单个区域 """
+    print('=== 子进程开始执行 {} 区域 ==='.format(area))
+    res = catcher.crawl_area(area)
+    if isinstance(res, tuple):  # (False, 错误信息)
+        raise Exception(res[1])
+    print('=== 子进程 {} 区域执行完毕 ==='.format(area))
+    save_price_decoders()  # 子进程中新识别的价格数字
+    # 子进程的指标、性能分析和页面失败的区域交给主进程合并
+    return res, get_metrics().snapshot(reset=True), profile_snapshot(), catcher.failed_areas
+
+
+@print_time
+def crawl_areas_multiprocess(catchers: dict, workers=4, retries=1) -> tuple:
+    """
+    多进程按区域并行抓取。全部爬虫的区域任务放入同一个进程池, 结果按爬虫和区域顺序合并
+    失败的区域在全部任务结束后重试, 仍失败的区域同时记录在各爬虫的failed_areas中
+
+    :param catchers: {名称: 爬虫实例}, 爬虫需要有generate_area_urls和crawl_area方法
+    :param workers: 进程池大小
+    :param retries: 失败区域的重试轮数
+    :return: {名称: 信息list}, 重试后仍失败的 [(名称, 区域)]
+    """
+    tasks = list()
+    for name, catcher in catchers.items():
+        area_info_list = catcher.urls_area if catcher.urls_area else catcher.generate_area_urls()
+        for i in area_info_list:
+            tasks.append((name, i['area']))
+    print('= 多进程抓取开始！共有 {} 个区域任务, 进程数 {} = '.format(len(tasks), workers))
+
+    res = {name: list() for name in catchers}
+    failed = list()
+    from concurrent.futures import ProcessPoolExecutor  # 多进程时才导入multiprocessing
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_process,
+                             initargs=worker_initargs(workers)) as executor:
+        for n in range(retries + 1):
+            if n:
+                print('= 重试失败的区域 第 {} 轮, 共 {} 个 {} = '.format(n, len(tasks), tasks))
+            futures = [executor.submit(_crawl_area, catchers[name], area) for name, area in tasks]
+            failed = list()
+            for (name, area), future in zip(tasks, futures):  # 按提交顺序取结果, 保证合并顺序稳定
+                try:
+                    info, snapshot, profile, failed_areas = future.result()
+                    res[name] += info
+                    get_metrics().merge(snapshot)
+                    merge_profile_snapshot(profile)
+                    catchers[name].failed_areas.update(failed_areas)
+                except Exception:
+                    failed.append((name, area))
+                    print('==== {} {} 区域获取失败 ===='.format(name, area))
+                    print('==== 异常原因如下 =====', traceback.format_exc())
+            tasks = failed
+            if not tasks:
+                break
+    for name, area in failed:
+        catchers[name].failed_areas.add(area)
+    if failed:
+        print('==== 共 {} 个区域重试后仍获取失败 {} ===='.format(len(failed), failed))
+    return res, failed
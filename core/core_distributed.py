@@ -0,0 +1,202 @@
+# 本方法为多城市分布式抓取: 协调器把城市列表展开为区域级任务放入共享队列, 同一台机器上的多个worker进程领取执行
+# 队列为sqlite文件, 不支持放在共享目录中供多台机器使用, 见queue_service
+# 每个区域任务的结果随任务完成写入队列的results表, 全部任务结束后按城市合并
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+from typing import Dict, List
+
+now_dir = os.path.dirname(__file__)
+path_code = os.path.dirname(now_dir)
+if path_code not in sys.path:
+    sys.path.append(path_code)
+
+from core.core_catching import RoomInfoCatchingLJ, RoomInfoCatchingZR, HouseDistrictCatching
+from utils.common_utils import G_LJ, G_ZR, get_city_code
+from utils.queue_service import TaskQueue
+
+
+CATCHER_CLASSES = {'LJ': RoomInfoCatchingLJ, 'ZR': RoomInfoCatchingZR, 'HD': HouseDistrictCatching}
+
+
+def parse_cities(cities) -> List[str]:
+    """
+    城市列表转为城市代码list
+
+    :param cities: 'sh,bj' 或 ['上海', 'bj'], 'all'为链家和自如支持的全部城市
+    """
+    if isinstance(cities, str):
+        if cities == 'all':
+            return list(dict.fromkeys(G_LJ.citycode_list + G_ZR.citycode_list))
+        cities = cities.split(',')
+    return list(dict.fromkeys(get_city_code(i.strip()) for i in cities if i.strip()))
+
+
+def city_sources(city, house_district=False) -> List[str]:
+    """ 该城市支持的来源, 链家和自如支持的城市不同, 小区信息来自链家 """
+    sources = list()
+    if city in G_LJ.citycode_list:
+        sources.append('LJ')
+    if city in G_ZR.citycode_list:
+        sources.append('ZR')
+    if house_district and 'LJ' in sources:
+        sources.append('HD')
+    return sources
+
+
+def expand_city_tasks(cities: List[str], house_district=False) -> List[dict]:
+    """
+    把城市列表展开为区域级任务
+
+    :param cities: 城市代码list
+    :param house_district: 是否包含小区任务
+    :return: [{'city': 城市代码, 'source': 来源, 'area': 区域名}]
+    """
+    tasks = list()
+    for city in cities:
+        sources = city_sources(city, house_district)
+        if not sources:
+            print('==== 城市 {} 不在支持列表内 ===='.format(city))
+        for source in sources:
+            try:
+                areas = CATCHER_CLASSES[source].init_city(city).generate_area_urls()
+            except Exception:
+                print('==== {} {} 区域列表获取失败 ===='.format(city, source))
+                print('==== 异常原因如下 =====', traceback.format_exc())
+                continue
+            tasks += [{'city': city, 'source': source, 'area': i['area']} for i in areas]
+            print('== {} {} 共有 {} 个区域 =='.format(city, source, len(areas)))
+    return tasks
+
+
+def coordinate(queue: TaskQueue, cities: List[str], run_tag: str, house_district=False) -> int:
+    """ 协调器: 展开任务并放入队列, 返回新加入的任务数 """
+    tasks = expand_city_tasks(cities, house_district)
+    n = queue.put(run_tag, tasks)
+    print('= 协调器 {} 共 {} 个区域任务, 新加入 {} 个 = '.format(run_tag, len(tasks), n))
+    return n
+
+
+class Heartbeat(threading.Thread):
+    """ 后台心跳线程, 每隔lease_seconds/3续约一次当前任务 """
+    def __init__(self, queue: TaskQueue, worker: str):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.worker = worker
+        self.task_id = None
+        self.lost = False  # 当前任务的租约是否已被其他worker接管
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(max(self.queue.lease_seconds / 3, 1)):
+            try:
+                if not self.queue.heartbeat(self.worker, self.task_id):
+                    self.lost = True
+            except Exception:
+                print('==== worker {} 心跳失败 ===='.format(self.worker))
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def run_worker(queue: TaskQueue, run_tag=None, worker_id=None, idle_exit=True, poll=5) -> int:
+    """
+    worker: 循环领取区域任务并执行, 结果随任务完成写入队列
+
+    :param queue: 任务队列
+    :param run_tag: 只执行该批次的任务, 为空时不限
+    :param worker_id: worker id, 默认为 主机名-pid-随机串
+    :param idle_exit: 队列中没有可领取的任务时是否退出, 否则每poll秒重试
+    :param poll: 等待间隔(秒)
+    :return: 完成的任务数
+    """
+    worker = worker_id or '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+    catchers = dict()  # 同一城市和来源的任务共用catcher, 区域列表只解析一次
+    heartbeat = Heartbeat(queue, worker)
+    queue.heartbeat(worker)
+    heartbeat.start()
+    n = 0
+    print('= worker {} 开始 = '.format(worker))
+    try:
+        while True:
+            task = queue.lease(worker, run_tag)
+            if task is None:
+                if idle_exit:
+                    break
+                time.sleep(poll)
+                continue
+            heartbeat.task_id, heartbeat.lost = task['id'], False
+            queue.heartbeat(worker, task['id'])
+            key = (task['city'], task['source'])
+            print('== worker {} 开始 {} {} {} 第 {} 次 =='.format(worker, *key, task['area'], task['attempts']))
+            try:
+                if key not in catchers:
+                    catchers[key] = CATCHER_CLASSES[task['source']].init_city(task['city'])
+                catchers[key].failed_areas.discard(task['area'])  # 同一区域重试时清除上次的失败记录
+                res = catchers[key].crawl_area(task['area'])
+                if isinstance(res, tuple):  # (False, 错误信息)
+                    raise Exception(res[1])
+                if heartbeat.lost or not queue.heartbeat(worker, task['id']):
+                    # 租约已过期并被其他worker接管, 放弃结果, 不写入也不标记完成
+                    print('==== 任务 {} 的租约已丢失, 放弃该区域 ===='.format(task['id']))
+                    heartbeat.task_id = None
+                    continue
+                if task['area'] in catchers[key].failed_areas:  # 缺页的结果不写入, 任务失败后重新放回队列
+                    raise Exception('区域 {} 有页面获取失败'.format(task['area']))
+                if queue.complete(task['id'], worker, res):
+                    n += 1
+                else:
+                    print('==== 任务 {} 的租约已被其他worker接管 ===='.format(task['id']))
+            except Exception:
+                print('==== {} {} {} 区域获取失败 ===='.format(*key, task['area']))
+                print('==== 异常原因如下 =====', traceback.format_exc())
+                queue.fail(task['id'], worker, traceback.format_exc(limit=1))
+            heartbeat.task_id = None
+    finally:
+        heartbeat.stop()
+        queue.heartbeat(worker)
+    print('= worker {} 结束, 完成 {} 个任务 = '.format(worker, n))
+    return n
+
+
+def wait_for_tasks(queue: TaskQueue, run_tag, poll=30, timeout=None) -> dict:
+    """ 等待该批次全部任务结束(完成或失败), 返回各状态任务数 """
+    time0 = time.time()
+    while queue.unfinished(run_tag):
+        if timeout is not None and time.time() - time0 > timeout:
+            print('==== 等待超时, 仍有 {} 个任务未结束 ===='.format(queue.unfinished(run_tag)))
+            break
+        print('== {} 任务进度 {} 活跃worker {} 个 =='.format(
+            run_tag, queue.stats(run_tag), len(queue.workers(alive_seconds=queue.lease_seconds))))
+        time.sleep(poll)
+    return queue.stats(run_tag)
+
+
+def failed_city_areas(queue: TaskQueue, run_tag, city) -> Dict[str, set]:
+    """ 一个城市未完成的区域 {来源: 区域set}, 增量模式下这些区域的房源不算下架 """
+    res = {source: set() for source in CATCHER_CLASSES}
+    for task in queue.tasks(run_tag, city):
+        if task['status'] != TaskQueue.DONE:
+            res[task['source']].add(task['area'])
+    return res
+
+
+def load_city_results(queue: TaskQueue, run_tag, city) -> Dict[str, list]:
+    """
+    按任务加入顺序合并一个城市的区域结果
+
+    :return: {来源: 信息list}, 失败的区域会打印并跳过
+    """
+    res = dict()
+    for task in queue.tasks(run_tag, city):
+        info = res.setdefault(task['source'], list())
+        if task['status'] != TaskQueue.DONE:
+            print('==== {} {} {} 区域未完成 状态 {} 原因 {} ===='.format(
+                city, task['source'], task['area'], task['status'], task['error']))
+            continue
+        info += queue.result(task['id']) or list()
+    return res
@@ -0,0 +1,115 @@
+# 本方法为房源列表页的解析。css选择器在模块加载时编译为xpath, 每页只建一次dom, 一次遍历取出全部字段
+import re
+from typing import List
+
+from lxml import html as lxml_html
+from lxml.cssselect import CSSSelector
+from pyquery.text import extract_text  # 与PyQuery.text()的文本规则保持一致
+
+
+# 链家
+SEL_LJ_ITEM = CSSSelector('.content__list--item--main')
+SEL_LJ_URL = CSSSelector('.twoline')
+SEL_LJ_DESC = CSSSelector('.content__list--item--des')
+SEL_LJ_PRICE = CSSSelector('.content__list--item-price')
+SEL_LJ_TIME = CSSSelector('.content__list--item--time.oneline')
+RE_LJ_PRICE = re.compile(r'(\d+).* +元/月')
+RE_AREA = re.compile('(.*)㎡')
+
+# 自如
+SEL_ZR_ITEM = CSSSelector('div.item')
+SEL_ZR_NAME = CSSSelector('div.info-box a')
+SEL_ZR_AREA = CSSSelector('div.desc div:nth-of-type(1)')
+SEL_ZR_LOCATION = CSSSelector('div.desc>div.location')
+SEL_ZR_PRICE = CSSSelector('div.price span.num')
+SEL_ZR_TAG = CSSSelector('div.tag span')
+RE_ZR_TYPES = re.compile(r'.*(\d+居室).*')
+
+
+def to_dom(html):
+    """ html文本或response的bytes转为dom, 空页面返回None """
+    if html is None or not html.strip():
+        return None
+    return lxml_html.fromstring(html)
+
+
+def _text(elements) -> str:
+    """ 同PyQuery的text(), 多个元素以空格拼接 """
+    return ' '.join(extract_text(i) for i in elements)
+
+
+def _attr(elements, name):
+    """ 同PyQuery的attr(), 取第一个元素的属性 """
+    return elements[0].get(name) if elements else None
+
+
+def parse_room_info_page_lj(html, url_base) -> List[dict]:
+    """
+    解析链家房源列表页, 结果与RoomInfoCatchingLJ原PyQuery实现一致
+
+    :param html: 页面html文本或bytes
+    :param url_base: 链家首页, 用于拼接房源链接
+    :return:
+    """
+    doc = to_dom(html)
+    if doc is None:
+        return list()
+    res = []
+    for i in SEL_LJ_ITEM(doc):
+        room_url = url_base + _attr(SEL_LJ_URL(i), 'href')
+        desc = _text(SEL_LJ_DESC(i))
+        price_str = _text(SEL_LJ_PRICE(i))
+        updated_info = _text(SEL_LJ_TIME(i))
+        desc_vec = desc.replace(' ', '').split('/')
+        name = desc_vec[0]
+        area_str = desc_vec[1]
+        orientation = desc_vec[2]
+        types = desc_vec[3]
+        floor = desc_vec[4]
+        price = float(RE_LJ_PRICE.findall(price_str)[0])
+        area = float(RE_AREA.findall(area_str)[0])
+        avg_price = round(price / area, 2)
+        sub_area = name.split('-')[1]
+        dict_info = {'name': name, 'area_str': area_str, 'price_str': price_str,
+                     'area': area, 'price': price, 'avg_price': avg_price,
+                     'orientation': orientation, 'room_types': types, 'floor': floor,
+                     'updated_info': updated_info, '子区域': sub_area,
+                     'room_url': room_url}
+        res.append(dict_info)
+    return res
+
+
+def parse_room_info_page_zr(html) -> List[dict]:
+    """
+    解析自如房源列表页, 结果与RoomInfoCatchingZR原PyQuery实现一致
+
+    :param html: 页面html文本或bytes
+    :return:
+    """
+    doc = to_dom(html)
+    if doc is None:
+        return list()
+    res = list()
+    for i in SEL_ZR_ITEM(doc):
+        name_items = SEL_ZR_NAME(i)
+        name = _text(name_items)  # 名称
+        url = 'https:' + _attr(name_items, 'href')
+        area_desc_str = _text(SEL_ZR_AREA(i))
+        area_str = area_desc_str.split('|')[0]
+        area = float(RE_AREA.findall(area_str)[0])  # 面积
+        tmp_types = area_desc_str.split('|')[1]
+        if len(tmp_types.split('/')) > 1:
+            types = RE_ZR_TYPES.findall(name)[0]
+            floor = int(tmp_types.split('/')[0])
+        else:
+            types = tmp_types
+            floor = ''
+        locations = _text(SEL_ZR_LOCATION(i))
+        price_info = '||'.join([num.get('style') for num in SEL_ZR_PRICE(i)])  # ||分割改list为str
+        tags = '||'.join([_text([tag]) for tag in SEL_ZR_TAG(i)])  # ||分割改list为str
+        dict_info = {'name': name, 'room_url': url, 'area_str': area_str, 'price_info': price_info,
+                     'area': area, 'room_types': types, 'locations': locations, 'tags': tags, 'floor': floor,
+                     }
+        res.append(dict_info)
+    return res
+
@@ -0,0 +1,124 @@
+# 本方法为流水线模式: 页面 -> 解析 -> 价格识别 -> 整理 -> 分块写入
+# 每个环节都是生成器, 内存占用与城市大小无关, 第一批数据在抓取开始后很快就能写入
+import os
+import sys
+import time
+from itertools import islice
+from typing import Iterable, Iterator, List
+
+now_dir = os.path.dirname(__file__)
+path_code = os.path.dirname(now_dir)
+if path_code not in sys.path:
+    sys.path.append(path_code)
+
+from core.core_record import RoomRecord
+from utils.ocr_service import get_price_decoder
+from utils.fingerprint_service import ListingIndex
+from utils.community_service import CommunityIndex
+from utils.dedup_service import ListingDeduper
+from utils.metrics_service import get_metrics
+from utils.profile_service import profile_stage
+
+
+def iter_chunks(iterable: Iterable, chunk_size) -> Iterator[list]:
+    """ 按chunk_size切分生成器 """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def add_avg_price(room_info: dict) -> dict:
+    """ 添加平米均价, 价格或面积缺失时为空 """
+    try:
+        avg_price = round(float(room_info['price']) / float(room_info['area']), 2)
+    except:
+        avg_price = ''
+    room_info['avg_price'] = avg_price
+    return room_info
+
+
+def dedup_listings(room_info_iter: Iterable[dict], source, deduper: ListingDeduper=None) -> Iterator[dict]:
+    """ 按room_url去掉重复的房源(跨分页、跨区域), 需要放在价格识别和整理之前, 每个来源一个deduper """
+    deduper = deduper if deduper is not None else ListingDeduper()
+    metrics = get_metrics()
+    for i in room_info_iter:
+        metrics.inc('dedup_listings_total', source=source)
+        if deduper.seen(i['room_url']):
+            metrics.inc('dedup_duplicates_total', source=source)
+            continue
+        yield i
+
+
+def add_zr_price(room_info_iter: Iterable[dict], model_path, chunk_size=200) -> Iterator[dict]:
+    """ 自如房源分块添加价格: 每块先并发下载并批量识别价格图片, 再逐条查缓存 """
+    decoder = get_price_decoder(model_path)
+    for chunk in iter_chunks(room_info_iter, chunk_size):
+        decoder.prefetch([i['price_info'] for i in chunk])
+        for i in chunk:
+            i['price'] = decoder.decode_price(i['price_info'])
+            yield add_avg_price(i)
+
+
+def normalize(room_info_iter: Iterable[dict], source, report_size=500) -> Iterator[RoomRecord]:
+    """ 逐条整理数据, 每report_size条记录一次整理耗时 """
+    cost, n = 0.0, 0
+    for i in room_info_iter:
+        with profile_stage('merge'):
+            time0 = time.perf_counter()
+            record = RoomRecord.from_raw(i, source)
+            cost += time.perf_counter() - time0
+        n += 1
+        if n == report_size:
+            get_metrics().observe('normalize_seconds', cost, source=source)
+            get_metrics().inc('normalize_records_total', n, source=source)
+            cost, n = 0.0, 0
+        yield record
+    if n:
+        get_metrics().observe('normalize_seconds', cost, source=source)
+        get_metrics().inc('normalize_records_total', n, source=source)
+
+
+def add_hd_price(records: Iterable[RoomRecord], hd_index: CommunityIndex) -> Iterator[RoomRecord]:
+    """ 逐条按小区索引添加小区均价, 同名小区用区域区分 """
+    for i in records:
+        i.hd_avg_price = hd_index.price(i.house_district, i.area_name)
+        yield i
+
+
+def iter_removed(index: ListingIndex, failed_areas: Iterable[str]=()) -> Iterator[RoomRecord]:
+    """
+    增量模式下的下架房源, 需要放在该来源全部房源之后消费
+
+    :param failed_areas: 有页面获取失败的区域(catcher.failed_areas), 在消费时才读取, 这些区域的房源不算下架
+    """
+    index.keep(failed_areas)
+    for url in index.removed():
+        yield RoomRecord.removed(url, ListingIndex.REMOVED)
+
+
+def run_pipeline(info_iter: Iterable[dict], sinks: List, chunk_size=500, name='') -> int:
+    """
+    按块将数据写入全部sink
+
+    :param info_iter: 整理好的数据生成器
+    :param sinks: 需要有write(chunk)和close()方法
+    :param chunk_size: 每次写入的条数
+    :param name: 打印进度用的名称
+    :return: 写入总条数
+    """
+    n = 0
+    time0 = time.time()
+    try:
+        for chunk in iter_chunks(info_iter, chunk_size):
+            with profile_stage('sink'):
+                for sink in sinks:
+                    sink.write(chunk)
+            n += len(chunk)
+            print('== {} 已写入 {} 条, 耗时 {} 秒 =='.format(name, n, int(time.time() - time0)))
+    finally:
+        for sink in sinks:
+            sink.close()
+    return n
@@ -0,0 +1,63 @@
+import re
+import sys
+
+
+RE_ZR_ROOM_NUM = re.compile(r'\d居室')
+_MISSING = object()  # 小区均价未计算, 区别于计算了但没有匹配到(None)
+
+
+class RoomRecord:
+    """
+    整理后的房源记录。使用__slots__减少单条内存, 区域/朝向/户型等重复取值较多的字段做字符串驻留
+    只在写入本地或数据库时通过to_dict转为中文字段的dict
+    """
+    __slots__ = ('house_district', 'orientation', 'avg_price', 'room_url', 'area_name', 'room_types',
+                 'price', 'area', 'floor', 'change', 'hd_avg_price')
+
+    def __init__(self, house_district=None, orientation=None, avg_price=None, room_url=None, area_name=None,
+                 room_types=None, price=None, area=None, floor=None, change=None):
+        self.house_district = house_district
+        self.orientation = sys.intern(orientation) if orientation else orientation
+        self.avg_price = avg_price
+        self.room_url = room_url
+        self.area_name = sys.intern(area_name) if area_name else area_name
+        self.room_types = sys.intern(room_types) if room_types else room_types
+        self.price = price
+        self.area = area
+        self.floor = floor
+        self.change = change  # 增量模式的变更类型
+        self.hd_avg_price = _MISSING
+
+    @classmethod
+    def from_raw(cls, i: dict, source='ZR'):
+        """
+        由get_room_info_page的结果生成记录
+
+        :param i: 房源原始信息
+        :param source: 'ZR' 或 'LJ'
+        """
+        if source == 'ZR':
+            name_vec = i['name'].split('-')
+            house_district = RE_ZR_ROOM_NUM.sub('', i['name'].split('·')[-1].split('-')[0])
+            orientation = name_vec[-1] if len(name_vec) > 1 else ''
+        else:
+            house_district = i['name'].split('-')[-1]
+            orientation = i['orientation']
+        return cls(house_district=house_district, orientation=orientation, avg_price=i['avg_price'],
+                   room_url=i['room_url'], area_name=i['区域'], room_types=i['room_types'].replace(' ', ''),
+                   price=i.get('price'), area=i['area'], floor=i['floor'], change=i.get('change'))
+
+    @classmethod
+    def removed(cls, room_url, change):
+        """ 增量模式下已下架的房源, 只有链接 """
+        return cls(room_url=room_url, change=change)
+
+    def to_dict(self) -> dict:
+        res = {'小区': self.house_district, '朝向': self.orientation, '平米均价': self.avg_price,
+               '房源链接': self.room_url, '区域': self.area_name, '户型': self.room_types, '价格': self.price,
+               '面积': self.area, '楼层': self.floor}
+        if self.change is not None:
+            res['变更'] = self.change
+        if self.hd_avg_price is not _MISSING:
+            res['小区均价'] = self.hd_avg_price
+        return res
@@ -4,24 +4,373 @@ import logging
 import time
 import datetime
 import traceback
-import pandas as pd
 import argparse
 import copy
+from itertools import chain
+from urllib.parse import urlsplit
 
 path_code = os.path.dirname(__file__)
 if path_code not in sys.path:
     sys.path.append(path_code)
 
-from core.core_catching import RoomInfoCatching, RoomInfoCatchingLJ, RoomInfoCatchingZR, HouseDistrictCatching
+from core.core_catching import RoomInfoCatching, RoomInfoCatchingLJ, RoomInfoCatchingZR, HouseDistrictCatching, \
+    crawl_areas_multiprocess, init_worker_process, worker_initargs
 from utils.log_service import Logging
-from utils.io_service import save_info_to_local, save_info_to_mongodb, test_db_connect
+from core.core_pipeline import add_avg_price, add_zr_price, normalize, add_hd_price, iter_removed, run_pipeline, \
+    dedup_listings
+from utils.io_service import save_info_to_local, save_info_to_mongodb, test_db_connect, CsvChunkSink, MongoBulkWriter, \
+    ParquetChunkSink, save_info_to_parquet, export_parquet_to_excel
+from utils.common_utils import get_city_code
+from utils.html_service import configure_fetcher, get_fetcher
+from utils.ocr_service import configure_price_decoder, save_price_decoders
+from utils.store_service import ResponseStore
+from utils.fingerprint_service import ListingIndex
+from utils.community_service import CommunityIndex
+from utils.frontier_service import CrawlFrontier
+from utils.queue_service import TaskQueue
+from utils.metrics_service import get_metrics, start_progress, stop_progress
+from utils.profile_service import start_profiler, stop_profiler, profile_stage, profile_snapshot, \
+    merge_profile_snapshot
+from core.core_distributed import CATCHER_CLASSES, parse_cities, coordinate, run_worker, wait_for_tasks, \
+    load_city_results, failed_city_areas
 
 
 logger = Logging().log(level='INFO')
 
 
+# 各来源在mongodb中upsert的唯一键(与date一起)
+DB_KEY_FIELDS = {'LJ': '房源链接', 'ZR': '房源链接', 'HD': 'url'}
+
+
+def make_db_configs(db_config: dict, time_tag: str):
+    """
+    根据main的db_config生成链家、自如、小区各自的库表配置
+
+    :return: {'LJ': 库表配置, 'ZR': 库表配置, 'HD': 库表配置}, server_config
+    """
+    if not db_config:  # 默认存local
+        db_configs = {'LJ': {'db_name': 'crawler', 'tb_name': 'room_info_lj_{}'.format(time_tag)},
+                      'ZR': {'db_name': 'crawler', 'tb_name': 'room_info_zr_{}'.format(time_tag)},
+                      'HD': {'db_name': 'crawler', 'tb_name': 'house_district_info_{}'.format(time_tag)}}
+        server_config = None
+    else:
+        db_configs = {'LJ': {'db_name': db_config['db_name'], 'tb_name': db_config['tb_name_lj']},
+                      'ZR': {'db_name': db_config['db_name'], 'tb_name': db_config['tb_name_zr']},
+                      'HD': {'db_name': db_config['db_name'], 'tb_name': db_config.get('tb_name_hd')}}
+        server_config = {'host': db_config['host'], 'port': db_config['port']}
+    return db_configs, server_config
+
+
+def excel_file_path(local_path, source, time_tag) -> str:
+    """ 本地excel的路径, 与历史结果的目录和命名保持一致 """
+    if source == 'HD':
+        return os.path.join(local_path, 'house_district_info_{}.xlsx'.format(time_tag))
+    return os.path.join(local_path, source, '{}_room_info_{}.xlsx'.format(source, time_tag))
+
+
+def save_local(infos: dict, local_path, local_format, export_excel, city_code, time_tag):
+    """
+    写入本地
+
+    :param infos: {来源: 信息list}
+    :param local_format: 'excel' 或 'parquet'(按 来源/城市/日期 分区, 分row group写入)
+    :param export_excel: parquet格式时是否同时导出excel
+    """
+    for source, info in infos.items():
+        file_path = excel_file_path(local_path, source, time_tag)
+        if local_format == 'parquet':
+            with profile_stage('sink'):
+                save_info_to_parquet(info, local_path, source, city_code, time_tag)
+                if export_excel:
+                    export_parquet_to_excel(local_path, source, city_code, time_tag, file_path)
+        else:
+            with profile_stage('sink'):
+                save_info_to_local(info, os.path.dirname(file_path), os.path.basename(file_path))
+
+
+def make_listing_index(catcher, index_path) -> ListingIndex:
+    """ 每个来源和城市(按域名区分)一个指纹索引文件 """
+    return ListingIndex(os.path.join(index_path, '{}.json'.format(urlsplit(catcher.url_base).netloc)))
+
+
+def community_index_path(local_path, index_path, city_code) -> str:
+    """ 每个城市一个小区索引文件, 默认在local_path/index中 """
+    return os.path.join(index_path if index_path else os.path.join(local_path, 'index'),
+                        'community_{}.json'.format(city_code))
+
+
+def build_community_index(info_hd, path=None) -> CommunityIndex:
+    """ 由本次抓取的小区信息建立索引, path输入后保存, 并保留原索引文件中手动维护的别名 """
+    hd_index = CommunityIndex.from_hd_info(info_hd, CommunityIndex.load_aliases(path))
+    if path:
+        hd_index.save(path)
+        logger.info('== 小区索引共 {} 个小区, 已保存 {} =='.format(len(hd_index), path))
+    return hd_index
+
+
+def main_stream(catcher_lj, catcher_zr, catcher_hd, model_path, local_path, db_config, tag_local, tag_db,
+                time_tag, chunk_size=500, index_lj=None, index_zr=None, local_format='excel', export_excel=False,
+                city_code='sh', hd_index=None, hd_index_path=None):
+    """
+    流水线模式: 边抓取边价格识别、整理, 并分块写入本地和数据库。本地为csv或parquet, 参数同main
+    index_lj, index_zr: 增量模式的ListingIndex, 输入后只处理新增和变更的房源, 最后追加下架房源
+        有页面获取失败的区域(catcher.failed_areas)中的房源不算下架
+    hd_index: 已有的小区索引, 不抓取小区时用于添加小区均价; catcher_hd输入时由本次抓取的小区重建并保存到hd_index_path
+    """
+    db_configs, server_config = make_db_configs(db_config, time_tag)
+
+    def make_sinks(source):
+        sinks = list()
+        if tag_local and local_format == 'parquet':
+            sinks.append(ParquetChunkSink(local_path, source, city_code, time_tag))
+        elif tag_local:
+            file_path = excel_file_path(local_path, source, time_tag)[:-len('xlsx')] + 'csv'
+            sinks.append(CsvChunkSink(os.path.dirname(file_path), os.path.basename(file_path)))
+        if tag_db:
+            sinks.append(MongoBulkWriter(db_configs[source], server_config, DB_KEY_FIELDS[source], time_tag,
+                                         chunk_size, city=city_code))
+        return sinks
+
+    if catcher_hd is not None:  # 小区均价需要先于房源获取
+        logger.info('== 开始获取小区信息 {} =='.format(time.asctime()))
+        info_hd = catcher_hd.get_total_hd_info()
+        hd_index = build_community_index(info_hd, hd_index_path)
+        run_pipeline(info_hd, make_sinks('HD'), chunk_size, 'HD')
+
+    logger.info('== 开始流式获取链家的房源信息 {} =='.format(time.asctime()))
+    info_lj = dedup_listings(catcher_lj.iter_room_info_total(), 'LJ')
+    if index_lj is not None:
+        info_lj = index_lj.diff(info_lj)
+    info_lj = normalize(info_lj, 'LJ')
+    if hd_index is not None:
+        info_lj = add_hd_price(info_lj, hd_index)
+    if index_lj is not None:
+        info_lj = chain(info_lj, iter_removed(index_lj, catcher_lj.failed_areas))
+    n_lj = run_pipeline(info_lj, make_sinks('LJ'), chunk_size, 'LJ')
+
+    logger.info('== 链家 {} 条写入完毕，开始流式获取自如房源信息 {} =='.format(n_lj, time.asctime()))
+    info_zr = add_zr_price(dedup_listings(catcher_zr.iter_room_info_total(), 'ZR'), model_path)
+    if index_zr is not None:  # 指纹使用识别后的价格, 价格识别需要在对比之前
+        info_zr = index_zr.diff(info_zr)
+    info_zr = normalize(info_zr, 'ZR')
+    if hd_index is not None:
+        info_zr = add_hd_price(info_zr, hd_index)
+    if index_zr is not None:
+        info_zr = chain(info_zr, iter_removed(index_zr, catcher_zr.failed_areas))
+    n_zr = run_pipeline(info_zr, make_sinks('ZR'), chunk_size, 'ZR')
+    logger.info('== 自如 {} 条写入完毕 {} =='.format(n_zr, time.asctime()))
+    if hd_index is not None:
+        logger.info('== 小区匹配统计 {} =='.format(hd_index.stats))
+    if tag_local and local_format == 'parquet' and export_excel:
+        for source in (['HD'] if catcher_hd is not None else []) + ['LJ', 'ZR']:
+            export_parquet_to_excel(local_path, source, city_code, time_tag,
+                                    excel_file_path(local_path, source, time_tag))
+    return True
+
+
+def save_batch(info_lj, info_zr, info_hd, model_path, local_path, db_config, tag_local, tag_db, time_tag,
+               index_lj=None, index_zr=None, local_format='excel', export_excel=False, city_code='sh',
+               hd_index=None, hd_index_path=None):
+    """
+    批量模式: 抓取完成后统一价格识别、整理, 并写入本地和数据库。参数同main_stream
+    info_lj, info_zr, info_hd: 各来源的原始信息, 为None时跳过该来源(如城市不支持自如, 或不计算小区)
+    index_lj, index_zr: 有页面获取失败的区域需要先用ListingIndex.keep标记
+    """
+    if info_lj is not None:  # 去掉跨分页、跨区域(多进程时为跨进程)的重复房源
+        info_lj = list(dedup_listings(info_lj, 'LJ'))
+    if info_zr is not None:
+        info_zr = list(dedup_listings(info_zr, 'ZR'))
+    if info_zr is not None:  # 添加价格, 增量模式的指纹使用识别后的价格
+        n_sprite = RoomInfoCatchingZR.prefetch_prices(info_zr, model_path)
+        logger.info('== 自如价格图片下载识别完毕, 共 {} 张 {} =='.format(n_sprite, time.asctime()))
+        with profile_stage('merge'):
+            for i in info_zr:
+                i['price'] = RoomInfoCatchingZR.get_price(i['price_info'], model_path)
+        logger.info('== 自如房源价格计算完毕 {} =='.format(time.asctime()))
+    if index_lj is not None and info_lj is not None:  # 只保留新增和变更的房源
+        info_lj = list(index_lj.diff(info_lj))
+        logger.info('== 增量统计 链家 {} =='.format(index_lj.stats))
+    if index_zr is not None and info_zr is not None:
+        info_zr = list(index_zr.diff(info_zr))
+        logger.info('== 增量统计 自如 {} =='.format(index_zr.stats))
+
+    infos = dict()
+    if info_lj is not None:
+        infos['LJ'] = RoomInfoCatching.normalize_info(info_lj, 'LJ')
+    if info_zr is not None:
+        # 添加均价
+        with profile_stage('merge'):
+            for i in info_zr:
+                add_avg_price(i)
+        # 整理数据
+        infos['ZR'] = RoomInfoCatching.normalize_info(info_zr, 'ZR')
+    if info_hd is not None:
+        hd_index = build_community_index(info_hd, hd_index_path)
+    if hd_index is not None:  # 数据中添加小区信息
+        with profile_stage('merge'):
+            for source in list(infos):
+                infos[source] = list(add_hd_price(infos[source], hd_index))
+        logger.info('== 小区匹配统计 {} =='.format(hd_index.stats))
+    if index_lj is not None and 'LJ' in infos:  # 追加下架的房源
+        infos['LJ'] += list(iter_removed(index_lj))
+    if index_zr is not None and 'ZR' in infos:
+        infos['ZR'] += list(iter_removed(index_zr))
+    if info_hd is not None:
+        infos['HD'] = info_hd
+    # 写入local
+    if tag_local:
+        save_local(infos, local_path, local_format, export_excel, city_code, time_tag)
+        logger.info('== 写入本地 {} 完成 {} =='.format(local_path, time.asctime()))
+    # 写入数据库
+    if tag_db:
+        db_configs, server_config = make_db_configs(db_config, time_tag)
+        for source, info in infos.items():
+            with profile_stage('sink'):
+                save_info_to_mongodb(info, db_configs[source], server_config, DB_KEY_FIELDS[source], time_tag,
+                                     city_code)
+        logger.info('== 写入数据库 {} {} 完成 {} =='.format(
+            db_configs['LJ']['db_name'], [db_configs[i]['tb_name'] for i in infos], time.asctime()))
+    return True
+
+
+def _run_worker_process(queue: TaskQueue, run_tag):
+    """ 本机worker子进程, 返回完成的任务数、指标快照和性能分析结果 """
+    n = run_worker(queue, run_tag)
+    save_price_decoders()
+    return n, get_metrics().snapshot(reset=True), profile_snapshot()
+
+
+def run_local_workers(queue: TaskQueue, run_tag, workers=1):
+    """ 本机启动workers个worker进程消费队列, workers为1时在当前进程执行 """
+    if workers <= 1:
+        return run_worker(queue, run_tag)
+    from concurrent.futures import ProcessPoolExecutor  # 多进程时才导入multiprocessing
+    n = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_process,
+                             initargs=worker_initargs(workers)) as executor:
+        futures = [executor.submit(_run_worker_process, queue, run_tag) for _ in range(workers)]
+        for future in futures:
+            n_worker, snapshot, profile = future.result()
+            n += n_worker
+            get_metrics().merge(snapshot)
+            merge_profile_snapshot(profile)
+    return n
+
+
+def main_distributed(role, cities, run_tag, queue_path, workers, lease_seconds, house_district, model_path,
+                     local_path, db_config, tag_local, tag_db, incremental=False, index_path=None,
+                     local_format='excel', export_excel=False):
+    """
+    多城市分布式抓取, 参数同main
+
+    :param role: coordinator 展开城市为区域任务放入队列
+                 worker 领取任务执行, 可在同一台机器上同时运行多个(queue_path为sqlite文件, 其他主机上有活跃worker时报错)
+                 collect 等待全部任务结束, 按城市合并结果并写入本地和数据库
+                 all 单机依次执行以上三步
+    """
+    queue = TaskQueue(queue_path, lease_seconds=lease_seconds)
+    if role in ('coordinator', 'all'):
+        coordinate(queue, parse_cities(cities), run_tag, house_district)
+    if role in ('worker', 'all'):
+        other_hosts = queue.other_hosts()
+        if other_hosts:
+            raise Exception('任务队列 {} 正在被其他主机 {} 的worker使用, sqlite队列不支持多台机器共享'.format(
+                queue_path, other_hosts))
+        n = run_local_workers(queue, run_tag, workers)
+        logger.info('== 本机worker完成 {} 个任务 {} =='.format(n, time.asctime()))
+    if role in ('collect', 'all'):
+        stats = wait_for_tasks(queue, run_tag)
+        logger.info('== {} 全部任务结束 {} =='.format(run_tag, stats))
+        city_list = parse_cities(cities) if cities else list(dict.fromkeys(i['city'] for i in queue.tasks(run_tag)))
+        for city in city_list:
+            infos = load_city_results(queue, run_tag, city)
+            index_lj = index_zr = None
+            if incremental:
+                index_path_city = index_path if index_path else os.path.join(local_path, 'index')
+                failed_areas = failed_city_areas(queue, run_tag, city)
+                if 'LJ' in infos:
+                    index_lj = make_listing_index(CATCHER_CLASSES['LJ'].init_city(city), index_path_city)
+                    index_lj.keep(failed_areas['LJ'])
+                if 'ZR' in infos:
+                    index_zr = make_listing_index(CATCHER_CLASSES['ZR'].init_city(city), index_path_city)
+                    index_zr.keep(failed_areas['ZR'])
+            local_path_city = local_path if local_format == 'parquet' else os.path.join(local_path, city)
+            logger.info('== 开始写入 {} {} =='.format(city, {k: len(v) for k, v in infos.items()}))
+            save_batch(infos.get('LJ'), infos.get('ZR'), infos.get('HD'), model_path, local_path_city, db_config,
+                       tag_local, tag_db, run_tag, index_lj, index_zr, local_format, export_excel, city,
+                       hd_index_path=community_index_path(local_path, index_path, city))
+            for index in (index_lj, index_zr):
+                if index is not None:
+                    index.save()
+        failed = queue.tasks(run_tag, status=TaskQueue.FAILED)
+        if failed:
+            logger.warning('== 共 {} 个区域任务失败 {} =='.format(
+                len(failed), [(i['city'], i['source'], i['area']) for i in failed]))
+    return True
+
+
+def open_frontiers(catchers: dict, frontier_path, time_tag, resume=False) -> str:
+    """
+    为各catcher打开断点续抓的抓取队列
+
+    :param catchers: {来源: catcher}
+    :return: 实际使用的time_tag, 续抓时沿用被中断那次运行的日期
+    """
+    frontiers, time_tag = CrawlFrontier.open(frontier_path, list(catchers), time_tag, resume)
+    for source, catcher in catchers.items():
+        catcher.frontier = frontiers[source]
+    if resume:
+        logger.info('== 断点续抓 {} 日期 {} 已有记录 {} =='.format(
+            frontier_path, time_tag, {source: i.stats() for source, i in frontiers.items()}))
+    return time_tag
+
+
+def log_run_summary(time0, catchers: dict=None, metrics_path=None, tag=None):
+    """ 打印抓取统计和总耗时, metrics_path输入后写入指标文件, 性能分析模式下写入分析结果, 并写入数字图像查找表 """
+    stop_progress()
+    if save_price_decoders():
+        logger.info('== 新识别的价格数字已写入数字图像查找表 ==')
+    profile_summary = stop_profiler()
+    if profile_summary is not None:
+        logger.info('== 性能分析 各环节耗时和内存峰值 {} =='.format(profile_summary))
+    metrics = get_metrics()
+    logger.info('== 各环节耗时合计(秒, 并发环节为各线程之和) {} =='.format(metrics.summary()))
+    logger.info('== 页面 {} 房源 {} 价格图片 {} 写入 {} =='.format(
+        metrics.total('pages_total'), metrics.total('listings_total'), metrics.total('ocr_sprites_total'),
+        metrics.total('sink_rows_total')))
+    n_glyph = metrics.total('ocr_glyph_lookups_total')
+    if n_glyph:
+        logger.info('== 价格数字 {} 个, 查表未命中由模型识别 {} 个, 低置信度 {} 个 =='.format(
+            n_glyph, metrics.total('ocr_glyph_model_total'), metrics.total('ocr_glyph_low_confidence_total')))
+    n_dedup = metrics.total('dedup_listings_total')
+    if n_dedup:
+        n_duplicated = metrics.total('dedup_duplicates_total')
+        logger.info('== 去重 房源 {} 重复 {} 重复率 {:.2%} =='.format(n_dedup, n_duplicated, n_duplicated / n_dedup))
+    if metrics_path:
+        logger.info('== 指标已写入 {} =='.format(metrics.write(metrics_path, tag)))
+    for source, catcher in (catchers or dict()).items():
+        if catcher is not None and catcher.frontier is not None:
+            logger.info('== {} 抓取队列统计 {} =='.format(source, catcher.frontier.stats()))
+        if catcher is not None and catcher.failed_areas:
+            logger.warning('== {} 有页面或整个区域获取失败的区域 {} =='.format(source, sorted(catcher.failed_areas)))
+    fetcher = get_fetcher()
+    if fetcher.cache is not None:
+        logger.info('== 页面缓存统计 {} =='.format(fetcher.cache.stats()))
+    logger.info('== 各host请求速度统计 {} =='.format(fetcher.scheduler.stats()))
+    if fetcher.failed_urls:
+        logger.warning('== 共 {} 个url重试后仍获取失败 =='.format(len(fetcher.failed_urls)))
+        for url, status in fetcher.failed_urls.items():
+            logger.warning('==== 获取失败 {} 状态 {}'.format(url, status))
+    logger.info('== 全部任务完成，共耗时 {} 秒 =='.format(int(time.time() - time0)))
+
+
 def main(city=None, local_path: str=None, db_config: dict=None, tag_local=True, tag_db=False, 
-         model_path=None, house_district=False, multi_process=False, *args, **kwargs):
+         model_path=None, house_district=False, multi_process=False, concurrency=8, workers=4, cache_mb=256,
+         store_path=None, store_ttl_days=7, replay=False, replay_date=None, retries=3, rate=5.0,
+         stream=False, chunk_size=500, incremental=False, index_path=None, local_format='excel', export_excel=False,
+         checkpoint=False, resume=False, frontier_path=None, cities=None, role=None, queue_path=None, run_tag=None,
+         lease_seconds=300, metrics_path=None, metrics_interval=30, profile=False, profile_path=None, profile_top=30,
+         reuse_hd_index=False, glyph_table_path=None, *args, **kwargs):
     """
     :param local_path:  存入本地的路径 注 会在该路径下生成LJ和ZR两个文件夹, 代表链家和自如。默认在项目result中
     :param db_config:  MongoDB config, 如手动输入, 需要有如下字段
@@ -33,11 +382,60 @@ def main(city=None, local_path: str=None, db_config: dict=None, tag_local=True,
         tb_name_hd  链家小区的库名，如果计算小区的话
     :param tag_local:  是否存入本地
     :param tag_db:  是否存入数据库
-    :param model_path:  预测自如房价的预训练模型路径 图片文字识别模型路径, 如自行添加, 需要该类存在predict方法即可
+    :param model_path:  预测自如房价的预训练模型路径 图片文字识别模型路径, 如自行添加, 需要该类存在predict方法即可;
+                        .npz为utils/ocr/train.py导出的模型, 加载时不需要sklearn
     :param house_district:  是否计算小区数据 计算耗时较久
-    :param multi_process:  是否使用multi_process
+    :param multi_process:  是否使用multi_process 按区域分配到进程池, 链家、自如、小区同时抓取
+    :param concurrency:  同时抓取的页面数量
+    :param workers:  multi_process模式下的进程数
+    :param cache_mb:  运行内页面缓存的上限(MB), 0为不缓存
+    :param store_path:  本地响应存储路径, 输入后所有页面和价格图片会压缩存入该路径
+    :param store_ttl_days:  本地响应存储的过期天数
+    :param replay:  回放模式, 只使用store_path中已存储的响应重新解析, 不访问网络
+    :param replay_date:  回放的日期 如20221201, 默认今天
+    :param retries:  请求被限流(429/5xx)或异常时的最大重试次数
+    :param rate:  每个host的初始请求速度(次/秒), 运行中按限流情况自动调整
+    :param stream:  流水线模式, 边抓取边处理并分块写入本地csv和数据库, 内存占用不随城市大小增长
+    :param chunk_size:  流水线模式下每次写入的条数
+    :param incremental:  增量模式, 与上次运行的房源指纹对比, 只输出新增、变更和下架的房源, 未变房源不做整理和小区匹配等处理
+    :param index_path:  增量模式的指纹索引和小区索引的目录, 默认在local_path/index中
+    :param local_format:  本地存储格式 'excel' 或 'parquet', parquet按 local_path/source=/city=/date= 分区并分row group写入
+    :param export_excel:  parquet格式时是否同时由parquet导出excel
+    :param checkpoint:  记录抓取队列, 区域、分页、小区页面的状态和解析结果每完成一个就写入sqlite
+    :param resume:  从上次中断的抓取队列继续, 已完成的页面直接使用记录的结果, 日期沿用上次运行
+    :param frontier_path:  抓取队列的sqlite文件路径, 默认为local_path/frontier/城市代码.sqlite
+    :param cities:  多城市分布式抓取的城市列表, 如 'sh,bj', 'all'为全部支持的城市
+    :param role:  分布式抓取的角色 coordinator/worker/collect/all, 为空时为单城市抓取, 见main_distributed
+    :param queue_path:  分布式任务队列的sqlite文件路径, 默认为local_path/distributed/queue.sqlite
+    :param run_tag:  分布式抓取的批次, 默认为当天日期, 协调器和worker需一致
+    :param lease_seconds:  分布式任务的租约时长(秒), worker超过该时间没有心跳, 任务会被其他worker重新领取
+    :param metrics_path:  运行指标的输出目录, 结束时写入Prometheus文本文件metrics_日期.prom和json汇总metrics_日期.json
+    :param metrics_interval:  每隔多少秒打印一次请求、页面、房源、写入的速度, 0为不打印
+    :param profile:  性能分析模式, 按抓取、解析、价格识别、整理、写入分别记录cProfile和tracemalloc内存峰值, 运行会明显变慢
+    :param profile_path:  性能分析的输出目录, 默认为local_path/profile/开始时间, 包括各环节的.prof文件(可生成火焰图)和热点函数报告
+    :param profile_top:  热点函数报告中每个环节列出的函数数量
+    :param reuse_hd_index:  已有小区索引(index_path/community_城市代码.json)时直接用于添加小区均价, 不重新抓取小区
+        小区索引在每次抓取小区后保存, 索引文件中的aliases可手动添加 {房源中的小区名: 小区名}
+    :param glyph_table_path:  自如价格数字图像查找表的路径, 默认为index_path/glyphs_模型名.json
+        价格数字先查表, 未见过的数字图像才由模型识别并写入表, 低置信度的识别结果在表中标记为low_confidence
     :return:
     """
+    if profile:
+        if not profile_path:
+            profile_path = os.path.join(local_path or os.path.join(path_code, 'result'), 'profile',
+                                        datetime.datetime.today().strftime('%Y%m%d_%H%M%S'))
+        start_profiler(profile_path, profile_top)
+        logger.info('== 性能分析模式, 结果写入 {} =='.format(profile_path))
+    store = None
+    if store_path:
+        store = ResponseStore(store_path, ttl=store_ttl_days * 24 * 3600, date_tag=replay_date, replay=replay)
+        if not replay:  # 回放时不清理, 要回放的日期可能已超过ttl
+            logger.info('== 响应存储 {} 清理过期条目 {} 个 =='.format(store_path, store.purge()))
+    elif replay:
+        raise Exception('回放模式需要输入store_path')
+    configure_fetcher(max_workers=concurrency, cache_bytes=cache_mb * 1024 * 1024, store=store,
+                      retries=retries, rate=rate)
+    start_progress(metrics_interval, logger.info)
     if tag_db:  # 测试数据库链接
         if not db_config:  # 默认存local
             r = test_db_connect({'host': 'localhost', 'port': 27017})
@@ -46,93 +444,93 @@ def main(city=None, local_path: str=None, db_config: dict=None, tag_local=True,
         if not r:
             raise Exception('mongo数据库链接失败, 请检查配置 {}'.format(db_config))
 
-    time_tag = datetime.datetime.today().strftime('%Y%m%d')
+    time_tag = store.date_tag if store else datetime.datetime.today().strftime('%Y%m%d')
+
+    time0 = time.time()  # 开始时间
+    if not city:
+        catcher_lj, catcher_zr = RoomInfoCatchingLJ(), RoomInfoCatchingZR()
+        catcher_hd = HouseDistrictCatching() if house_district else None
+    else:
+        catcher_lj, catcher_zr = RoomInfoCatchingLJ.init_city(city), RoomInfoCatchingZR.init_city(city)
+        catcher_hd = HouseDistrictCatching.init_city(city) if house_district else None
+    if not model_path:
+        model_path = os.path.join(path_code, 'utils', 'ocr', 'pre_trained_model', 'LR_0906.pickle')
+    if not local_path:
+        local_path = os.path.join(path_code, 'result')
+    if not glyph_table_path:
+        glyph_table_path = os.path.join(index_path if index_path else os.path.join(local_path, 'index'),
+                                        'glyphs_{}.json'.format(os.path.splitext(os.path.basename(model_path))[0]))
+    configure_price_decoder(model_path, glyph_table_path)
+    if role:
+        if not queue_path:
+            queue_path = os.path.join(local_path, 'distributed', 'queue.sqlite')
+        main_distributed(role, cities, run_tag or time_tag, queue_path, workers, lease_seconds, house_district,
+                         model_path, local_path, db_config, tag_local, tag_db, incremental, index_path, local_format,
+                         export_excel)
+        log_run_summary(time0, metrics_path=metrics_path, tag=run_tag or time_tag)
+        return True
+    hd_index_path = community_index_path(local_path, index_path, get_city_code(city))
+    hd_index = CommunityIndex.load(hd_index_path) if reuse_hd_index else None
+    if hd_index is not None:
+        logger.info('== 使用已有的小区索引 {} 共 {} 个小区, 不抓取小区 =='.format(hd_index_path, len(hd_index)))
+        catcher_hd = None
+    elif reuse_hd_index and catcher_hd is None:
+        logger.warning('== 小区索引 {} 不存在, 不添加小区均价 =='.format(hd_index_path))
+    catchers = {'LJ': catcher_lj, 'ZR': catcher_zr, 'HD': catcher_hd}
+    if checkpoint or resume:
+        if not frontier_path:
+            frontier_path = os.path.join(local_path, 'frontier', '{}.sqlite'.format(get_city_code(city)))
+        time_tag = open_frontiers({k: v for k, v in catchers.items() if v is not None}, frontier_path, time_tag,
+                                  resume)
+    index_lj = index_zr = None
+    if incremental:
+        if not index_path:
+            index_path = os.path.join(local_path, 'index')
+        index_lj, index_zr = make_listing_index(catcher_lj, index_path), make_listing_index(catcher_zr, index_path)
+
+    if stream:
+        main_stream(catcher_lj, catcher_zr, catcher_hd, model_path, local_path, db_config, tag_local, tag_db,
+                    time_tag, chunk_size, index_lj, index_zr, local_format, export_excel, get_city_code(city),
+                    hd_index, hd_index_path)
+        if incremental:
+            index_lj.save()
+            index_zr.save()
+            logger.info('== 增量统计 链家 {} 自如 {} =='.format(index_lj.stats, index_zr.stats))
+        log_run_summary(time0, catchers, metrics_path, time_tag)
+        return True
 
     if not multi_process:
-        time0 = time.time()  # 开始时间
-        if not city:
-            logger.info('== 开始获取链家的房源信息 {} =='.format(time.asctime()))
-            info_lj = RoomInfoCatchingLJ().get_room_info_total()
-            logger.info('== 链家房源信息获取完毕，开始获取自如房源信息 {} =='.format(time.asctime()))
-            info_zr = RoomInfoCatchingZR().get_room_info_total()
-        else:
-            logger.info('== 开始获取链家的房源信息 {} =='.format(time.asctime()))
-            info_lj = RoomInfoCatchingLJ.init_city(city).get_room_info_total()
-            logger.info('== 链家房源信息获取完毕，开始获取自如房源信息 {} =='.format(time.asctime()))
-            info_zr = RoomInfoCatchingZR.init_city(city).get_room_info_total()
-        
+        logger.info('== 开始获取链家的房源信息 {} =='.format(time.asctime()))
+        info_lj = catcher_lj.get_room_info_total()
+        logger.info('== 链家房源信息获取完毕，开始获取自如房源信息 {} =='.format(time.asctime()))
+        info_zr = catcher_zr.get_room_info_total()
         logger.info('== 自如房源信息获取完毕 {} =='.format(time.asctime()))
-        if not model_path:
-            model_path = os.path.join(path_root, r'code\utils\orc\pre_trained_model\LR_0906.pickle')
-        # 添加价格
-        t = RoomInfoCatchingZR()
-        for i in info_zr:
-            i['price'] = t.get_price(i['price_info'], model_path)
-        logger.info('== 自如房源价格计算完毕 {} =='.format(time.asctime()))
-        # 添加均价
-        for i in info_zr:
-            try:
-                avg_price = round(float(i['price']) / float(i['area']), 2)
-            except:
-                avg_price = ''
-            i['avg_price'] = avg_price
-        # 整理数据
-        info_zr = RoomInfoCatching.update_info(info_zr, 'ZR')
-        info_lj = RoomInfoCatching.update_info(info_lj, 'LJ')
-        if house_district:  # 计算小区信息
-            hd = HouseDistrictCatching()
-            info_hd = hd.get_total_hd_info()
-            # 数据中添加小区信息
-            tmp_df_zr = pd.DataFrame(info_zr)
-            tmp_df_lj = pd.DataFrame(info_lj)
-            tmp_df_hd = pd.DataFrame(info_hd)
-            info_zr = tmp_df_zr.merge(tmp_df_hd[['小区', '小区均价']], on='小区', how='left').to_dict('records')
-            info_lj = tmp_df_lj.merge(tmp_df_hd[['小区', '小区均价']], on='小区', how='left').to_dict('records')
-        # 写入local
-        if tag_local:
-            if not local_path:
-                local_path = os.path.join(path_root, 'result')
-            path_lj = os.path.join(local_path, 'LJ')
-            path_zr = os.path.join(local_path, 'ZR')
-            if not os.path.isdir(path_lj):
-                os.makedirs(path_lj)
-            if not os.path.isdir(path_zr):
-                os.makedirs(path_zr)
-            save_info_to_local(info_lj, path_lj, 'LJ_room_info_{}.xlsx'.format(time_tag))
-            save_info_to_local(info_zr, path_zr, 'ZR_room_info_{}.xlsx'.format(time_tag))
-            if house_district:  # 计算小区信息
-                save_info_to_local(info_hd, local_path, 'house_district_info_{}.xlsx'.format(time_tag))
-            logger.info('== 写入本地 {} 完成 {} =='.format(local_path, time.asctime()))
-        # 写入数据库
-        if tag_db:
-            if not db_config:  # 默认存local
-                db_config_lj = {'db_name': 'crawler',
-                                'tb_name': 'room_info_lj_{}'.format(time_tag)}
-                db_config_zr = {'db_name': 'crawler',
-                                'tb_name': 'room_info_zr_{}'.format(time_tag)}
-                save_info_to_mongodb(info_lj, db_config_lj)
-                save_info_to_mongodb(info_zr, db_config_zr)
-                if house_district:
-                    db_config_hd = {'db_name': 'crawler',
-                                    'tb_name': 'house_district_info_{}'.format(time_tag)}
-                    save_info_to_mongodb(info_hd, db_config_hd)
-            else:
-                db_config_lj = {'db_name': db_config['db_name'], 'tb_name': db_config['tb_name_lj']}
-                db_config_zr = {'db_name': db_config['db_name'], 'tb_name': db_config['tb_name_zr']}
-                server_config = {'host': db_config['host'], 'port': db_config['port']}
-                save_info_to_mongodb(info_lj, db_config_lj, server_config)
-                save_info_to_mongodb(info_zr, db_config_zr, server_config)
-                if house_district:
-                    db_config_hd = {'db_name': db_config['db_name'], 'tb_name': db_config['tb_name_hd']}
-                    save_info_to_mongodb(info_hd, db_config_hd, server_config)
-            logger.info('== 写入数据库 {} {}和{} 完成 {} =='.format(db_config_lj['db_name'],
-                                                            db_config_lj['tb_name'],
-                                                            db_config_zr['tb_name'],
-                                                            time.asctime()))
-
+        if catcher_hd is not None:  # 计算小区信息
+            info_hd = catcher_hd.get_total_hd_info()
     else:
-        raise Exception('暂未开放')
-    logger.info('== 全部任务完成，共耗时 {} 秒 =='.format(int(time.time() - time0)))
+        catchers = {'LJ': catcher_lj, 'ZR': catcher_zr}
+        if catcher_hd is not None:
+            catchers['HD'] = catcher_hd
+        logger.info('== 开始多进程获取{}信息, 进程数 {} {} =='.format(list(catchers), workers, time.asctime()))
+        info_total, failed_tasks = crawl_areas_multiprocess(catchers, workers)
+        if failed_tasks:
+            logger.warning('== 共 {} 个区域重试后仍获取失败, 其房源缺失 {} =='.format(len(failed_tasks), failed_tasks))
+        info_lj, info_zr = info_total['LJ'], info_total['ZR']
+        if catcher_hd is not None:
+            info_hd = info_total['HD']
+        logger.info('== 多进程获取信息完毕 {} =='.format(time.asctime()))
+
+    if incremental:  # 有页面获取失败的区域, 其中的房源不算下架
+        index_lj.keep(catcher_lj.failed_areas)
+        index_zr.keep(catcher_zr.failed_areas)
+    save_batch(info_lj, info_zr, info_hd if catcher_hd is not None else None, model_path, local_path, db_config,
+               tag_local, tag_db, time_tag, index_lj, index_zr, local_format, export_excel, get_city_code(city),
+               hd_index, hd_index_path)
+
+    if incremental:
+        index_lj.save()
+        index_zr.save()
+    log_run_summary(time0, catchers, metrics_path, time_tag)
     return True
 
 
@@ -144,7 +542,7 @@ def make_argsparse():
     parse.add_argument('--city', type=str)  # 需要访问的城市名, 如未输入，默认上海
     parse.add_argument('--local_path', type=str)  # 本地存储路径
     parse.add_argument('--db_host', type=str) # 存入的数据库host地址
-    parse.add_argument('--db_port', type=str) # 存入的数据库port地址
+    parse.add_argument('--db_port', type=int, default=27017) # 存入的数据库port地址
     parse.add_argument('--db_name', type=str) # 存入的数据库db名
     parse.add_argument('--db_tb_name_lj', type=str) # 存入的数据库链家tb名
     parse.add_argument('--db_tb_name_zr', type=str) # 存入的数据库自如tb名
@@ -153,13 +551,43 @@ def make_argsparse():
     parse.add_argument('--house_district', default=False, action='store_true') # 是否计算小区数据   
     parse.add_argument('--multi_process', default=False, action='store_true') # 是否使用multiprocess
     parse.add_argument('--model_path', type=str) # 用于自如价格图像分割识别数字的模型路径，建议不要修改，使用本项目自带的部分       
+    parse.add_argument('--concurrency', type=int, default=8) # 同时抓取的页面数量
+    parse.add_argument('--workers', type=int, default=4) # multiprocess模式下的进程数
+    parse.add_argument('--cache_mb', type=int, default=256) # 运行内页面缓存的上限(MB), 0为不缓存
+    parse.add_argument('--store_path', type=str) # 本地响应存储路径
+    parse.add_argument('--store_ttl_days', type=int, default=7) # 本地响应存储的过期天数
+    parse.add_argument('--replay', default=False, action='store_true') # 回放模式, 只使用本地存储的响应
+    parse.add_argument('--replay_date', type=str) # 回放的日期 如20221201
+    parse.add_argument('--retries', type=int, default=3) # 被限流或异常时的最大重试次数
+    parse.add_argument('--rate', type=float, default=5.0) # 每个host的初始请求速度(次/秒)
+    parse.add_argument('--stream', default=False, action='store_true') # 流水线模式, 边抓取边分块写入
+    parse.add_argument('--chunk_size', type=int, default=500) # 流水线模式下每次写入的条数
+    parse.add_argument('--incremental', default=False, action='store_true') # 增量模式, 只输出新增、变更和下架的房源
+    parse.add_argument('--index_path', type=str) # 增量模式的指纹索引和小区索引的目录
+    parse.add_argument('--local_format', type=str, default='excel', choices=['excel', 'parquet']) # 本地存储格式
+    parse.add_argument('--export_excel', default=False, action='store_true') # parquet格式时是否同时导出excel
+    parse.add_argument('--checkpoint', default=False, action='store_true') # 记录抓取队列, 中断后可续抓
+    parse.add_argument('--resume', default=False, action='store_true') # 从上次中断的抓取队列继续
+    parse.add_argument('--frontier_path', type=str) # 抓取队列的sqlite文件路径
+    parse.add_argument('--cities', type=str) # 多城市分布式抓取的城市列表, 如 sh,bj 或 all
+    parse.add_argument('--role', type=str, choices=['coordinator', 'worker', 'collect', 'all']) # 分布式抓取的角色
+    parse.add_argument('--queue_path', type=str) # 分布式任务队列的sqlite文件路径
+    parse.add_argument('--run_tag', type=str) # 分布式抓取的批次, 默认当天日期
+    parse.add_argument('--lease_seconds', type=int, default=300) # 分布式任务的租约时长(秒)
+    parse.add_argument('--metrics_path', type=str) # 运行指标的输出目录
+    parse.add_argument('--metrics_interval', type=int, default=30) # 每隔多少秒打印一次速度, 0为不打印
+    parse.add_argument('--profile', default=False, action='store_true') # 性能分析模式
+    parse.add_argument('--profile_path', type=str) # 性能分析的输出目录
+    parse.add_argument('--profile_top', type=int, default=30) # 热点函数报告中每个环节列出的函数数量
+    parse.add_argument('--reuse_hd_index', default=False, action='store_true') # 使用已保存的小区索引, 不重新抓取小区
+    parse.add_argument('--glyph_table_path', type=str) # 自如价格数字图像查找表的路径
     
     args = copy.deepcopy(parse.parse_args().__dict__)
     
-    if args.get('tag_db') == True:
+    if args.get('tag_db') == True and args.get('db_host'):  # 未输入db_host时使用默认的本地库
         args['db_config'] = {
-            'db_host': args.get('db_host'), 'db_port': args.get('db_port'), 'db_name': args.get('db_name'), 
-            'db_tb_name_lj': args.get('db_tb_name_lj'), 'db_tb_name_zr': args.get('db_tb_name_zr'), 'tb_name_hd': args.get('tb_name_hd'),
+            'host': args.get('db_host'), 'port': args.get('db_port'), 'db_name': args.get('db_name'), 
+            'tb_name_lj': args.get('db_tb_name_lj'), 'tb_name_zr': args.get('db_tb_name_zr'), 'tb_name_hd': args.get('tb_name_hd'),
             }
     
     return args
@@ -1,6 +1,8 @@
 import time
 from dataclasses import dataclass
 
+from utils.metrics_service import get_metrics
+
 
 @dataclass
 class G_LJ:
@@ -20,6 +22,18 @@ class G_ZR:
     citycode2url_mapper = dict(zip(citycode_list, url_list))
 
 
+def get_city_code(city=None, default='sh') -> str:
+    """ 城市名或城市代码转为城市代码, 用于数据分区 """
+    if not city:
+        return default
+    for g in (G_LJ, G_ZR):
+        if city in g.citycode_list:
+            return city
+        if city in g.city_list:
+            return g.citycode_list[g.city_list.index(city)]
+    return city
+
+
 def print_time(f):
     """Decorator of viewing function runtime.
     eg:
@@ -37,5 +51,6 @@ def print_time(f):
         s = time.time()
         res = f(*args, **kwargs)
         print('--> RUN TIME: <%s> : %s' % (f.__name__, round(float(time.time() - s), 2)))
+        get_metrics().observe('stage_seconds', time.time() - s, stage=f.__name__)
         return res
     return fi
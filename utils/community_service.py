@@ -0,0 +1,157 @@
+# 本方法为小区索引: 由小区信息建立 小区名/规范化名/别名 -> 小区 的索引, 房源逐条查询小区均价
+# 链家和自如房源中的小区名写法与小区页面不完全一致(全角半角、空格、括号中的分期等), 规范化后再匹配
+# 索引保存为json, 之后的运行可以直接使用, 不需要重新抓取小区
+
+import json
+import os
+import re
+import time
+import unicodedata
+from typing import Iterable, List, Optional
+
+
+RE_NAME_IGNORED = re.compile(r'[\s·•・\-_\'"]')
+RE_BRACKET = re.compile(r'[(\[【<].*?[)\]】>]')
+RE_NAME_SUFFIX = re.compile(r'(小区|[一二三四五六七八九十\d]+期|[东西南北中a-z]区|\d+号院)$')
+
+
+def normalize_name(name: str) -> str:
+    """ 小区名规范化: 全角转半角、小写、去掉空格和分隔符 """
+    return RE_NAME_IGNORED.sub('', unicodedata.normalize('NFKC', name or '').lower())
+
+
+def base_name(name: str) -> str:
+    """ 小区的主名称: 规范化后去掉括号内容和结尾的分期、分区, 如 汤臣一品(东区) 和 汤臣一品 相同 """
+    res = normalize_name(name)
+    base = RE_BRACKET.sub('', res)
+    while True:
+        stripped = RE_NAME_SUFFIX.sub('', base)
+        if stripped == base or not stripped:
+            break
+        base = stripped
+    return base or res
+
+
+class CommunityIndex:
+    """
+    小区索引, 依次按 小区名、别名、规范化名、主名称 匹配
+    同名的候选小区有多个时, 用房源的区域区分, 仍无法确定时视为未匹配, 避免填入其他小区的均价
+
+    - communities: [{'小区': 小区名, '区域': 区域, '小区均价': 均价, 'url': 小区页面}]
+    - aliases: {别名: 小区名}, 可在索引文件中手动添加, 重建索引时保留
+    """
+    EXACT = '精确'
+    ALIAS = '别名'
+    NORMALIZED = '规范化'
+    BASE = '主名称'
+    MISSED = '未匹配'
+
+    def __init__(self, communities: Iterable[dict]=None, aliases: dict=None):
+        self.communities = list()
+        self.aliases = dict(aliases or dict())
+        self.stats = {self.EXACT: 0, self.ALIAS: 0, self.NORMALIZED: 0, self.BASE: 0, self.MISSED: 0}
+        self._by_name = dict()  # 小区名: [序号]
+        self._by_normalized = dict()
+        self._by_base = dict()
+        self._by_alias = {normalize_name(k): v for k, v in self.aliases.items()}
+        self._cache = dict()  # (房源中的小区名, 区域): (序号, 匹配方式), 同一小区的房源只匹配一次
+        for i in communities or list():
+            self.add(i)
+
+    @classmethod
+    def from_hd_info(cls, info_hd: List[dict], aliases: dict=None):
+        """ 由get_total_hd_info的结果建立索引 """
+        return cls(info_hd, aliases)
+
+    @classmethod
+    def load(cls, path: str):
+        """ 读取索引文件, 不存在时返回None """
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data.get('communities'), data.get('aliases'))
+
+    @staticmethod
+    def load_aliases(path: str) -> dict:
+        """ 索引文件中手动维护的别名, 不存在时为空 """
+        if not path or not os.path.isfile(path):
+            return dict()
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('aliases', dict())
+
+    def add(self, info: dict):
+        """ 加入一个小区, info需要有 小区, 可选 区域、小区均价、url """
+        name = info.get('小区')
+        if not name:
+            return
+        n = len(self.communities)
+        self.communities.append({'小区': name, '区域': info.get('区域'), '小区均价': info.get('小区均价'),
+                                 'url': info.get('url')})
+        self._by_name.setdefault(name, list()).append(n)
+        self._by_normalized.setdefault(normalize_name(name), list()).append(n)
+        self._by_base.setdefault(base_name(name), list()).append(n)
+        self._cache.clear()
+
+    def _pick(self, candidates: List[int], area) -> Optional[int]:
+        if len(candidates) == 1:
+            return candidates[0]
+        if area:
+            candidates = [i for i in candidates if self.communities[i]['区域'] == area]
+            if len(candidates) == 1:
+                return candidates[0]
+        return None
+
+    def _match(self, name, area) -> (Optional[int], str):
+        if name in self._by_name:
+            return self._pick(self._by_name[name], area), self.EXACT
+        normalized = normalize_name(name)
+        alias = self._by_alias.get(normalized)
+        if alias in self._by_name:
+            return self._pick(self._by_name[alias], area), self.ALIAS
+        if normalized in self._by_normalized:
+            return self._pick(self._by_normalized[normalized], area), self.NORMALIZED
+        base = base_name(name)
+        if base in self._by_base:
+            return self._pick(self._by_base[base], area), self.BASE
+        return None, self.MISSED
+
+    def match(self, name, area=None) -> Optional[dict]:
+        """
+        查询房源所在的小区
+
+        :param name: 房源中的小区名
+        :param area: 房源的区域, 用于区分同名小区
+        :return: 小区信息dict, 未匹配时为None
+        """
+        if not name:
+            self.stats[self.MISSED] += 1
+            return None
+        key = (name, area)
+        res = self._cache.get(key)
+        if res is None:
+            res = self._match(name, area)
+            if res[0] is None:
+                res = (None, self.MISSED)
+            self._cache[key] = res
+        self.stats[res[1]] += 1
+        return self.communities[res[0]] if res[0] is not None else None
+
+    def price(self, name, area=None):
+        """ 房源所在小区的均价, 未匹配时为None """
+        community = self.match(name, area)
+        return community['小区均价'] if community is not None else None
+
+    def save(self, path: str):
+        """ 写入索引文件, 原子替换 """
+        dir_path = os.path.dirname(path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'updated_at': time.strftime('%Y%m%d'), 'aliases': self.aliases,
+                       'communities': self.communities}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.communities)
@@ -0,0 +1,84 @@
+# 本方法为房源去重: 翻页时房源顺序变化, 同一房源可能出现在多个分页或多个区域中, 在价格识别和整理之前按room_url去掉重复
+# 使用64位指纹的精确集合, 超过上限后只使用布隆过滤器, 内存占用有上限
+
+import hashlib
+import math
+from typing import Iterable, Iterator
+
+
+def url_fingerprint(url: str) -> int:
+    """ url的64位指纹, 百万级房源的碰撞概率可忽略 """
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class BloomFilter:
+    """ 布隆过滤器, 输入为64位指纹, 用double hashing生成k个位置 """
+    def __init__(self, capacity=1000000, error_rate=0.01):
+        """
+        :param capacity: 预计元素数量
+        :param error_rate: 达到预计数量时的误判率
+        """
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, fp: int) -> bool:
+        """ 加入指纹, 返回加入前是否可能已存在 """
+        h1, h2 = fp & 0xffffffff, (fp >> 32) | 1
+        exists = True
+        for i in range(self.hash_count):
+            pos = (h1 + i * h2) % self.size
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                exists = False
+                self.bits[pos >> 3] |= mask
+        return exists
+
+
+class ListingDeduper:
+    """
+    按room_url去重
+
+    - 布隆过滤器判断为不存在的一定是新房源, 判断为可能存在时再查精确集合, 精确集合为准, 不会误删
+    - 精确集合超过exact_limit后不再增加, 之后只按布隆过滤器判断, 误判率由capacity和error_rate决定
+    """
+    def __init__(self, capacity=1000000, error_rate=0.01, exact_limit=None):
+        """
+        :param capacity: 布隆过滤器的预计房源数量
+        :param error_rate: 布隆过滤器的误判率
+        :param exact_limit: 精确集合的上限, 默认同capacity
+        """
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.exact = set()
+        self.exact_limit = capacity if exact_limit is None else exact_limit
+        self.stats = {'总数': 0, '重复': 0}
+
+    def seen(self, url: str) -> bool:
+        """ 记录url并返回是否为重复 """
+        fp = url_fingerprint(url)
+        self.stats['总数'] += 1
+        duplicated = False
+        if self.bloom.add(fp):
+            if fp in self.exact:
+                duplicated = True
+            elif len(self.exact) >= self.exact_limit:  # 精确集合已满, 以布隆过滤器为准
+                duplicated = True
+        if duplicated:
+            self.stats['重复'] += 1
+        elif len(self.exact) < self.exact_limit:
+            self.exact.add(fp)
+            if len(self.exact) == self.exact_limit:
+                print('==== 去重的精确集合已达上限 {}, 之后按布隆过滤器判断, 可能误删少量房源 ===='.format(
+                    self.exact_limit))
+        return duplicated
+
+    def filter(self, room_info_iter: Iterable[dict], key='room_url') -> Iterator[dict]:
+        """ 只放行第一次出现的房源 """
+        for i in room_info_iter:
+            if not self.seen(i[key]):
+                yield i
+
+    @property
+    def rate(self) -> float:
+        """ 重复率 """
+        return self.stats['重复'] / self.stats['总数'] if self.stats['总数'] else 0.0
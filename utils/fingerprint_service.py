@@ -0,0 +1,99 @@
+# 本方法为增量抓取用的房源指纹索引
+
+import hashlib
+import json
+import os
+import re
+from typing import Iterable, Iterator, List
+
+RE_SPRITE_URL = re.compile(r'url\([^)]*\)')
+
+
+class ListingIndex:
+    """
+    房源指纹索引 {room_url: [指纹, 区域]}, 指纹由价格和维护信息生成
+    与上次运行的索引对比, 只放行新增和变更的房源, 并给出下架的房源
+    有页面获取失败的区域用keep标记, 上次在这些区域的房源不算下架, 并保留上次的指纹
+    """
+    NEW = '新增'
+    CHANGED = '变更'
+    REMOVED = '下架'
+
+    def __init__(self, path: str):
+        """ :param path: 索引文件路径(json), 不存在时视为首次运行, 全部房源都是新增 """
+        self.path = path
+        self.last = dict()
+        self.last_area = dict()
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for url, value in json.load(f).items():
+                    if isinstance(value, list):
+                        self.last[url], self.last_area[url] = value
+                    else:  # 旧的索引文件只有指纹
+                        self.last[url] = value
+        self.current = dict()
+        self.current_area = dict()
+        self.kept_areas = set()
+        self.stats = {self.NEW: 0, self.CHANGED: 0, '未变': 0}
+
+    @staticmethod
+    def fingerprint(room_info: dict) -> str:
+        """
+        使用识别后的价格, 自如需要先做价格识别; 识别失败时使用price_info,
+        其中的价格图片url每天轮换, 需要去掉, 否则全部自如房源都会变为变更
+        """
+        price = room_info.get('price')
+        if price in (None, '') and room_info.get('price_info'):
+            price = RE_SPRITE_URL.sub('', room_info['price_info'])
+        s = '{}|{}|{}'.format(room_info['room_url'], price, room_info.get('updated_info', ''))
+        return hashlib.md5(s.encode('utf-8')).hexdigest()
+
+    def diff(self, room_info_iter: Iterable[dict], key='change') -> Iterator[dict]:
+        """
+        过滤出新增和变更的房源, 未变的房源直接跳过
+
+        :param room_info_iter: 原始房源信息
+        :param key: 写入变更类型的字段名
+        :return: 生成器
+        """
+        for i in room_info_iter:
+            url = i['room_url']
+            fp = self.fingerprint(i)
+            self.current[url] = fp
+            self.current_area[url] = i.get('区域')
+            last_fp = self.last.get(url)
+            if last_fp == fp:
+                self.stats['未变'] += 1
+                continue
+            i[key] = self.NEW if last_fp is None else self.CHANGED
+            self.stats[i[key]] += 1
+            yield i
+
+    def keep(self, areas: Iterable[str]):
+        """ 标记有页面获取失败的区域, 需要在removed和save之前调用 """
+        self.kept_areas.update(areas)
+
+    def _is_kept(self, url) -> bool:
+        """ 上次在失败区域中的房源; 旧的索引文件没有区域, 有失败区域时全部保留 """
+        if not self.kept_areas:
+            return False
+        area = self.last_area.get(url)
+        return area is None or area in self.kept_areas
+
+    def removed(self) -> List[str]:
+        """ 上次存在本次未出现的房源url, 需要在diff全部消费后调用, 失败区域中的房源不算下架 """
+        return [i for i in self.last if i not in self.current and not self._is_kept(i)]
+
+    def save(self):
+        """ 用本次的指纹覆盖索引文件, 失败区域中本次未出现的房源保留上次的指纹 """
+        data = {url: [fp, self.current_area.get(url)] for url, fp in self.current.items()}
+        for url, fp in self.last.items():
+            if url not in self.current and self._is_kept(url):
+                data[url] = [fp, self.last_area.get(url)]
+        dir_path = os.path.dirname(self.path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,160 @@
+# 本方法为断点续抓用的抓取队列, 基于sqlite持久化
+# 记录区域、分页、小区页面的状态, 每完成一个页面就把解析结果写入, 中断后可从最后完成的页面继续
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class CrawlFrontier:
+    """
+    持久化的抓取队列, 一个sqlite文件对应一次运行(一个城市), 各来源按source区分
+
+    - urls: (source, kind, url) -> area, status(pending/done/failed), error
+      kind为 area(区域页)/page(房源分页)/hd_page(小区列表分页)/community(小区页), 链家区域页与第一个分页url相同, 按kind区分
+    - results: (source, kind, url) -> 该url的解析结果(json), 区域url记录其分页url list
+    - meta: 运行信息, 如time_tag
+
+    连接在每个进程内按需建立, 可以随catcher一起传入子进程
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path: str, source: str):
+        """
+        :param path: sqlite文件路径
+        :param source: 'LJ', 'ZR', 'HD'
+        """
+        self.path = path
+        self.source = source
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path: str, sources: Iterable[str], time_tag: str,
+             resume=False) -> Tuple[Dict[str, 'CrawlFrontier'], str]:
+        """
+        打开抓取队列
+
+        :param path: sqlite文件路径
+        :param sources: 需要的来源
+        :param time_tag: 本次运行的日期标签, 续抓时沿用上次记录的标签
+        :param resume: 是否续抓, 否则清空已有的记录
+        :return: {来源: CrawlFrontier}, 实际使用的time_tag
+        """
+        dir_path = os.path.dirname(path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        if not resume:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.isfile(path + suffix):
+                    os.remove(path + suffix)
+        frontiers = {source: cls(path, source) for source in sources}
+        conn = next(iter(frontiers.values()))._connect()
+        row = conn.execute("SELECT value FROM meta WHERE key = 'time_tag'").fetchone()
+        if row is None:
+            with conn:
+                conn.execute("INSERT INTO meta VALUES ('time_tag', ?)", (time_tag,))
+        else:
+            time_tag = row[0]
+        return frontiers, time_tag
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')  # 多进程同时写入
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS urls (source TEXT, kind TEXT, url TEXT, area TEXT, '
+                             'status TEXT, error TEXT, updated_at REAL, PRIMARY KEY (source, kind, url))')
+                conn.execute('CREATE TABLE IF NOT EXISTS results (source TEXT, kind TEXT, url TEXT, data TEXT, '
+                             'PRIMARY KEY (source, kind, url))')
+                conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def add(self, urls: Iterable[str], kind: str, area=None):
+        """ 加入待抓取的url, 已存在的url保持原状态 """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO urls VALUES (?, ?, ?, ?, ?, NULL, ?)',
+                                 [(self.source, kind, url, area, self.PENDING, time.time()) for url in urls])
+
+    def done(self, url: str, data, kind: str, area=None):
+        """ 记录url已完成及其解析结果, 状态和结果在同一事务中写入 """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?, NULL, ?)',
+                             (self.source, kind, url, area, self.DONE, time.time()))
+                conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                             (self.source, kind, url, json.dumps(data, ensure_ascii=False)))
+
+    def failed(self, url: str, error: str, kind: str, area=None):
+        """ 记录url失败, 续抓时会重新抓取 """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (self.source, kind, url, area, self.FAILED, error, time.time()))
+
+    def get(self, url: str, kind: str) -> Optional[object]:
+        """ 已完成url的解析结果, 未完成返回None """
+        return self.get_many([url], kind).get(url)
+
+    def get_many(self, urls: Iterable[str], kind: str) -> dict:
+        """ 批量读取已完成url的解析结果 {url: 结果}, 未完成的url不在结果中 """
+        urls = list(urls)
+        res = dict()
+        with self._lock:
+            conn = self._connect()
+            for start in range(0, len(urls), 500):  # sqlite参数个数有上限
+                batch = urls[start:start + 500]
+                rows = conn.execute('SELECT r.url, r.data FROM results r JOIN urls u '
+                                    'ON r.source = u.source AND r.kind = u.kind AND r.url = u.url '
+                                    'WHERE r.source = ? AND r.kind = ? AND u.status = ? AND r.url IN ({})'
+                                    .format(','.join('?' * len(batch))), [self.source, kind, self.DONE] + batch)
+                for url, data in rows:
+                    res[url] = json.loads(data)
+        return res
+
+    def stats(self) -> dict:
+        """ 各类url的状态统计 {kind: {status: 数量}} """
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute('SELECT kind, status, COUNT(*) FROM urls WHERE source = ? GROUP BY kind, status',
+                                (self.source,)).fetchall()
+        res = dict()
+        for kind, status, n in rows:
+            res.setdefault(kind, dict())[status] = n
+        return res
+
+    def failed_urls(self) -> List[dict]:
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute('SELECT url, kind, area, error FROM urls WHERE source = ? AND status = ?',
+                                (self.source, self.FAILED)).fetchall()
+        return [{'url': url, 'kind': kind, 'area': area, 'error': error} for url, kind, area, error in rows]
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
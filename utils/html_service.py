@@ -1,25 +1,289 @@
 # 本方法为html相关内容
 
-import requests
-import pandas as pd
-from requests.exceptions import RequestException
-from pyquery import PyQuery as pq
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, Iterator, Tuple
+from urllib.parse import urlsplit
+
+from utils.throttle_service import HostScheduler, RETRY_STATUS, retry_delay
+from utils.metrics_service import get_metrics
+from utils.profile_service import profile_stage
+
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                  "Chrome/85.0.4183.121 Safari/537.36"
+}
+
+
+class PageCache:
+    """
+    进程内按url缓存页面的LRU, 以内容字节数为上限, 保证同一次运行中每个url最多下载一次
+    文本页面按utf-8编码后的字节数计算, 中文页面一个字符为多个字节, 不能按字符数计算
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        """
+        :param max_bytes: 缓存内容的总大小上限, 超出后淘汰最久未使用的页面
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key: (value, 字节数)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    @staticmethod
+    def byte_size(value) -> int:
+        """ 内容的字节数, str按utf-8编码计算 """
+        return len(value.encode('utf-8')) if isinstance(value, str) else len(value)
+
+    def put(self, key, value):
+        size = self.byte_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, dropped_size) = self._data.popitem(last=False)
+                self.size -= dropped_size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        """ 命中统计 """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._data), 'bytes': self.size}
+
+
+class HtmlFetcher:
+    """ 带连接池的并发抓取引擎。每个host一个Session(keep-alive复用), 用线程池控制并发数 """
+    def __init__(self, max_workers=8, pool_size=10, timeout=10, headers=None, cache_bytes=256 * 1024 * 1024,
+                 store=None, retries=3, rate=5.0):
+        """
+        :param max_workers: 批量抓取时的最大并发数
+        :param pool_size: 每个host的连接池大小
+        :param timeout: 单次请求超时时间(秒)
+        :param headers: 请求头, 默认使用DEFAULT_HEADERS
+        :param cache_bytes: 页面缓存上限(字节), 0表示不缓存
+        :param store: utils.store_service.ResponseStore 本地响应存储, 回放模式下只从存储读取
+        :param retries: 429/5xx/网络异常时的最大重试次数
+        :param rate: 每个host的初始请求速度(次/秒), 之后按返回状态和延迟自动调整
+        """
+        self.cache = PageCache(cache_bytes) if cache_bytes else None
+        self.store = store
+        self.retries = retries
+        self.scheduler = HostScheduler(rate=rate, max_concurrency=max_workers)
+        self.failed_urls = dict()  # 重试后仍失败的url: 最后一次的状态码, 网络异常为None
+        self.max_workers = max_workers
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.headers = headers if headers else DEFAULT_HEADERS
+        self._sessions = dict()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_session(self, url) -> 'requests.Session':
+        """ 获取该url对应host的Session, 没有则新建。requests在第一次请求时才导入, 回放模式等不访问网络时不需要加载 """
+        host = urlsplit(url).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update(self.headers)
+                self._sessions[host] = session
+        return session
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _request(self, url):
+        """ 按host限速发送请求, 429/5xx/异常时退避重试。最终失败记入failed_urls并返回None """
+        from requests.exceptions import RequestException
+        session = self._get_session(url)
+        throttle = self.scheduler.get(url)
+        host = urlsplit(url).netloc
+        status = None
+        for attempt in range(self.retries + 1):
+            throttle.acquire()
+            time0 = time.monotonic()
+            response = None
+            try:
+                response = session.get(url, timeout=self.timeout)
+                status = response.status_code
+            except RequestException:
+                status = None
+            finally:
+                latency = time.monotonic() - time0
+                throttle.release(status, latency)
+            metrics = get_metrics()
+            metrics.inc('fetch_requests_total', host=host, status=status if status is not None else 'none')
+            metrics.observe('fetch_seconds', latency, host=host)
+            if response is not None:
+                metrics.inc('fetch_bytes_total', len(response.content), host=host)
+            if status == 200:
+                self.failed_urls.pop(url, None)
+                return response
+            if status not in RETRY_STATUS or attempt == self.retries:  # 404等不重试
+                break
+            delay = retry_delay(attempt)
+            retry_after = response.headers.get('Retry-After') if response is not None else None
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            time.sleep(delay)
+        self.failed_urls[url] = status
+        return None
+
+    def _get_cached(self, url, attr):
+        """ 依次查询内存缓存、本地存储, 都未命中再请求并写入。attr为response的text或content """
+        key = (url, attr)
+        if self.cache is not None:
+            value = self.cache.get(key)
+            if value is not None:
+                get_metrics().inc('fetch_cache_hits_total', layer='memory')
+                return value
+        if self.store is not None:
+            data = self.store.get(url, attr)
+            if data is not None:
+                get_metrics().inc('fetch_cache_hits_total', layer='store')
+                value = data.decode('utf-8') if attr == 'text' else data
+                if self.cache is not None:
+                    self.cache.put(key, value)
+                return value
+            if self.store.replay:  # 回放模式不访问网络
+                return None
+        with profile_stage('fetch'):
+            response = self._request(url)
+        if response is None:
+            return None
+        value = getattr(response, attr)
+        if self.cache is not None:
+            self.cache.put(key, value)
+        if self.store is not None:
+            self.store.put(url, value.encode('utf-8') if attr == 'text' else value, attr)
+        return value
+
+    def get_content(self, url):
+        """ 获取url的原始bytes, 失败返回None """
+        return self._get_cached(url, 'content')
+
+    def get(self, url):
+        """ 获取url的html文本, 失败返回None """
+        return self._get_cached(url, 'text')
+
+    def get_many(self, urls: Iterable[str], content=False) -> Iterator[Tuple[str, object]]:
+        """
+        批量并发抓取, 按完成顺序返回
+
+        :param urls: url列表
+        :param content: True返回bytes, False返回html文本
+        :return: 生成器 (url, html)
+        """
+        func = self.get_content if content else self.get
+        executor = self._get_executor()
+        futures = {executor.submit(func, url): url for url in dict.fromkeys(urls)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.clear()
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = dict()
+
+
+_fetcher = None
+_fetcher_config = dict()
+_fetcher_lock = threading.Lock()
+
+
+def get_fetcher() -> HtmlFetcher:
+    """ 获取进程内共享的抓取引擎 """
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = HtmlFetcher(**_fetcher_config)
+    return _fetcher
+
+
+def configure_fetcher(**kwargs) -> HtmlFetcher:
+    """ 按参数重建进程内共享的抓取引擎, 参数同HtmlFetcher """
+    global _fetcher, _fetcher_config
+    with _fetcher_lock:
+        if _fetcher is not None:
+            _fetcher.close()
+        _fetcher_config = kwargs
+        _fetcher = HtmlFetcher(**kwargs)
+    return _fetcher
+
+
+def fetcher_config() -> dict:
+    """ 当前抓取引擎的配置, 子进程中用configure_fetcher(**config)重建。spawn方式启动的子进程不继承模块状态, 需要显式传递 """
+    with _fetcher_lock:
+        return dict(_fetcher_config)
+
+
+def _reset_fetcher_after_fork():
+    """ fork出的子进程不继承父进程的线程池和连接, 按相同配置重新创建 """
+    global _fetcher, _fetcher_lock
+    _fetcher = None
+    _fetcher_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_fetcher_after_fork)
 
 
 def get_one_page_html(url):
     """ 获取网站每一页的html return html文件 """
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
-                      "Chrome/85.0.4183.121 Safari/537.36"
-    }
-    try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            return response.text
-        else:
-            return None
-    except RequestException:
-        return None
+    return get_fetcher().get(url)
+
+
+def get_one_page_content(url):
+    """ 获取url的原始bytes, 用于图片等非文本内容 """
+    return get_fetcher().get_content(url)
+
+
+def get_many_page_html(urls: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """ 批量并发获取html, 按完成顺序返回 (url, html) """
+    return get_fetcher().get_many(urls)
+
+
+def get_many_page_content(urls: Iterable[str]) -> Iterator[Tuple[str, bytes]]:
+    """ 批量并发获取原始bytes, 按完成顺序返回 (url, content) """
+    return get_fetcher().get_many(urls, content=True)
 
 
 # def find_page_url(html) -> [str]:
@@ -30,4 +294,3 @@ def get_one_page_html(url):
 #     for i in pages_info:
 #         res.append(i.attr('href'))
 #     return res
-
@@ -1,10 +1,21 @@
 # 本方法为数据导出等功能
-import copy
+# pandas和pymongo导入较慢, 在写入excel/csv和数据库时才导入, 不写入的运行(如分布式worker)不需要加载
+import datetime
+import json
+import numbers
+import queue
+import threading
+import time
 
-import pandas as pd
-import numpy as np
 import os
-import pymongo
+
+from utils.metrics_service import get_metrics
+from utils.profile_service import profile_stage
+
+
+def as_dicts(info) -> [dict]:
+    """ 写入前将记录对象(如RoomRecord)转为dict """
+    return [i if isinstance(i, dict) else i.to_dict() for i in info]
 
 
 def save_info_to_local(info: [dict], path: str, file_name='info.xlsx', data_type='DataFrame'):
@@ -19,51 +30,372 @@ def save_info_to_local(info: [dict], path: str, file_name='info.xlsx', data_type
     """
     # 生成输出路径
     if not os.path.isdir(path):
-        os.mkdir(path)
+        os.makedirs(path)
     # 生成输出的信息
+    time0 = time.perf_counter()
     if data_type == 'DataFrame':
-        df = pd.DataFrame.from_dict(info)
+        import pandas as pd
+        df = pd.DataFrame.from_dict(as_dicts(info))
         df.to_excel(os.path.join(path, file_name), index=False)
         data = df
+        sink = 'excel'
     elif data_type == 'json':
-        with open(os.path.join(path, file_name), 'w') as f:
-            f.write(info)
-        data = info
+        data = as_dicts(info)
+        with open(os.path.join(path, file_name), 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        sink = 'json'
     else:
         raise Exception('不支持的信息存入方法，请修改data_type参数')
+    get_metrics().observe('sink_seconds', time.perf_counter() - time0, sink=sink)
+    get_metrics().inc('sink_rows_total', len(info), sink=sink)
 
     return True, data
 
 
-def save_info_to_mongodb(info: [dict], db_config: dict, server_config=None):
+_mongo_clients = dict()
+_mongo_lock = threading.Lock()
+
+
+def get_mongo_client(host='localhost', port=27017) -> 'pymongo.MongoClient':
+    """ 进程内按 host+port 复用的MongoClient, 自带连接池 """
+    key = (host, int(port))
+    with _mongo_lock:
+        client = _mongo_clients.get(key)
+        if client is None:
+            import pymongo
+            client = pymongo.MongoClient(host, int(port))
+            _mongo_clients[key] = client
+    return client
+
+
+def _reset_mongo_after_fork():
+    """ MongoClient不能跨fork使用, 子进程重新创建 """
+    global _mongo_clients, _mongo_lock
+    _mongo_clients = dict()
+    _mongo_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_mongo_after_fork)
+
+
+def _parse_server_config(server_config):
+    if server_config:
+        return server_config.get('host', 'localhost'), server_config.get('port', 27017)
+    return 'localhost', 27017
+
+
+class MongoBulkWriter:
+    """
+    mongodb批量写入。按 key_field+city+date upsert, 重复运行或重试不会产生重复文档
+    写入在后台线程执行, 与抓取并行; 队列满时write阻塞(背压)
     """
-    将信息存入mongodb
+    _STOP = object()
+
+    def __init__(self, db_config: dict, server_config=None, key_field='房源链接', date=None, chunk_size=500,
+                 max_queue=8, index_fields=('区域', '小区'), client=None, city=None):
+        """
+        :param db_config: 数据库信息，要求包含db_name和tb_name
+        :param server_config: {'host': , 'port': }, 默认localhost:27017
+        :param key_field: 唯一键字段, 与date一起作为upsert条件
+        :param date: 写入每条文档的date字段 如20221201, 默认今天
+        :param chunk_size: 每次bulk_write的条数
+        :param max_queue: 等待写入的最大块数
+        :param index_fields: 需要建索引的查询字段
+        :param client: 已有的MongoClient, 默认按server_config复用连接池
+        :param city: 写入每条文档的city字段(城市代码), 多个城市写入同一集合时用于区分
+        """
+        import pymongo
+        self.pymongo = pymongo
+        db_name = db_config.get('db_name')
+        tb_name = db_config.get('tb_name')
+        if not db_name or not tb_name:
+            raise Exception('数据库信息错误，需要包含db_name和tb_name参数')
+        if client is None:
+            client = get_mongo_client(*_parse_server_config(server_config))
+        self.tb = client.get_database(db_name).get_collection(tb_name)
+        self.key_field = key_field
+        self.date = date if date else datetime.datetime.today().strftime('%Y%m%d')
+        self.city = city
+        self.chunk_size = chunk_size
+        self.n = 0
+        self.error = None
+        self._buffer = list()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.tb.create_index([(key_field, pymongo.ASCENDING), ('city', pymongo.ASCENDING), ('date', pymongo.ASCENDING)],
+                             unique=True)
+        for i in index_fields:
+            self.tb.create_index([(i, pymongo.ASCENDING), ('date', pymongo.ASCENDING)])
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is self._STOP:
+                return
+            if self.error is not None:  # 出错后丢弃剩余数据, 在close时抛出
+                continue
+            try:
+                operations = list()
+                for doc in chunk:
+                    doc = dict(doc, date=self.date, city=self.city)
+                    operations.append(self.pymongo.UpdateOne(
+                        {self.key_field: doc.get(self.key_field), 'city': self.city, 'date': self.date},
+                        {'$set': doc}, upsert=True))
+                with get_metrics().timer('sink_seconds', sink='mongodb'), profile_stage('sink'):
+                    self.tb.bulk_write(operations, ordered=False)
+                get_metrics().inc('sink_rows_total', len(chunk), sink='mongodb')
+                self.n += len(chunk)
+            except Exception as e:
+                self.error = e
+
+    def write(self, chunk: [dict]):
+        """ 加入写入队列, 满chunk_size条提交一次 """
+        if self.error is not None:
+            raise self.error
+        self._buffer += as_dicts(chunk)
+        while len(self._buffer) >= self.chunk_size:
+            self._queue.put(self._buffer[:self.chunk_size])
+            self._buffer = self._buffer[self.chunk_size:]
+
+    def close(self):
+        """ 提交剩余数据并等待写入完成 """
+        if self._buffer:
+            self._queue.put(self._buffer)
+            self._buffer = list()
+        self._queue.put(self._STOP)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.n
+
+
+def save_info_to_mongodb(info: [dict], db_config: dict, server_config=None, key_field='房源链接', date=None,
+                         city=None):
+    """
+    将信息存入mongodb, 按 key_field+city+date upsert
 
     :param info: 要存入的信息
-    :param db_config: 数据库信息，要求包含库名，表（集合）名。如{}
-    :param server_config:
+    :param db_config: 数据库信息，要求包含库名，表（集合）名。如{'db_name': 'crawler', 'tb_name': 'room_info_lj'}
+    :param server_config: {'host': , 'port': }, 默认localhost:27017
+    :param key_field: 唯一键字段 房源为'房源链接', 小区为'url'
+    :param date: 写入的date字段, 默认今天
+    :param city: 写入的city字段(城市代码)
     :return:
     """
-    _info = copy.deepcopy(info)
-    # 参数解析
-    if server_config:
-        host = server_config.get('host')
-        port = server_config.get('post')
-    else:
-        host = 'localhost'
-        port = 27017
-    db_name = db_config.get('db_name')
-    tb_name = db_config.get('tb_name')
-    if not db_name or not tb_name:
-        raise Exception('数据库信息错误，需要包含db_name和tb_name参数')
-    # 开始操作
-    client = pymongo.MongoClient(host, port)
-    db = client.get_database(db_name)
-    tb = db.get_collection(tb_name)
-    tb.insert_many(_info)
+    writer = MongoBulkWriter(db_config, server_config, key_field, date, city=city)
+    try:
+        writer.write(info)
+    finally:
+        writer.close()
     return True
 
 
+class CsvChunkSink:
+    """
+    分块追加写入本地csv, 用于流水线模式
+    之后的块出现新的列时, 新列加在最后, 重写已写入部分的表头, 已写入的行中新列为空, 不会丢弃数据
+    """
+    def __init__(self, path: str, file_name: str):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.file_path = os.path.join(path, file_name)
+        self.n = 0
+        self.columns = None  # 已写入的列, 之后的块按此对齐
+        if os.path.isfile(self.file_path):
+            os.remove(self.file_path)
+
+    def write(self, chunk: [dict]):
+        import pandas as pd
+        time0 = time.perf_counter()
+        df = pd.DataFrame.from_dict(as_dicts(chunk))
+        if self.n == 0:
+            self.columns = list(df.columns)
+        else:
+            new_columns = [i for i in df.columns if i not in self.columns]
+            if new_columns:
+                self._add_columns(new_columns)
+            df = df.reindex(columns=self.columns)
+        # utf-8-sig 便于excel直接打开
+        df.to_csv(self.file_path, mode='a', index=False, header=self.n == 0,
+                  encoding='utf-8-sig' if self.n == 0 else 'utf-8')
+        self.n += len(chunk)
+        get_metrics().observe('sink_seconds', time.perf_counter() - time0, sink='csv')
+        get_metrics().inc('sink_rows_total', len(chunk), sink='csv')
+
+    def _add_columns(self, columns: list):
+        """ 按加上新列的表头重写已写入的文件 """
+        import csv
+        tmp_path = self.file_path + '.tmp'
+        with open(self.file_path, 'r', encoding='utf-8-sig', newline='') as f_in, \
+                open(tmp_path, 'w', encoding='utf-8-sig', newline='') as f_out:
+            reader = csv.reader(f_in)
+            writer = csv.writer(f_out, lineterminator=os.linesep)  # 与pandas.to_csv一致
+            next(reader)
+            writer.writerow(self.columns + columns)
+            for row in reader:
+                writer.writerow(row + [''] * len(columns))
+        os.replace(tmp_path, self.file_path)
+        print('== csv {} 出现新的列 {}, 已重写 {} 行 =='.format(self.file_path, columns, self.n))
+        self.columns = self.columns + columns
+
+    def close(self):
+        pass
+
+
+def parquet_partition_path(root: str, source: str, city: str, date: str) -> str:
+    """ 按 来源/城市/日期 分区的目录 """
+    return os.path.join(root, 'source={}'.format(source), 'city={}'.format(city), 'date={}'.format(date))
+
+
+def _is_number(v):
+    return isinstance(v, numbers.Number) and not isinstance(v, bool)
+
+
+class ParquetChunkSink:
+    """
+    分块写入本地parquet, 每块一个row group, 按 来源/城市/日期 分区
+    列类型: 全部为数值(或空)的列为float64, 其余为string
+    之后的块出现新的列, 或float64列中出现非数值时, 扩展schema(新列加在最后, 该列改为string), 并按新schema重写已写入的row group,
+    不会丢弃数据。改为string的列中已写入的数值转为文本, 整数值不带小数点
+    """
+    def __init__(self, root: str, source: str, city: str, date: str, file_name='part-0.parquet'):
+        import pyarrow  # 可选依赖, 只有写parquet时需要
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = parquet_partition_path(root, source, city, date)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.file_path = os.path.join(self.path, file_name)
+        self._tmp_path = self.file_path + '.tmp'
+        self.schema = None
+        self.writer = None
+        self.n = 0
+
+    def _make_schema(self, rows: [dict], base=None):
+        """ 由rows推断schema, base不为空时在base的基础上扩展 """
+        columns = [i.name for i in base] if base is not None else list()
+        for row in rows:
+            for k in row:
+                if k not in columns:
+                    columns.append(k)
+        fields = list()
+        for k in columns:
+            if base is not None and k in base.names and base.field(k).type == self.pa.string():
+                fields.append(base.field(k))
+                continue
+            values = [row.get(k) for row in rows]
+            numeric = all(v is None or v == '' or _is_number(v) for v in values)
+            fields.append(self.pa.field(k, self.pa.float64() if numeric else self.pa.string()))
+        return self.pa.schema(fields)
+
+    @staticmethod
+    def _float_to_str(v):
+        if v is None:
+            return None
+        return str(int(v)) if v.is_integer() else repr(v)
+
+    def _conform(self, table, schema):
+        """ 将已写入的row group转换为新schema """
+        columns = list()
+        for field in schema:
+            if field.name not in table.column_names:
+                columns.append(self.pa.nulls(table.num_rows, field.type))
+            elif table.schema.field(field.name).type != field.type:  # float64改为string
+                columns.append(self.pa.array([self._float_to_str(v) for v in table.column(field.name).to_pylist()],
+                                             field.type))
+            else:
+                columns.append(table.column(field.name))
+        return self.pa.Table.from_arrays(columns, schema=schema)
+
+    def _evolve(self, schema):
+        """ 按新schema重写已写入的row group, 之后继续追加。写入过程中的文件为.tmp, close时替换 """
+        self.writer.close()
+        os.replace(self._tmp_path, self.file_path)
+        source = self.pq.ParquetFile(self.file_path)
+        try:
+            self.writer = self.pq.ParquetWriter(self._tmp_path, schema, compression='zstd')
+            for n in range(source.num_row_groups):
+                self.writer.write_table(self._conform(source.read_row_group(n), schema))
+        finally:
+            source.close()
+        print('== parquet {} 的列变化 {}, 已按新的列重写 {} 行 =='.format(
+            self.file_path, [i.name for i in schema if i.name not in self.schema.names or
+                             self.schema.field(i.name).type != i.type], self.n))
+        self.schema = schema
+
+    def _coerce(self, rows: [dict]) -> dict:
+        data = dict()
+        for field in self.schema:
+            values = [row.get(field.name) for row in rows]
+            if field.type == self.pa.float64():
+                data[field.name] = [float(v) if _is_number(v) else None for v in values]
+            else:
+                data[field.name] = [None if v is None else str(v) for v in values]
+        return data
+
+    def write(self, chunk: [dict]):
+        time0 = time.perf_counter()
+        rows = as_dicts(chunk)
+        if self.schema is None:
+            self.schema = self._make_schema(rows)
+            self.writer = self.pq.ParquetWriter(self._tmp_path, self.schema, compression='zstd')
+        else:
+            schema = self._make_schema(rows, self.schema)
+            if not schema.equals(self.schema):
+                self._evolve(schema)
+        table = self.pa.Table.from_pydict(self._coerce(rows), schema=self.schema)
+        self.writer.write_table(table)
+        self.n += len(rows)
+        get_metrics().observe('sink_seconds', time.perf_counter() - time0, sink='parquet')
+        get_metrics().inc('sink_rows_total', len(rows), sink='parquet')
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            os.replace(self._tmp_path, self.file_path)
+
+
+def save_info_to_parquet(info: [dict], root: str, source: str, city: str, date: str, row_group_size=5000):
+    """
+    将信息按row group分块写入本地parquet
+
+    :param info: 信息。dict或RoomRecord组成的list
+    :param root: 数据根目录
+    :param source: 来源 如LJ ZR HD
+    :param city: 城市代码 如sh
+    :param date: 日期 如20221201
+    :param row_group_size: 每个row group的条数
+    :return: 写入的文件路径
+    """
+    sink = ParquetChunkSink(root, source, city, date)
+    try:
+        for n in range(0, len(info), row_group_size):
+            sink.write(info[n: n + row_group_size])
+    finally:
+        sink.close()
+    return sink.file_path
+
+
+def load_info_from_parquet(root: str, source: str, city: str, date: str) -> 'pd.DataFrame':
+    """ 读取某来源某城市某天的数据 """
+    import pandas as pd
+    return pd.read_parquet(parquet_partition_path(root, source, city, date))
+
+
+def export_parquet_to_excel(root: str, source: str, city: str, date: str, excel_path: str):
+    """ 由parquet导出excel """
+    df = load_info_from_parquet(root, source, city, date)
+    dir_path = os.path.dirname(excel_path)
+    if dir_path and not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    df.to_excel(excel_path, index=False)
+    return excel_path
+
+
 def test_db_connect(db_config: dict):
     """
     根据db_config测试数据库链接
@@ -74,8 +406,8 @@ def test_db_connect(db_config: dict):
     host = db_config.get('host')
     port = db_config.get('port')
     if not host or not port:
-        return False, '未输入正确的db_config'
-    client = pymongo.MongoClient(host, port)
+        return False
+    client = get_mongo_client(host, port)
     try:
         client.list_databases()
     except:
@@ -0,0 +1,291 @@
+# 本方法为运行指标: 计数器和耗时直方图, 按抓取、解析、价格识别、整理、写入各环节分别统计
+# 运行结束后输出为Prometheus文本文件(可供node_exporter的textfile collector采集)和json汇总, 运行中定期打印速度
+
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# 耗时直方图的默认分桶(秒)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: tuple, extra=()) -> str:
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"')
+    return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in items) + '}'
+
+
+def _json_bound(bound):
+    """ 超出最大分桶时为+Inf, json不支持inf """
+    return '+Inf' if bound == float('inf') else bound
+
+
+class Histogram:
+    """ 按标签分组的直方图, 记录各分桶的计数、总和与次数 """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.values = dict()  # 标签: [各分桶计数(不累计), 总和, 次数]
+
+    def observe(self, key, value):
+        v = self.values.get(key)
+        if v is None:
+            v = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self.values[key] = v
+        v[0][bisect.bisect_left(self.buckets, value)] += 1
+        v[1] += value
+        v[2] += 1
+
+    def quantile(self, key, q) -> float:
+        """ 由分桶估计分位数, 返回所在分桶的上界 """
+        counts, _, n = self.values[key]
+        target = q * n
+        acc = 0
+        for bound, c in zip(self.buckets + (float('inf'),), counts):
+            acc += c
+            if acc >= target:
+                return bound
+        return float('inf')
+
+
+class MetricsRegistry:
+    """
+    进程内的指标注册表, 线程安全
+
+    - inc(name, value, **labels): 计数器
+    - observe(name, seconds, **labels): 耗时直方图
+    - timer(name, **labels): 计时的上下文管理器, 结束时observe
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = dict()  # 名称: {标签: 值}
+        self.histograms = dict()  # 名称: Histogram
+        self.helps = dict()
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        """ 指标说明, 写入Prometheus的# HELP """
+        self.helps[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counter = self.counters.setdefault(name, dict())
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = Histogram(self.buckets)
+                self.histograms[name] = histogram
+            histogram.observe(key, seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        time0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - time0, **labels)
+
+    def total(self, name) -> float:
+        """ 计数器全部标签的合计 """
+        with self._lock:
+            return sum(self.counters.get(name, dict()).values())
+
+    def summary(self) -> dict:
+        """ 各直方图合计全部标签的 {名称: {'count': 次数, 'seconds': 总耗时}}, 用于判断各环节的耗时占比 """
+        with self._lock:
+            return {name: {'count': sum(v[2] for v in h.values.values()),
+                           'seconds': round(sum(v[1] for v in h.values.values()), 3)}
+                    for name, h in self.histograms.items()}
+
+    def snapshot(self, reset=False) -> dict:
+        """ 可pickle的指标快照, 用于子进程汇总到主进程。reset为True时清空本进程的指标 """
+        with self._lock:
+            res = {'counters': {k: dict(v) for k, v in self.counters.items()},
+                   'histograms': {k: (h.buckets, {key: [list(v[0]), v[1], v[2]] for key, v in h.values.items()})
+                                  for k, h in self.histograms.items()}}
+            if reset:
+                self.counters = dict()
+                self.histograms = dict()
+        return res
+
+    def merge(self, snapshot: dict):
+        """ 合并其他进程的指标快照 """
+        with self._lock:
+            for name, values in snapshot['counters'].items():
+                counter = self.counters.setdefault(name, dict())
+                for key, value in values.items():
+                    counter[key] = counter.get(key, 0) + value
+            for name, (buckets, values) in snapshot['histograms'].items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = Histogram(buckets)
+                    self.histograms[name] = histogram
+                for key, (counts, total, n) in values.items():
+                    v = histogram.values.setdefault(key, [[0] * (len(buckets) + 1), 0.0, 0])
+                    v[0] = [i + j for i, j in zip(v[0], counts)]
+                    v[1] += total
+                    v[2] += n
+
+    def to_prometheus(self, prefix='watchingu_') -> str:
+        """ Prometheus文本格式 """
+        lines = list()
+        with self._lock:
+            for name, values in sorted(self.counters.items()):
+                full_name = prefix + name
+                if name in self.helps:
+                    lines.append('# HELP {} {}'.format(full_name, self.helps[name]))
+                lines.append('# TYPE {} counter'.format(full_name))
+                for key, value in sorted(values.items()):
+                    lines.append('{}{} {}'.format(full_name, _format_labels(key), value))
+            for name, histogram in sorted(self.histograms.items()):
+                full_name = prefix + name
+                if name in self.helps:
+                    lines.append('# HELP {} {}'.format(full_name, self.helps[name]))
+                lines.append('# TYPE {} histogram'.format(full_name))
+                for key, (counts, total, n) in sorted(histogram.values.items()):
+                    acc = 0
+                    for bound, c in zip(histogram.buckets, counts):
+                        acc += c
+                        lines.append('{}_bucket{} {}'.format(full_name, _format_labels(key, [('le', bound)]), acc))
+                    lines.append('{}_bucket{} {}'.format(full_name, _format_labels(key, [('le', '+Inf')]), n))
+                    lines.append('{}_sum{} {}'.format(full_name, _format_labels(key), round(total, 6)))
+                    lines.append('{}_count{} {}'.format(full_name, _format_labels(key), n))
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> dict:
+        """ json汇总: 计数器的值, 直方图的次数、总耗时、平均、p50、p95 """
+        res = {'elapsed_seconds': round(time.time() - self.start_time, 3), 'counters': dict(), 'histograms': dict()}
+        with self._lock:
+            for name, values in self.counters.items():
+                res['counters'][name] = {_format_labels(key) or 'total': value for key, value in values.items()}
+            for name, histogram in self.histograms.items():
+                summary = dict()
+                for key, (counts, total, n) in histogram.values.items():
+                    summary[_format_labels(key) or 'total'] = {
+                        'count': n, 'sum': round(total, 6), 'avg': round(total / n, 6) if n else None,
+                        'p50': _json_bound(histogram.quantile(key, 0.5)),
+                        'p95': _json_bound(histogram.quantile(key, 0.95))}
+                res['histograms'][name] = summary
+        return res
+
+    def write(self, path, tag):
+        """
+        写入 path/metrics_标签.prom 和 path/metrics_标签.json
+
+        :return: 两个文件的路径
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        prom_path = os.path.join(path, 'metrics_{}.prom'.format(tag))
+        json_path = os.path.join(path, 'metrics_{}.json'.format(tag))
+        for file_path, text in ((prom_path, self.to_prometheus()),
+                                (json_path, json.dumps(self.to_dict(), ensure_ascii=False, indent=2))):
+            tmp_path = file_path + '.tmp'  # textfile collector要求原子替换
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, file_path)
+        return prom_path, json_path
+
+
+class ProgressReporter(threading.Thread):
+    """ 后台线程, 每interval秒打印一次页面和房源的速度 """
+    def __init__(self, registry: MetricsRegistry, interval=30, printer=print):
+        super().__init__(daemon=True)
+        self.registry = registry
+        self.interval = interval
+        self.printer = printer
+        self._stop_event = threading.Event()
+
+    def line(self, last: dict, elapsed) -> (str, dict):
+        now = {name: self.registry.total(name) for name in ('fetch_requests_total', 'pages_total', 'listings_total',
+                                                              'sink_rows_total')}
+        speed = {name: (now[name] - last.get(name, 0)) / max(elapsed, 1e-6) for name in now}
+        text = '== 进度 请求 {:.0f} ({:.1f}/s) 页面 {:.0f} ({:.1f}/s) 房源 {:.0f} ({:.1f}/s) 写入 {:.0f} ({:.1f}/s) =='.format(
+            now['fetch_requests_total'], speed['fetch_requests_total'], now['pages_total'], speed['pages_total'],
+            now['listings_total'], speed['listings_total'], now['sink_rows_total'], speed['sink_rows_total'])
+        return text, now
+
+    def run(self):
+        last, time0 = dict(), time.time()
+        while not self._stop_event.wait(self.interval):
+            text, last = self.line(last, time.time() - time0)
+            time0 = time.time()
+            self.printer(text)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_registry = MetricsRegistry()
+_registry.describe('fetch_requests_total', '请求次数, 按host和状态码, 状态码none为网络异常')
+_registry.describe('fetch_bytes_total', '响应字节数, 按host')
+_registry.describe('fetch_seconds', '单次请求耗时, 按host')
+_registry.describe('fetch_cache_hits_total', '页面缓存和本地存储的命中次数, 按来源')
+_registry.describe('pages_total', '解析的页面数, 按来源')
+_registry.describe('listings_total', '解析出的房源或小区数, 按来源')
+_registry.describe('parse_seconds', '单个页面的解析耗时, 按来源')
+_registry.describe('ocr_sprites_total', '识别的价格图片数')
+_registry.describe('ocr_sprite_failures_total', '下载失败的价格图片数, 使用这些图片的房源价格为空')
+_registry.describe('ocr_glyph_lookups_total', '查表的价格数字数')
+_registry.describe('ocr_glyph_model_total', '查表未命中、由模型识别的数字图像数')
+_registry.describe('ocr_glyph_low_confidence_total', '模型识别置信度较低的数字图像数')
+_registry.describe('ocr_seconds', '单张价格图片的识别耗时(批量识别时为平均)')
+_registry.describe('dedup_listings_total', '去重前的房源数, 按来源')
+_registry.describe('dedup_duplicates_total', '去掉的重复房源数, 按来源')
+_registry.describe('normalize_records_total', '整理的记录数, 按来源')
+_registry.describe('normalize_seconds', '每批记录的整理耗时, 按来源')
+_registry.describe('sink_rows_total', '写入的行数, 按写入方式')
+_registry.describe('sink_seconds', '每次写入的耗时, 按写入方式')
+_registry.describe('stage_seconds', 'print_time装饰的方法的耗时')
+
+
+def get_metrics() -> MetricsRegistry:
+    """ 进程内共享的指标注册表 """
+    return _registry
+
+
+_reporter = None
+
+
+def start_progress(interval=30, printer=print):
+    """ 开始定期打印速度, interval<=0时不打印 """
+    global _reporter
+    stop_progress()
+    if interval and interval > 0:
+        _reporter = ProgressReporter(get_metrics(), interval, printer)
+        _reporter.start()
+
+
+def stop_progress():
+    global _reporter
+    if _reporter is not None:
+        _reporter.stop()
+        _reporter = None
+
+
+def _reset_metrics_after_fork():
+    """ 子进程从空的指标开始, 由主进程合并子进程的快照, 避免重复计数 """
+    global _registry, _reporter
+    _reporter = None  # 打印线程不会随fork复制
+    registry = MetricsRegistry(_registry.buckets)
+    registry.helps = dict(_registry.helps)
+    _registry = registry
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_metrics_after_fork)
@@ -1,81 +1,385 @@
 #! /usr/bin/python3
-# Attention path
-from PIL import Image
-import numpy as np
-from sklearn.linear_model import LogisticRegression as LR
-import pickle
+# 本方法为自如价格数字识别模型的训练和评估: 由标注的数字图片和价格图片生成数字图像(含平移、噪点的合成样本), 训练候选模型,
+# 报告准确率、单个数字的推理耗时和模型加载耗时, 并将选出的模型保存为加载较快的格式
+#   python utils/ocr/train.py                                训练并评估全部候选模型, 保存最优模型
+#   python utils/ocr/train.py --models lr,knn --no_save --report result/ocr_report.json
+#   python utils/ocr/train.py --train_sprites data/sprites   加入更多标注的价格图片(目录中需有digits.json)
+#   python utils/ocr/train.py --eval_sprites data/eval       使用另外标注的价格图片评估
+# 训练数据: training_data下(含子目录)以数字命名的单个数字图片, 如 training_data/20220818/3.jpg, 可由 生成训练图片.py 生成
+# 评估数据: --eval_sprites中标注的价格图片, 与训练数据完全相同的数字图像会被排除; 不指定时按数字分层留出holdout比例的训练数据,
+#   留出的部分不参与训练。每个数字少于2个不同的数字图像(如仓库自带的training_data), 或评估图片全部出现在训练数据中时,
+#   改为用合成样本评估: 与训练用的合成样本使用不同的随机种子和更大的平移范围, 并排除与训练样本完全相同的图像,
+#   此时的准确率只反映对平移和噪点的鲁棒性, 会打印警告
+# benchmark/fixtures/sprites由训练图片生成, 不能作为独立的评估数据; 现有模型可能使用过评估数据训练, 其准确率仅供参考
+import argparse
+import glob
+import json
 import os
-import copy
-import pandas as pd
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+
+now_dir = os.path.dirname(os.path.abspath(__file__))
+path_code = os.path.dirname(os.path.dirname(now_dir))
+if path_code not in sys.path:
+    sys.path.append(path_code)
+
+import numpy as np
+from PIL import Image
+
+from utils.ocr_service import LinearGlyphModel, read_model, sprite_to_glyphs
+
+
+TRAINING_DATA_PATH = os.path.join(now_dir, 'training_data')
+MODEL_DIR = os.path.join(now_dir, 'pre_trained_model')
+BASELINE_MODEL_PATH = os.path.join(MODEL_DIR, 'LR_0906.pickle')  # 当前使用的模型, 作为对比
+THRESHOLD = 130  # 二值化阈值, 与ocr_service一致
+
+
+def make_candidates() -> dict:
+    """ 候选模型 {名称: 生成未训练模型的方法}, 输入为0/255的像素, 与识别时一致 """
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.neighbors import KNeighborsClassifier, NearestCentroid
+    from sklearn.svm import LinearSVC
+    return {
+        'lr': lambda: LogisticRegression(max_iter=2000),
+        'svm': lambda: LinearSVC(max_iter=10000),
+        'knn': lambda: KNeighborsClassifier(n_neighbors=1),
+        'centroid': lambda: NearestCentroid(),
+    }
+
+
+def load_digit_images(path) -> (np.ndarray, np.ndarray, tuple):
+    """
+    读取path下(含子目录)以数字命名的单个数字图片, 如 3.jpg
+
+    :return: (数字图像 shape为(n, 像素数), 标注, 单个数字图像的shape)
+    """
+    glyphs, labels, shape = list(), list(), None
+    for file in sorted(glob.glob(os.path.join(path, '**', '*.*'), recursive=True)):
+        name = os.path.splitext(os.path.basename(file))[0]
+        if not (len(name) == 1 and name.isdigit()):
+            continue
+        image = np.asarray(Image.open(file).convert('L'))
+        if shape is None:
+            shape = image.shape
+        elif image.shape != shape:
+            print('==== 图片 {} 尺寸 {} 与其他图片 {} 不一致, 已跳过 ===='.format(file, image.shape, shape))
+            continue
+        glyphs.append(np.where(image.reshape(-1) > THRESHOLD, 255, 0).astype(np.uint8))
+        labels.append(int(name))
+    if not glyphs:
+        return np.zeros((0, 0), dtype=np.uint8), np.zeros(0, dtype=int), shape
+    return np.array(glyphs), np.array(labels), shape
+
+
+def load_sprites(path) -> (np.ndarray, np.ndarray, tuple):
+    """
+    读取path下标注的价格图片, 标注为path/digits.json {文件名: 从左到右的10个数字}
+
+    :return: (数字图像 shape为(n, 像素数), 标注, 单个数字图像的shape)
+    """
+    with open(os.path.join(path, 'digits.json'), 'r', encoding='utf-8') as f:
+        digits = json.load(f)
+    glyphs, labels, shape = list(), list(), None
+    for file, label in sorted(digits.items()):
+        image = Image.open(os.path.join(path, file))
+        shape = (image.size[1], int(image.size[0] / len(label)))
+        glyphs.append(sprite_to_glyphs(image, len(label), THRESHOLD))
+        labels.extend(int(i) for i in label)
+    return np.concatenate(glyphs), np.array(labels), shape
+
+
+def unique_glyphs(glyphs, labels) -> (np.ndarray, np.ndarray):
+    """ 去掉完全相同的数字图像, 相同图像的标注不一致时报错 """
+    seen, keep = dict(), list()
+    for n, (glyph, label) in enumerate(zip(glyphs, labels)):
+        key = glyph.tobytes()
+        if key in seen:
+            if seen[key] != label:
+                raise Exception('相同的数字图像标注不一致: {} 和 {}'.format(seen[key], label))
+            continue
+        seen[key] = label
+        keep.append(n)
+    return glyphs[keep], labels[keep]
+
+
+def exclude_seen(x_eval, y_eval, x_train) -> (np.ndarray, np.ndarray, int):
+    """
+    排除评估数据中与训练数据完全相同的数字图像
+
+    :return: (数字图像, 标注, 排除的数量)
+    """
+    seen = {i.tobytes() for i in x_train}
+    keep = [n for n, i in enumerate(x_eval) if i.tobytes() not in seen]
+    return x_eval[keep], y_eval[keep], len(x_eval) - len(keep)
+
+
+def holdout_split(glyphs, labels, fraction=0.3, seed=0) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    """
+    按数字分层留出评估数据, 每个数字至少留出1个、至少保留1个用于训练
+
+    :param fraction: 留出的比例
+    :return: (训练数字图像, 训练标注, 评估数字图像, 评估标注), 有数字少于2个不同的数字图像、无法留出时为None
+    """
+    rng = np.random.RandomState(seed)
+    train_idx, eval_idx, lacking = list(), list(), list()
+    for digit in range(10):
+        idx = np.flatnonzero(labels == digit)
+        if len(idx) < 2:
+            lacking.append(digit)
+            continue
+        rng.shuffle(idx)
+        k = min(len(idx) - 1, max(1, int(round(len(idx) * fraction))))
+        eval_idx.extend(idx[:k])
+        train_idx.extend(idx[k:])
+    if lacking:
+        print('==== 数字 {} 不同的数字图像少于2个, 无法留出评估数据 ===='.format(lacking))
+        return None
+    return glyphs[train_idx], labels[train_idx], glyphs[eval_idx], labels[eval_idx]
 
 
-path = r'D:\学习总文件夹\整体项目\爬虫\住房问题\整体\code\utils\orc\training_data'
-os.chdir(path)
+def shift_image(image, dy, dx) -> np.ndarray:
+    """ 平移图像, 移出的部分丢弃, 空出的部分为0 """
+    res = np.zeros_like(image)
+    h, w = image.shape
+    res[max(dy, 0): h + min(dy, 0), max(dx, 0): w + min(dx, 0)] = \
+        image[max(-dy, 0): h + min(-dy, 0), max(-dx, 0): w + min(-dx, 0)]
+    return res
 
-model_path = 'LR_0906.pickle'
 
+def augment(glyphs, labels, shape, n=20, max_shift=2, noise=0.02, seed=0) -> (np.ndarray, np.ndarray):
+    """
+    生成合成样本: 每个数字图像随机平移并翻转部分像素, 模拟渲染位置偏差和压缩噪点
 
-def my_threshold(image):
+    :param n: 每个数字图像生成的样本数
+    :param max_shift: 最大平移像素数
+    :param noise: 像素翻转的比例
+    :param seed: 随机种子, 相同参数生成的样本相同
+    :return: (数字图像, 标注)
     """
-    将灰度图像转换为二元图像，即1-0
+    rng = np.random.RandomState(seed)
+    res = list()
+    for glyph in glyphs:
+        image = glyph.reshape(shape)
+        for _ in range(n):
+            dy, dx = rng.randint(-max_shift, max_shift + 1, 2)
+            sample = shift_image(image, dy, dx)
+            flip = rng.random_sample(shape) < noise
+            res.append(np.where(flip, 255 - sample, sample).reshape(-1))
+    return np.array(res, dtype=np.uint8).reshape(-1, glyphs.shape[1]), np.repeat(labels, n)
 
-    :param image: PIL Image对象
-    :return: PIL Image对象
+
+def synthetic_eval(x_train, y_train, x_fit, shape, n=20, max_shift=2, noise=0.02, seed=0) -> (np.ndarray, np.ndarray):
     """
-    im0 = copy.deepcopy(image)
-    im0_num = pd.DataFrame(np.array(im0))
-    im0_num[im0_num > 130] = 255
-    im0_num[im0_num <= 130] = 0
-    res = Image.fromarray(np.array(im0_num))
+    没有独立评估数据时的合成评估集: 随机种子与训练不同, 平移范围比训练大1像素, 并排除与训练样本(x_fit)完全相同的图像
+
+    :return: (数字图像, 标注)
+    """
+    x_eval, y_eval = augment(x_train, y_train, shape, n, max_shift + 1, noise, seed + 1000)
+    x_eval, y_eval, _ = exclude_seen(x_eval, y_eval, x_fit)
+    return x_eval, y_eval
+
+
+def best_time(func, repeat) -> float:
+    """ repeat次中最短的耗时(秒) """
+    res = float('inf')
+    for _ in range(repeat):
+        time0 = time.perf_counter()
+        func()
+        res = min(res, time.perf_counter() - time0)
     return res
 
 
-def train():
-    model = LR()
-    images = []
-    for i in range(10):
-        image_path = os.path.join(path, '%d.jpg' % i)
-        image = Image.open(image_path)
-        image = my_threshold(image)
-        images.append(np.array(image))
-    images = np.array(images)
-    images = images.reshape((10, -1))
-    print(images.shape)
-    X = images
-    # Y = np.reshape(np.array([[0, 1, 2, 3, 4, 5, 6, 7, 8, 9]]), (10, 1))
-    Y = np.array(range(10))
-    model.fit(X, Y)
-    print(model.score(X, Y))
-    # save model
-    with open(model_path, 'wb') as fw:
-        pickle.dump(model, fw)
+def save_model(model, path):
+    """ 保存模型, .npz为LinearGlyphModel(只支持线性模型), 其他为pickle """
+    if path.endswith('.npz'):
+        if compact_suffix(model) != '.npz':
+            raise Exception('{} 不能保存为.npz, 请使用.pickle'.format(type(model).__name__))
+        if not isinstance(model, LinearGlyphModel):
+            model = LinearGlyphModel.from_sklearn(model)
+        model.save(path)
+    else:
+        with open(path, 'wb') as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
 
 
-if __name__ == '__main__':
-    train()
+def compact_suffix(model) -> str:
+    """ 保存时使用的格式, 可导出为LinearGlyphModel的线性模型为.npz, 加载时不需要sklearn; 其他为.pickle """
+    if isinstance(model, LinearGlyphModel):
+        return '.npz'
+    try:
+        LinearGlyphModel.from_sklearn(model)
+        return '.npz'
+    except Exception:
+        return '.pickle'
+
+
+def measure_load(path, repeat=3) -> float:
+    """ 在新的子进程中读取模型的耗时(秒), 包含导入sklearn等依赖的时间, 与每次运行时一致 """
+    code = ('import sys, time; sys.path.insert(0, {!r}); from utils.ocr_service import read_model; '
+            'time0 = time.perf_counter(); read_model({!r}); print(time.perf_counter() - time0)').format(path_code, path)
+    res = float('inf')
+    for _ in range(repeat):
+        p = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, universal_newlines=True)
+        if p.returncode != 0:
+            raise Exception('读取模型 {} 失败\n{}'.format(path, p.stderr[-2000:]))
+        res = min(res, float(p.stdout.strip()))
+    return res
+
+
+def evaluate(model, eval_sets: dict, tmp_path, repeat=5, model_path=None) -> dict:
+    """
+    评估模型。模型先按compact_suffix的格式保存, 准确率、推理耗时和加载耗时都按保存后重新读取的模型测量, 与实际使用时一致
 
+    :param model: 训练好的模型, model_path不为空时不使用
+    :param eval_sets: {评估集名称: (数字图像, 标注)}
+    :param model_path: 已有的模型文件
+    :return: {'accuracy': {评估集: 准确率}, 'errors': {评估集: 错误数}, 'batch_us': 批量识别时单个数字的耗时,
+              'single_us': 单独识别一个数字的耗时, 'load_ms': 新进程中读取模型的耗时, 'size_kb': 模型文件大小,
+              'format': 保存的格式}
+    """
+    path = model_path
+    if path is None:
+        path = os.path.join(tmp_path, 'model' + compact_suffix(model))
+        save_model(model, path)
+    model = read_model(path)
+    res = {'accuracy': dict(), 'errors': dict(), 'format': os.path.splitext(path)[1][1:]}
+    for name, (x, y) in eval_sets.items():
+        pred = np.asarray(model.predict(x)).astype(int)
+        res['accuracy'][name] = round(float(np.mean(pred == y)), 4)
+        res['errors'][name] = int(np.sum(pred != y))
+    x = np.concatenate([i[0] for i in eval_sets.values()])
+    res['batch_us'] = round(best_time(lambda: model.predict(x), repeat) / len(x) * 1e6, 2)
+    res['single_us'] = round(best_time(lambda: model.predict(x[:1]), repeat) * 1e6, 2)
+    res['load_ms'] = round(measure_load(path) * 1000, 1)
+    res['size_kb'] = round(os.path.getsize(path) / 1024, 1)
+    return res
 
-#%% test
-# a = Image.open(r'D:\Learn\学习入口\大项目\爬他妈的\住房问题\自如\data\training_data\9.jpg')
-# b = Image.open(r'D:\Learn\学习入口\大项目\爬他妈的\住房问题\自如\data\training_data\20220818\9.jpg')
 
-# a1 = np.array(a)
-# b1 = np.array(b)
+def select(results: dict, eval_names, tolerance=0.01) -> str:
+    """
+    选择模型: 各评估集的准确率与最优模型相差都不超过tolerance的模型中, 选择加载最快的, 其次为批量识别最快的
+    数字先查表, 模型只在遇到新的数字图像时使用, 加载耗时通常比推理耗时更重要
+    """
+    best = {i: max(res['accuracy'][i] for res in results.values()) for i in eval_names}
+    qualified = [k for k, res in results.items() if all(res['accuracy'][i] >= best[i] - tolerance for i in eval_names)]
+    return min(qualified, key=lambda k: (results[k]['load_ms'], results[k]['batch_us']))
 
-# p_a = KMeans(n_clusters=2, random_state=9).fit_predict(
-#     a1.reshape((a1.shape[0]*a1.shape[1], 1)))
 
-# p_b = KMeans(n_clusters=2, random_state=9).fit_predict(
-#     b1.reshape((b1.shape[0]*b1.shape[1], 1)))
+def report(results: dict, eval_names):
+    print('{:<12} {} {:>10} {:>10} {:>10} {:>9} {:>7}'.format(
+        '模型', ' '.join('{:>10}'.format(i[:10]) for i in eval_names), 'batch_us', 'single_us', 'load_ms',
+        'size_kb', '格式'))
+    for name, res in results.items():
+        print('{:<12} {} {:>10.2f} {:>10.2f} {:>10.1f} {:>9.1f} {:>7}'.format(
+            name, ' '.join('{:>10.4f}'.format(res['accuracy'][i]) for i in eval_names), res['batch_us'],
+            res['single_us'], res['load_ms'], res['size_kb'], res['format']))
 
-# p_t = KMeans(n_clusters=2, random_state=9).fit_predict(
-#     t1.reshape((t1.shape[0]*t1.shape[1], 1)))
 
-# #%%
-# a2 = np.array(a.convert('L'))
-# b2 = np.array(b.convert('L'))
+def make_argsparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument('--training_data', type=str, default=TRAINING_DATA_PATH)  # 单个数字图片的目录
+    parse.add_argument('--train_sprites', type=str, action='append', default=list())  # 加入训练的价格图片目录, 可多次指定
+    parse.add_argument('--eval_sprites', type=str)  # 评估用的另外标注的价格图片目录, 为空时留出部分训练数据
+    parse.add_argument('--holdout', type=float, default=0.3)  # 不指定eval_sprites时留出的训练数据比例
+    parse.add_argument('--models', type=str, default='lr,svm,knn,centroid')  # 候选模型, 逗号分隔
+    parse.add_argument('--baseline_model', type=str, default=BASELINE_MODEL_PATH)  # 参与对比的现有模型, 为空时不对比
+    parse.add_argument('--augment', type=int, default=20)  # 每个数字图像生成的合成样本数
+    parse.add_argument('--max_shift', type=int, default=2)  # 合成样本的最大平移像素数
+    parse.add_argument('--noise', type=float, default=0.02)  # 合成样本的像素翻转比例
+    parse.add_argument('--seed', type=int, default=0)  # 随机种子, 评估的合成样本使用seed+1
+    parse.add_argument('--repeat', type=int, default=5)  # 测量耗时的次数, 取最短
+    parse.add_argument('--tolerance', type=float, default=0.01)  # 选择模型时允许的准确率差距
+    parse.add_argument('--output', type=str)  # 选出模型的保存路径, 默认为pre_trained_model/名称_月日.npz
+    parse.add_argument('--no_save', default=False, action='store_true')  # 只评估, 不保存模型
+    parse.add_argument('--report', type=str)  # 评估结果的输出路径(json)
+    return parse.parse_args()
+
+
+if __name__ == '__main__':
+    args = make_argsparse()
+    x_train, y_train, shape = load_digit_images(args.training_data)
+    for path in args.train_sprites:
+        x, y, shape_sprite = load_sprites(path)
+        if shape is not None and shape_sprite != shape:
+            raise Exception('价格图片 {} 的数字尺寸 {} 与训练图片 {} 不一致'.format(path, shape_sprite, shape))
+        x_train = np.concatenate([x_train, x]) if len(x_train) else x
+        y_train, shape = np.concatenate([y_train, y]), shape_sprite
+    if not len(x_train):
+        raise Exception('没有训练数据, 请检查 {}'.format(args.training_data))
+    x_train, y_train = unique_glyphs(x_train, y_train)
+    x_eval = y_eval = None
+    if args.eval_sprites:
+        x_eval, y_eval, shape_eval = load_sprites(args.eval_sprites)
+        if shape_eval != shape:
+            raise Exception('评估图片的数字尺寸 {} 与训练图片 {} 不一致'.format(shape_eval, shape))
+        x_eval, y_eval, n_seen = exclude_seen(*unique_glyphs(x_eval, y_eval), x_train)
+        if n_seen:
+            print('== 评估图片中 {} 个数字图像与训练数据相同, 已排除 =='.format(n_seen))
+        if not len(x_eval):
+            print('==== 评估图片 {} 的数字图像全部出现在训练数据中 ===='.format(args.eval_sprites))
+            x_eval = y_eval = None
+    else:
+        split = holdout_split(x_train, y_train, args.holdout, args.seed)
+        if split is not None:
+            x_train, y_train, x_eval, y_eval = split
+    x_aug, y_aug = augment(x_train, y_train, shape, args.augment, args.max_shift, args.noise, args.seed)
+    x_fit, y_fit = np.concatenate([x_train, x_aug]), np.concatenate([y_train, y_aug])
+    if x_eval is not None:
+        eval_source = 'eval_sprites' if args.eval_sprites else 'holdout'
+        eval_sets = {'eval': (x_eval, y_eval),
+                     'eval_aug': augment(x_eval, y_eval, shape, args.augment, args.max_shift, args.noise, args.seed + 1)}
+    else:
+        eval_source = 'synthetic'
+        x_eval, y_eval = synthetic_eval(x_train, y_train, x_fit, shape, args.augment, args.max_shift, args.noise,
+                                        args.seed)
+        eval_sets = {'synthetic': (x_eval, y_eval)}
+        print('==== 没有独立的评估数据, 改用合成样本评估(不同随机种子, 平移最多 {} 像素), '
+              '准确率只反映对平移和噪点的鲁棒性, 不代表真实价格图片的准确率; '
+              '请增加训练图片或使用--eval_sprites指定另外标注的价格图片 ===='.format(args.max_shift + 1))
+    print('== 训练样本 {} (原始 {}, 合成 {}), 评估样本 {} ({}) 数字图像尺寸 {} =='.format(
+        len(x_fit), len(x_train), len(x_aug), sum(len(i[0]) for i in eval_sets.values()), eval_source, shape))
 
-# a1 = thin(a).reshape((1, -1))
-# b1 = thin(b).reshape((1, -1))
+    candidates = make_candidates()
+    results, models = dict(), dict()
+    tmp_path = tempfile.mkdtemp(prefix='ocr_train_')
+    try:
+        if args.baseline_model:
+            name = os.path.splitext(os.path.basename(args.baseline_model))[0]
+            results[name] = evaluate(None, eval_sets, tmp_path, args.repeat, args.baseline_model)
+            results[name]['train_s'] = None
+        for name in args.models.split(','):
+            if name not in candidates:
+                raise Exception('未知的候选模型 {}, 可选 {}'.format(name, list(candidates)))
+            model = candidates[name]()
+            time0 = time.perf_counter()
+            model.fit(x_fit, y_fit)
+            train_s = time.perf_counter() - time0
+            models[name] = model
+            results[name] = evaluate(model, eval_sets, tmp_path, args.repeat)
+            results[name]['train_s'] = round(train_s, 3)
+            print('== {} 训练完成 耗时 {:.2f} 秒 =='.format(name, train_s))
+    finally:
+        for file in glob.glob(os.path.join(tmp_path, '*')):
+            os.remove(file)
+        os.rmdir(tmp_path)
+    report(results, list(eval_sets))
 
-# print(model.predict(b1))
+    trained = [i for i in results if i in candidates]
+    chosen = select({k: results[k] for k in trained}, list(eval_sets), args.tolerance) if trained else None
+    if chosen:
+        print('== 选出的模型 {} 评估准确率 {} 批量识别 {} us/数字 加载 {} ms =='.format(
+            chosen, results[chosen]['accuracy'], results[chosen]['batch_us'], results[chosen]['load_ms']))
+    if chosen and not args.no_save:
+        output = args.output or os.path.join(
+            MODEL_DIR, '{}_{}{}'.format(chosen.upper(), time.strftime('%m%d'), compact_suffix(models[chosen])))
+        save_model(models[chosen], output)
+        print('== 模型已保存 {} , 可通过main的--model_path使用 =='.format(output))
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({'shape': shape, 'samples': {'train': len(x_fit), 'eval': len(x_eval)},
+                       'eval_source': eval_source, 'args': vars(args), 'chosen': chosen, 'results': results}, f, ensure_ascii=False, indent=2)
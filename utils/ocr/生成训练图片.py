@@ -1,44 +1,63 @@
-from PIL import Image
+# 本方法为生成训练图片: 将下载的自如价格图片切分为10个单个数字的灰度图片, 保存到training_data下, 供train.py训练
+#   python utils/ocr/生成训练图片.py 价格图片.png --digits 8513406297
+# --digits为价格图片中从左到右的10个数字, 图片按数字命名; 不指定时按位置命名为0.jpg~9.jpg, 需要手动更改为对应的数字
+import argparse
 import os
-import numpy as np
-import pandas as pd
-import copy
+import time
+
+from PIL import Image
+
+
+now_dir = os.path.dirname(os.path.abspath(__file__))
+TRAINING_DATA_PATH = os.path.join(now_dir, 'training_data')
 
 
-# 读取下载的图片
-image_file = r'D:\Learn\学习入口\大项目\爬他妈的\住房问题\自如\data\测试价格图片.png'    
-image = Image.open(image_file)
-#%%
+def split_sprite(image, n=10) -> list:
+    """
+    分割价格图片中的数字
+
+    :param image: PIL Image对象, RGBA, 数字在alpha通道中
+    :param n: 图片中数字的个数
+    :return: n个数字的灰度PIL Image对象
+    """
+    image_width = int(image.size[0] / n)
+    return [image.crop((image_width * i, 0, image_width * (i + 1), image.size[1])).getchannel(3) for i in range(n)]
 
 
-def my_threshold(image):
+def save_training_images(image_file, output_path, digits=None) -> list:
     """
-    将灰度图像转换为二元图像，即1-0
+    生成训练图片
 
-    :param image: PIL Image对象
-    :return:
+    :param image_file: 价格图片路径
+    :param output_path: 输出目录
+    :param digits: 图片中从左到右的10个数字, 为空时按位置命名
+    :return: 生成的图片路径
     """
-    im0 = copy.deepcopy(image)
-    im0_num = pd.DataFrame(np.array(im0))
-    im0_num[im0_num > 130] = 255
-    im0_num[im0_num <= 130] = 0
-    res = Image.fromarray(np.array(im0_num))
+    images = split_sprite(Image.open(image_file))
+    if digits is not None and (len(digits) != len(images) or not digits.isdigit()):
+        raise Exception('digits应为{}个数字, 当前为 {}'.format(len(images), digits))
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    res = list()
+    for n, i in enumerate(images):
+        file = os.path.join(output_path, '{}.jpg'.format(digits[n] if digits else n))
+        i.save(file)
+        res.append(file)
     return res
 
 
-# 分割图片数字
-images = []
-image_width = 30
-for i in range(10):
-    im = image.crop((image_width*i, 0, image_width *
-                     (i+1), image.size[1]))
-    im_grey = im.getchannel(3)  # 生成灰度训练图片
-    im_tj = my_threshold(im_grey)
-    images.append(im_grey)
-
-# 输出训练图片数字
-train_pic_path = r'D:\Learn\学习入口\大项目\爬他妈的\住房问题\自如\data\training_data\20220818'
-for n, i in enumerate(images):
-    i.save(os.path.join(train_pic_path, '{}.jpg'.format(n)))
-    
-# 手动更改训练图片名称
+def make_argsparse():
+    parse = argparse.ArgumentParser()
+    parse.add_argument('image_file', type=str)  # 下载的价格图片
+    parse.add_argument('--digits', type=str)  # 图片中从左到右的10个数字
+    parse.add_argument('--output', type=str)  # 输出目录, 默认为training_data/年月日
+    return parse.parse_args()
+
+
+if __name__ == '__main__':
+    args = make_argsparse()
+    output = args.output or os.path.join(TRAINING_DATA_PATH, time.strftime('%Y%m%d'))
+    files = save_training_images(args.image_file, output, args.digits)
+    print('== 已生成训练图片 {} 张 {} =='.format(len(files), output))
+    if not args.digits:
+        print('== 未指定--digits, 请手动将图片更名为对应的数字 ==')
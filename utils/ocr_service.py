@@ -1,7 +1,27 @@
-from PIL import Image
-import numpy as np
-import copy
-import pandas as pd
+# PIL和numpy在识别价格图片时才导入, 只抓取链家时不需要加载
+# 数字图像查找表命中时不需要模型推理, 也不需要加载sklearn
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+import time
+from contextlib import contextmanager
+from io import BytesIO
+from typing import List, Optional
+
+from utils.html_service import get_one_page_content, get_many_page_content
+from utils.metrics_service import get_metrics
+from utils.profile_service import profile_stage
+
+
+# 价格图片中数字的px位置转换为顺序位置 人工学习结果
+PX2POS = {'-0px': 0, '-21.4px': 1, '-42.8px': 2, '-64.2px': 3, '-85.6px': 4, '-107px': 5,
+          '-128.4px': 6, '-149.8px': 7, '-171.2px': 8, '-192.6px': 9}
+
+_models = dict()
+_models_lock = threading.Lock()
 
 
 class PricePredict:
@@ -23,10 +43,15 @@ class PricePredict:
         image = self.get_img_idx(n)
         image = image.getchannel(3)
         image = my_threshold(image)
+        import numpy as np
         v_image = np.array(image).reshape((1, -1))
         res = self.model.predict(v_image)[0]
         return res
 
+    def predict_all(self) -> str:
+        """ 一次识别图片中全部10个数字 """
+        return predict_sprites([self.image], self.model)[0]
+
     def get_img_idx(self, n):
         """ 获取类图片的第n个数字，从0开始 """
         image_width = int(self.image.size[0] / 10)
@@ -34,6 +59,39 @@ class PricePredict:
         return im
 
 
+def sprite_to_glyphs(image, n=10, threshold=130) -> 'np.ndarray':
+    """
+    将价格图片一次性二值化并切分为n个数字, 与逐个crop + my_threshold的结果一致
+
+    :param image: PIL Image对象, RGBA
+    :param n: 图片中数字的个数
+    :param threshold: 二值化阈值
+    :return: shape为(n, 高*单个数字宽)的uint8矩阵, 每行为一个数字
+    """
+    import numpy as np
+    alpha = np.asarray(image.getchannel(3))
+    height, width = alpha.shape
+    glyph_width = int(width / n)
+    glyphs = alpha[:, :glyph_width * n].reshape(height, n, glyph_width).transpose(1, 0, 2).reshape(n, -1)
+    return np.where(glyphs > threshold, 255, 0).astype(np.uint8)
+
+
+def predict_sprites(images, model) -> List[str]:
+    """
+    批量识别多张价格图片, 全部数字只调用一次model.predict
+
+    :param images: PIL Image对象的list
+    :param model: 训练好的预测模型类
+    :return: 每张图片从左到右的10个数字组成的str
+    """
+    if not images:
+        return list()
+    import numpy as np
+    glyphs = np.concatenate([sprite_to_glyphs(i) for i in images])
+    pred = np.asarray(model.predict(glyphs)).reshape(len(images), -1)
+    return [''.join(str(j) for j in row) for row in pred]
+
+
 def my_threshold(image):
     """
     将灰度图像转换为二元图像，即1-0
@@ -41,14 +99,400 @@ def my_threshold(image):
     :param image: PIL Image对象
     :return: PIL Image对象
     """
-    im0 = copy.deepcopy(image)
-    im0_num = pd.DataFrame(np.array(im0))
-    im0_num[im0_num > 130] = 255
-    im0_num[im0_num <= 130] = 0
-    res = Image.fromarray(np.array(im0_num))
+    import numpy as np
+    from PIL import Image
+    res = Image.fromarray(np.where(np.asarray(image) > 130, 255, 0).astype(np.uint8))
     return res
 
 
+class LinearGlyphModel:
+    """
+    只依赖numpy的线性分类模型, 按 argmax(x @ coef.T + intercept) 分类, 保存为.npz
+    由sklearn的LogisticRegression、LinearSVC、NearestCentroid(欧氏距离)导出, 预测结果与原模型一致
+    文件小、加载时不需要导入sklearn, 也不受sklearn版本变化影响
+    """
+    def __init__(self, coef, intercept, classes, probability=False):
+        """
+        :param coef: 系数, shape为(类别数, 像素数)
+        :param intercept: 截距, shape为(类别数,)
+        :param classes: 类别
+        :param probability: 分数的softmax是否为概率, 只有多分类的LogisticRegression为True
+        """
+        import numpy as np
+        self.coef_ = np.asarray(coef, dtype=np.float32)
+        self.intercept_ = np.asarray(intercept, dtype=np.float32)
+        self.classes_ = np.asarray(classes)
+        self.probability = bool(probability)
+
+    @classmethod
+    def from_sklearn(cls, model):
+        """ 由sklearn的多分类线性模型导出, 不需要导入sklearn, 不支持的模型报错 """
+        import numpy as np
+        name = type(model).__name__
+        if len(getattr(model, 'classes_', ())) < 3:
+            raise Exception('只支持多分类模型, {} 的类别数为 {}'.format(name, len(getattr(model, 'classes_', ()))))
+        if name == 'NearestCentroid':
+            if getattr(model, 'metric', 'euclidean') != 'euclidean':
+                raise Exception('NearestCentroid只支持欧氏距离, 当前为 {}'.format(model.metric))
+            # argmin |x - c|^2 = argmax 2 c·x - |c|^2
+            centroids = np.asarray(model.centroids_, dtype=np.float64)
+            return cls(2 * centroids, -(centroids ** 2).sum(axis=1), model.classes_)
+        if name not in ('LogisticRegression', 'LinearSVC'):
+            raise Exception('{} 不是线性模型, 不能导出为LinearGlyphModel'.format(name))
+        # LogisticRegression多分类默认为multinomial, 概率为分数的softmax; ovr时各类概率单独计算, 不导出概率
+        probability = name == 'LogisticRegression' and getattr(model, 'multi_class', 'auto') != 'ovr'
+        return cls(model.coef_, model.intercept_, model.classes_, probability)
+
+    def decision_function(self, x):
+        import numpy as np
+        return np.asarray(x, dtype=np.float32) @ self.coef_.T + self.intercept_
+
+    @property
+    def predict_proba(self):
+        """ 只有由LogisticRegression导出时有概率, 其他模型hasattr(model, 'predict_proba')为False """
+        if not self.probability:
+            raise AttributeError('由线性分数导出的模型没有predict_proba')
+        return self._predict_proba
+
+    def _predict_proba(self, x):
+        import numpy as np
+        scores = self.decision_function(x)
+        scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return scores / scores.sum(axis=1, keepdims=True)
+
+    def predict(self, x):
+        return self.classes_[self.decision_function(x).argmax(axis=1)]
+
+    def save(self, path):
+        import numpy as np
+        with open(path, 'wb') as f:  # np.savez会给不以.npz结尾的路径加上后缀
+            np.savez_compressed(f, coef=self.coef_, intercept=self.intercept_, classes=self.classes_,
+                                probability=np.array(self.probability))
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+        with np.load(path, allow_pickle=False) as data:
+            probability = bool(data['probability']) if 'probability' in data else True  # 早期只导出LogisticRegression
+            return cls(data['coef'], data['intercept'], data['classes'], probability)
+
+
+def read_model(model_path):
+    """ 读取模型文件, .npz为LinearGlyphModel, 其他为pickle """
+    if model_path.endswith('.npz'):
+        return LinearGlyphModel.load(model_path)
+    with open(model_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_model(model_path):
+    """ 加载模型, 同一进程内每个路径只加载一次 """
+    with _models_lock:
+        model = _models.get(model_path)
+        if model is None:
+            model = read_model(model_path)
+            _models[model_path] = model
+    return model
+
+
+@contextmanager
+def _file_lock(path, timeout=60, poll=0.05):
+    """ 用独占创建的锁文件实现的跨进程锁, 超过timeout仍未释放的锁视为进程异常退出后的残留 """
+    lock_path = path + '.lock'
+    time0 = time.time()
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > timeout:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            if time.time() - time0 > timeout:
+                raise Exception('等待文件锁超时 {}'.format(lock_path))
+            time.sleep(poll)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
+class GlyphTable:
+    """
+    数字图像查找表 {二值化后单个数字图像的哈希: {'digit': 数字, 'confidence': 模型置信度}}
+    价格图片反复使用同一套数字渲染, 查表命中时不需要模型推理。未见过的数字图像由模型识别后加入
+    置信度低于min_confidence的识别结果会标记为low_confidence, 可在表文件中人工确认或修改digit
+    新识别的结果只标记未保存, 在运行或worker结束时调用save一次写入, 写入时与文件中其他进程的结果合并
+    """
+    def __init__(self, path: str=None, min_confidence=0.9):
+        """
+        :param path: 表文件路径(json), 为空时只在内存中使用, 已存在时加载
+        :param min_confidence: 模型置信度低于该值时标记为低置信度
+        """
+        self.path = path
+        self.min_confidence = min_confidence
+        self.glyphs = dict()
+        self.dirty = False  # 有未写入文件的识别结果
+        self._lock = threading.Lock()
+        if path and os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.glyphs = json.load(f)
+
+    @staticmethod
+    def glyph_key(glyph) -> str:
+        """ 二值化后的数字图像(展平的uint8数组)的哈希, 带上长度避免不同尺寸的图像冲突 """
+        return '{}:{}'.format(glyph.size, hashlib.blake2b(glyph.tobytes(), digest_size=8).hexdigest())
+
+    def lookup(self, keys: List[str]) -> list:
+        """ 查表, 未见过的为None """
+        glyphs = self.glyphs
+        return [glyphs[k]['digit'] if k in glyphs else None for k in keys]
+
+    def learn(self, key: str, digit: str, confidence=None) -> bool:
+        """ 加入模型识别的结果, 返回是否为低置信度 """
+        low = confidence is not None and confidence < self.min_confidence
+        entry = {'digit': digit, 'confidence': None if confidence is None else round(float(confidence), 4)}
+        if low:
+            entry['low_confidence'] = True
+        with self._lock:
+            self.glyphs[key] = entry
+            self.dirty = True
+        return low
+
+    def low_confidence(self) -> dict:
+        """ 低置信度的数字图像 {哈希: 记录} """
+        return {k: v for k, v in self.glyphs.items() if v.get('low_confidence')}
+
+    def save(self) -> bool:
+        """
+        写入表文件, 返回是否写入。path为空或没有新的识别结果时不写入
+        在文件锁内先读取文件中的表, 合并其他进程写入的结果(文件中的记录优先, 保留人工修改)后原子替换
+        """
+        if not self.path or not self.dirty:
+            return False
+        dir_path = os.path.dirname(self.path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+        with _file_lock(self.path):
+            saved = dict()
+            if os.path.isfile(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+            with self._lock:
+                self.glyphs.update(saved)
+                self.dirty = False
+                text = json.dumps(self.glyphs, ensure_ascii=False, indent=1, sort_keys=True)
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, self.path)
+        return True
+
+    def __len__(self):
+        return len(self.glyphs)
+
+
+class PriceDecoder:
+    """ 自如价格解码。每张价格图片(按url)只识别一次, 数字先查表, 未见过的数字图像才加载模型识别 """
+    def __init__(self, model_path, table: GlyphTable=None):
+        """
+        :param model_path: 模型文件路径
+        :param table: 数字图像查找表, 默认为只在内存中的空表
+        """
+        self.model_path = model_path
+        self.table = table if table is not None else GlyphTable()
+        self.sprite_digits = dict()  # 图片url: 图片中从左到右的10个数字
+        self.failed_sprites = set()  # 下载失败的图片url, 不再重复下载
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        return load_model(self.model_path)
+
+    def _predict(self, images) -> List[str]:
+        """ 识别多张价格图片, 数字先查表, 表中没有的数字图像去重后一次调用模型, 结果加入表, 由save_price_decoders写入 """
+        import numpy as np
+        glyphs = np.concatenate([sprite_to_glyphs(i) for i in images])
+        keys = [GlyphTable.glyph_key(i) for i in glyphs]
+        digits = self.table.lookup(keys)
+        missed = dict()  # 哈希: 第一次出现的位置
+        for n, (key, digit) in enumerate(zip(keys, digits)):
+            if digit is None and key not in missed:
+                missed[key] = n
+        metrics = get_metrics()
+        metrics.inc('ocr_glyph_lookups_total', len(keys))
+        if missed:
+            metrics.inc('ocr_glyph_model_total', len(missed))
+            model = self.model
+            rows = glyphs[list(missed.values())]
+            if hasattr(model, 'predict_proba') and hasattr(model, 'classes_'):  # 分类结果即概率最大的类别
+                proba = model.predict_proba(rows)
+                pred = np.asarray(model.classes_)[proba.argmax(axis=1)]
+                confidence = proba.max(axis=1)
+            else:  # 自定义模型可以只有predict方法
+                pred = np.asarray(model.predict(rows)).reshape(-1)
+                confidence = [None] * len(rows)
+            learned = dict()
+            for key, digit, c in zip(missed, pred, confidence):
+                learned[key] = str(digit)
+                if self.table.learn(key, str(digit), c):
+                    metrics.inc('ocr_glyph_low_confidence_total')
+                    print('==== 价格数字 {} 识别置信度较低 {:.3f}, 见数字图像查找表 {} {} ===='.format(
+                        digit, c, self.table.path, key))
+            digits = [learned[k] if d is None else d for k, d in zip(keys, digits)]
+        return [''.join(digits[n * 10: (n + 1) * 10]) for n in range(len(images))]
+
+    def decode_sprite(self, image) -> str:
+        """ 识别价格图片中的10个数字 """
+        with profile_stage('ocr'):
+            with get_metrics().timer('ocr_seconds'):
+                res = self._predict([image])[0]
+        get_metrics().inc('ocr_sprites_total')
+        return res
+
+    def decode_sprites(self, url_images: dict) -> dict:
+        """
+        批量识别多张价格图片并写入缓存
+
+        :param url_images: {图片url: PIL Image对象}
+        :return: {图片url: 10个数字}
+        """
+        urls = list(url_images)
+        if not urls:
+            return dict()
+        with profile_stage('ocr'):
+            time0 = time.perf_counter()
+            res = dict(zip(urls, self._predict([url_images[i] for i in urls])))
+        metrics = get_metrics()
+        cost = (time.perf_counter() - time0) / len(urls)
+        for _ in urls:
+            metrics.observe('ocr_seconds', cost)
+        metrics.inc('ocr_sprites_total', len(urls))
+        with self._lock:
+            self.sprite_digits.update(res)
+        return res
+
+    @staticmethod
+    def sprite_urls(s) -> List[str]:
+        """ 解析price_info中各位数字所用的图片url """
+        return ['https:' + re.findall(r'url\((.*)\)', i)[0] for i in s.split('||')]
+
+    def prefetch(self, price_infos) -> int:
+        """
+        并发下载全部未识别过的价格图片并批量识别, 之后decode_price只需查缓存
+
+        :param price_infos: price_info字段的list
+        :return: 本次识别的图片数量
+        """
+        urls = set()
+        for s in price_infos:
+            urls.update(self.sprite_urls(s))
+        urls = [i for i in urls if i not in self.sprite_digits and i not in self.failed_sprites]
+        from PIL import Image
+        url_images = dict()
+        for url, content in get_many_page_content(urls):
+            if content is None:
+                self._sprite_failed(url)
+                continue
+            url_images[url] = Image.open(BytesIO(content))
+        self.decode_sprites(url_images)
+        return len(url_images)
+
+    def _sprite_failed(self, url):
+        print('==== 价格图片 {} 获取失败, 使用该图片的房源价格为空 ===='.format(url))
+        get_metrics().inc('ocr_sprite_failures_total')
+        with self._lock:
+            self.failed_sprites.add(url)
+
+    def get_sprite_digits(self, url) -> Optional[str]:
+        """ 获取某张价格图片的识别结果, 未识别过则下载并识别, 下载失败时为None """
+        p_str = self.sprite_digits.get(url)
+        if p_str is None:
+            if url in self.failed_sprites:
+                return None
+            content = get_one_page_content(url)
+            if content is None:
+                self._sprite_failed(url)
+                return None
+            from PIL import Image
+            img = Image.open(BytesIO(content))
+            p_str = self.decode_sprite(img)
+            with self._lock:
+                self.sprite_digits[url] = p_str
+        return p_str
+
+    def decode_price(self, s):
+        """
+        根据图片的字符信息（price_info 字段）生成数值型价格
+
+        :param s: price_info 内容, 各位数字的style以||分割
+        :return: 价格int, 价格图片获取失败时为'', 与其他缺失的字段一致
+        """
+        num_str = str()
+        for i, i_url in zip(s.split('||'), self.sprite_urls(s)):
+            ## 识别该位数字图片的url
+            p_str = self.get_sprite_digits(i_url)
+            if p_str is None:
+                return ''
+            ## 识别该位数字在图片中px位置，并转换为顺序位置
+            px = re.findall('background-position: (.*)', i)[0]
+            num_str += p_str[PX2POS.get(px)]
+        # 拼接各位数字生成最终价格
+        return int(num_str)
+
+
+_decoders = dict()
+_decoder_configs = dict()  # 模型路径: configure_price_decoder的参数, 用于在子进程中重建
+
+
+def configure_price_decoder(model_path, table_path=None, min_confidence=0.9) -> PriceDecoder:
+    """
+    设置进程内共享的价格解码器, 之后get_price_decoder(model_path)返回该解码器
+
+    :param model_path: 模型文件路径
+    :param table_path: 数字图像查找表的路径, 已有的表直接使用, 新识别的数字图像会写入
+    :param min_confidence: 模型置信度低于该值时标记为低置信度
+    """
+    decoder = PriceDecoder(model_path, GlyphTable(table_path, min_confidence))
+    with _models_lock:
+        _decoders[model_path] = decoder
+        _decoder_configs[model_path] = {'table_path': table_path, 'min_confidence': min_confidence}
+    return decoder
+
+
+def decoder_config() -> dict:
+    """ 已设置的价格解码器的配置 {模型路径: 参数}, 传给子进程的configure_price_decoders """
+    with _models_lock:
+        return {k: dict(v) for k, v in _decoder_configs.items()}
+
+
+def configure_price_decoders(configs: dict):
+    """ 按decoder_config的结果设置价格解码器 """
+    for model_path, kwargs in configs.items():
+        configure_price_decoder(model_path, **kwargs)
+
+
+def save_price_decoders() -> int:
+    """ 写入各价格解码器新识别的数字图像, 在运行或worker进程结束时调用, 返回写入的表个数 """
+    with _models_lock:
+        decoders = list(_decoders.values())
+    return sum(decoder.table.save() for decoder in decoders)
+
+
+def get_price_decoder(model_path) -> PriceDecoder:
+    """ 获取进程内共享的价格解码器, 每个模型路径一个 """
+    with _models_lock:
+        decoder = _decoders.get(model_path)
+        if decoder is None:
+            decoder = PriceDecoder(model_path)
+            _decoders[model_path] = decoder
+    return decoder
+
+
 #%%
 if __name__ == '__main__':
     # model_path = r'D:\Learn\学习入口\大项目\爬他妈的\住房问题\自如\data\LR_0817.pickle'
@@ -0,0 +1,245 @@
+# 本方法为性能分析模式: 按环节(fetch/parse/ocr/merge/sink)分别用cProfile记录, 并用tracemalloc记录各环节的内存峰值
+# 结果为每个环节一个.prof文件(可用snakeviz、flameprof等生成火焰图)和热点函数报告
+#   flameprof result/profile/20221201/parse.prof > parse.svg
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+STAGES = ('fetch', 'parse', 'ocr', 'merge', 'sink', 'other')  # other为不属于任何环节的部分
+
+
+class _StatsHolder:
+    """ pstats.Stats可以直接读取有create_stats方法和stats属性的对象, 用于合并子进程的结果 """
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    """
+    按环节的性能分析
+
+    - 每个线程每个环节一个cProfile.Profile, 嵌套的环节会暂停外层环节, 时间只计入最内层
+    - 内存峰值为环节内tracemalloc峰值与进入时内存之差, 多线程同时运行时为近似值
+    - Python 3.12起同一时间只能有一个cProfile在运行, 无法启用时该次只记录耗时和内存
+    """
+    def __init__(self, output_path: str, top_n=30, memory=True):
+        """
+        :param output_path: 输出目录
+        :param top_n: 报告中每个环节列出的函数数量
+        :param memory: 是否使用tracemalloc记录内存峰值, 会明显降低运行速度
+        """
+        self.output_path = output_path
+        self.top_n = top_n
+        self.memory = memory
+        self.calls = dict()  # 环节: 次数
+        self.seconds = dict()  # 环节: 总耗时
+        self.peak = dict()  # 环节: 内存峰值(字节)
+        self._profiles = dict()  # 环节: [各线程的Profile]
+        self._child_stats = dict()  # 环节: [子进程的stats]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._base = None
+
+    def _get_profile(self, name) -> cProfile.Profile:
+        profiles = getattr(self._local, 'profiles', None)
+        if profiles is None:
+            profiles = self._local.profiles = dict()
+        profile = profiles.get(name)
+        if profile is None:
+            profile = profiles[name] = cProfile.Profile()
+            with self._lock:
+                self._profiles.setdefault(name, list()).append(profile)
+        return profile
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = list()
+        return stack
+
+    @staticmethod
+    def _enable(profile) -> bool:
+        try:
+            profile.enable()
+            return True
+        except ValueError:  # 已有其他profiler在运行
+            return False
+
+    @contextmanager
+    def stage(self, name):
+        """ 环节的上下文管理器 """
+        stack = self._stack()
+        if stack and stack[-1][1]:
+            stack[-1][0].disable()
+        profile = self._get_profile(name)
+        mem0 = 0
+        if self.memory and tracemalloc.is_tracing():
+            mem0 = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        time0 = time.perf_counter()
+        enabled = self._enable(profile)
+        stack.append((profile, enabled))
+        try:
+            yield
+        finally:
+            if enabled:
+                profile.disable()
+            stack.pop()
+            cost = time.perf_counter() - time0
+            peak = tracemalloc.get_traced_memory()[1] - mem0 if self.memory and tracemalloc.is_tracing() else 0
+            with self._lock:
+                self.calls[name] = self.calls.get(name, 0) + 1
+                self.seconds[name] = self.seconds.get(name, 0) + cost
+                self.peak[name] = max(self.peak.get(name, 0), peak)
+            if stack and stack[-1][1]:
+                stack[-1] = (stack[-1][0], self._enable(stack[-1][0]))
+
+    def start(self):
+        """ 开始分析, 当前线程中不属于任何环节的部分计入other """
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._base = self.stage('other')
+        self._base.__enter__()
+
+    def stop(self):
+        if self._base is not None:
+            self._base.__exit__(None, None, None)
+            self._base = None
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _stage_stats(self, name) -> pstats.Stats:
+        with self._lock:
+            sources = list(self._profiles.get(name, list()))
+            sources += [_StatsHolder(i) for i in self._child_stats.get(name, list())]
+        stats = None
+        for source in sources:
+            if isinstance(source, cProfile.Profile):
+                source.create_stats()
+                if not source.stats:
+                    continue
+            if stats is None:
+                stats = pstats.Stats(source)
+            else:
+                stats.add(source)
+        return stats
+
+    def snapshot(self, reset=False) -> dict:
+        """ 可pickle的分析结果, 用于子进程汇总到主进程 """
+        res = {'stats': dict(), 'calls': dict(self.calls), 'seconds': dict(self.seconds), 'peak': dict(self.peak)}
+        for name in list(self._profiles) + list(self._child_stats):
+            stats = self._stage_stats(name)
+            if stats is not None:
+                res['stats'][name] = stats.stats
+        if reset:
+            with self._lock:
+                self.calls, self.seconds, self.peak = dict(), dict(), dict()
+                self._profiles, self._child_stats = dict(), dict()
+            self._local = threading.local()
+        return res
+
+    def merge(self, snapshot: dict):
+        """ 合并子进程的分析结果 """
+        with self._lock:
+            for name, stats in snapshot['stats'].items():
+                self._child_stats.setdefault(name, list()).append(stats)
+            for name, n in snapshot['calls'].items():
+                self.calls[name] = self.calls.get(name, 0) + n
+            for name, cost in snapshot['seconds'].items():
+                self.seconds[name] = self.seconds.get(name, 0) + cost
+            for name, peak in snapshot['peak'].items():
+                self.peak[name] = max(self.peak.get(name, 0), peak)
+
+    def report(self) -> dict:
+        """
+        写入各环节的.prof文件、热点函数报告profile_report.txt和汇总profile_summary.json
+
+        :return: 汇总 {环节: {'calls': 次数, 'seconds': 耗时, 'peak_mb': 内存峰值}}
+        """
+        if not os.path.isdir(self.output_path):
+            os.makedirs(self.output_path)
+        summary = dict()
+        text = io.StringIO()
+        names = [i for i in STAGES if i in self.calls] + sorted(i for i in self.calls if i not in STAGES)
+        for name in names:
+            summary[name] = {'calls': self.calls[name], 'seconds': round(self.seconds[name], 3),
+                             'peak_mb': round(self.peak.get(name, 0) / 1024 / 1024, 2)}
+            text.write('=' * 30 + ' {} {} '.format(name, summary[name]) + '=' * 30 + '\n')
+            stats = self._stage_stats(name)
+            if stats is None:
+                text.write('(无cProfile记录)\n\n')
+                continue
+            stats.dump_stats(os.path.join(self.output_path, '{}.prof'.format(name)))
+            stats.stream = text
+            for sort_key in ('tottime', 'cumulative'):
+                text.write('-- 按{}排序 前{}个函数 --\n'.format(sort_key, self.top_n))
+                stats.sort_stats(sort_key).print_stats(self.top_n)
+        with open(os.path.join(self.output_path, 'profile_report.txt'), 'w', encoding='utf-8') as f:
+            f.write(text.getvalue())
+        with open(os.path.join(self.output_path, 'profile_summary.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        return summary
+
+
+_profiler = None
+
+
+def start_profiler(output_path, top_n=30, memory=True) -> Profiler:
+    """ 开启进程内的性能分析, 之后profile_stage开始记录 """
+    global _profiler
+    _profiler = Profiler(output_path, top_n, memory)
+    _profiler.start()
+    return _profiler
+
+
+def stop_profiler():
+    """ 结束性能分析并写入报告, 未开启时返回None """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return None
+    profiler.stop()
+    return profiler.report()
+
+
+def get_profiler():
+    return _profiler
+
+
+def profile_stage(name):
+    """ 环节的上下文管理器, 未开启性能分析时不做任何事 """
+    if _profiler is None:
+        return nullcontext()
+    return _profiler.stage(name)
+
+
+def profile_snapshot():
+    """ 子进程的分析结果, 未开启时为None """
+    return _profiler.snapshot(reset=True) if _profiler is not None else None
+
+
+def merge_profile_snapshot(snapshot):
+    if _profiler is not None and snapshot is not None:
+        _profiler.merge(snapshot)
+
+
+def _reset_profiler_after_fork():
+    """ 子进程不继承主进程other环节的状态, 重新开始记录 """
+    global _profiler
+    if _profiler is not None:
+        _profiler = Profiler(_profiler.output_path, _profiler.top_n, _profiler.memory)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_profiler_after_fork)
@@ -0,0 +1,218 @@
+# 本方法为分布式抓取的任务队列, 以sqlite文件作为broker, 同一台机器上的多个worker进程共同消费
+# sqlite的WAL模式依赖同一主机的共享内存, 网络文件系统(NFS、SMB等)上的锁也不可靠, 队列文件不能放在共享目录中供多台机器使用
+# 任务以租约的方式领取, worker定期心跳续约, 租约过期的任务会被其他worker重新领取
+# 区域任务的结果与完成状态在同一事务中写入results表, 合并时不依赖worker的本地目录
+# 领取和续约使用UPDATE ... RETURNING, 需要sqlite 3.35以上
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Optional
+
+
+class TaskQueue:
+    """
+    区域级任务队列
+
+    - tasks: run_tag + city + source + area 唯一, status为 pending/leased/done/failed
+    - workers: 各worker的最近心跳和当前任务
+    - results: 完成任务的结果(json)
+    """
+    PENDING = 'pending'
+    LEASED = 'leased'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path: str, lease_seconds=300, max_attempts=3):
+        """
+        :param path: sqlite文件路径
+        :param lease_seconds: 租约时长(秒), 超过该时间没有心跳的任务会被重新领取
+        :param max_attempts: 单个任务最多领取次数, 超过后标记为failed
+        """
+        if sqlite3.sqlite_version_info < (3, 35, 0):
+            raise Exception('任务队列需要sqlite 3.35以上(支持UPDATE ... RETURNING), 当前为 {}, 请升级python或sqlite'.format(
+                sqlite3.sqlite_version))
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        dir_path = os.path.dirname(path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')  # 只支持单机, 见文件开头
+            conn.execute('CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY AUTOINCREMENT, run_tag TEXT, '
+                         'city TEXT, source TEXT, area TEXT, status TEXT, attempts INTEGER DEFAULT 0, worker TEXT, '
+                         'lease_until REAL, error TEXT, updated_at REAL, UNIQUE (run_tag, city, source, area))')
+            conn.execute('CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, host TEXT, pid INTEGER, '
+                         'task_id INTEGER, heartbeat REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS results (task_id INTEGER PRIMARY KEY, data TEXT)')
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _execute(self, sql, params=(), write=False) -> List[tuple]:
+        """ 写操作使用BEGIN IMMEDIATE, 保证多个worker同时领取时不会领到同一个任务 """
+        with self._lock:
+            conn = self._connect()
+            if not write:
+                return conn.execute(sql, params).fetchall()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute(sql, params).fetchall()
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            return rows
+
+    def put(self, run_tag: str, tasks: Iterable[dict]) -> int:
+        """
+        加入任务, 已存在的任务保持原状态, 重复执行协调器不会重复抓取
+
+        :param tasks: [{'city': 城市代码, 'source': 'LJ'/'ZR'/'HD', 'area': 区域名}]
+        :return: 新加入的任务数
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            n0 = conn.total_changes
+            conn.executemany('INSERT OR IGNORE INTO tasks (run_tag, city, source, area, status, updated_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             [(run_tag, i['city'], i['source'], i['area'], self.PENDING, time.time()) for i in tasks])
+            n = conn.total_changes - n0
+            conn.execute('COMMIT')
+        return n
+
+    def lease(self, worker: str, run_tag: str=None) -> Optional[dict]:
+        """
+        领取一个任务: 待执行的任务, 或租约已过期的任务
+
+        :param worker: worker id
+        :param run_tag: 只领取该批次的任务, 为空时不限
+        :return: 任务dict, 没有可领取的任务时返回None
+        """
+        self.expire()
+        now = time.time()
+        rows = self._execute(
+            'UPDATE tasks SET status = ?, worker = ?, attempts = attempts + 1, lease_until = ?, updated_at = ? '
+            'WHERE id = (SELECT id FROM tasks WHERE (status = ? OR (status = ? AND lease_until < ?)) '
+            'AND attempts < ? AND (? IS NULL OR run_tag = ?) ORDER BY id LIMIT 1) '
+            'RETURNING id, run_tag, city, source, area, attempts',
+            (self.LEASED, worker, now + self.lease_seconds, now, self.PENDING, self.LEASED, now,
+             self.max_attempts, run_tag, run_tag), write=True)
+        if not rows:
+            return None
+        keys = ('id', 'run_tag', 'city', 'source', 'area', 'attempts')
+        return dict(zip(keys, rows[0]))
+
+    def expire(self):
+        """ 租约过期且已达到最多次数的任务标记为failed, 不再等待 """
+        self._execute('UPDATE tasks SET status = ?, error = ?, updated_at = ? '
+                      'WHERE status = ? AND lease_until < ? AND attempts >= ?',
+                      (self.FAILED, '租约过期', time.time(), self.LEASED, time.time(), self.max_attempts), write=True)
+
+    def heartbeat(self, worker: str, task_id: int=None) -> bool:
+        """
+        worker心跳, 同时为当前任务续约
+
+        :return: 当前任务是否仍由该worker持有, 租约被其他worker接管时为False
+        """
+        now = time.time()
+        self._execute('INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?, ?)',
+                      (worker, socket.gethostname(), os.getpid(), task_id, now), write=True)
+        if task_id is None:
+            return True
+        rows = self._execute('UPDATE tasks SET lease_until = ? WHERE id = ? AND worker = ? AND status = ? '
+                             'RETURNING id', (now + self.lease_seconds, task_id, worker, self.LEASED), write=True)
+        return bool(rows)
+
+    def complete(self, task_id: int, worker: str, result=None) -> bool:
+        """
+        任务完成, 返回是否由该worker完成(租约过期被接管后, 以后完成的为准)
+
+        :param result: 任务结果, 可json序列化, 只有仍持有租约时才写入
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute('UPDATE tasks SET status = ?, error = NULL, updated_at = ? '
+                                    'WHERE id = ? AND worker = ? AND status = ? RETURNING id',
+                                    (self.DONE, time.time(), task_id, worker, self.LEASED)).fetchall()
+                if rows and result is not None:
+                    conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?)',
+                                 (task_id, json.dumps(result, ensure_ascii=False)))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return bool(rows)
+
+    def result(self, task_id: int):
+        """ 完成任务的结果, 没有时返回None """
+        rows = self._execute('SELECT data FROM results WHERE task_id = ?', (task_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def fail(self, task_id: int, worker: str, error: str):
+        """ 任务失败, 未达到最多次数时重新放回队列 """
+        self._execute('UPDATE tasks SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, error = ?, '
+                      'updated_at = ? WHERE id = ? AND worker = ? AND status = ?',
+                      (self.max_attempts, self.PENDING, self.FAILED, error, time.time(), task_id, worker,
+                       self.LEASED), write=True)
+
+    def tasks(self, run_tag: str, city: str=None, status: str=None) -> List[dict]:
+        """ 按加入顺序列出任务 """
+        rows = self._execute('SELECT id, city, source, area, status, attempts, worker, error FROM tasks '
+                             'WHERE run_tag = ? AND (? IS NULL OR city = ?) AND (? IS NULL OR status = ?) '
+                             'ORDER BY id', (run_tag, city, city, status, status))
+        keys = ('id', 'city', 'source', 'area', 'status', 'attempts', 'worker', 'error')
+        return [dict(zip(keys, i)) for i in rows]
+
+    def stats(self, run_tag: str) -> dict:
+        """ 各状态的任务数 """
+        self.expire()
+        rows = self._execute('SELECT status, COUNT(*) FROM tasks WHERE run_tag = ? GROUP BY status', (run_tag,))
+        return dict(rows)
+
+    def unfinished(self, run_tag: str) -> int:
+        """ 还未结束(待执行或执行中)的任务数 """
+        stats = self.stats(run_tag)
+        return stats.get(self.PENDING, 0) + stats.get(self.LEASED, 0)
+
+    def workers(self, alive_seconds=None) -> List[dict]:
+        """ worker列表, alive_seconds输入后只返回该时间内有心跳的worker """
+        since = time.time() - alive_seconds if alive_seconds else 0
+        rows = self._execute('SELECT worker, host, pid, task_id, heartbeat FROM workers WHERE heartbeat >= ? '
+                             'ORDER BY worker', (since,))
+        keys = ('worker', 'host', 'pid', 'task_id', 'heartbeat')
+        return [dict(zip(keys, i)) for i in rows]
+
+    def other_hosts(self) -> List[str]:
+        """ 租约时长内有心跳的其他主机上的worker所在主机, 用于拒绝多台机器共享队列文件 """
+        host = socket.gethostname()
+        return sorted({i['host'] for i in self.workers(alive_seconds=self.lease_seconds) if i['host'] != host})
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
@@ -0,0 +1,96 @@
+# 本方法为抓取结果的本地持久化存储, 用于离线回放
+
+import datetime
+import hashlib
+import os
+import tempfile
+import time
+import zlib
+
+
+class ResponseStore:
+    """
+    压缩的本地响应存储。按 日期+url 做内容寻址, 超过ttl的条目视为过期
+    目录结构: path/日期/哈希前两位/哈希.z
+    """
+    def __init__(self, path: str, ttl=7 * 24 * 3600, date_tag=None, replay=False, level=6):
+        """
+        :param path: 存储根目录
+        :param ttl: 过期时间(秒), None为不过期
+        :param date_tag: 日期标签 如20221201, 默认今天。回放时指定要回放的日期
+        :param replay: 是否为回放模式, 回放模式只读存储, 不访问网络
+        :param level: zlib压缩等级
+        """
+        self.path = path
+        self.ttl = ttl
+        self.date_tag = date_tag if date_tag else datetime.datetime.today().strftime('%Y%m%d')
+        self.replay = replay
+        self.level = level
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file_path(self, url, kind):
+        key = hashlib.sha1('{}|{}|{}'.format(self.date_tag, kind, url).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, self.date_tag, key[:2], key + '.z')
+
+    def _expired(self, file_path):
+        if self.ttl is None or self.replay:  # 回放时不考虑过期
+            return False
+        return time.time() - os.path.getmtime(file_path) > self.ttl
+
+    def get(self, url, kind='text'):
+        """
+        读取存储的内容
+
+        :param url: 请求的url
+        :param kind: 'text' 或 'content'
+        :return: bytes, 不存在或已过期返回None
+        """
+        file_path = self._file_path(url, kind)
+        try:
+            if self._expired(file_path):
+                return None
+            with open(file_path, 'rb') as f:
+                return zlib.decompress(f.read())
+        except (OSError, zlib.error):
+            return None
+
+    def put(self, url, data: bytes, kind='text'):
+        """ 压缩写入, 先写唯一的临时文件再替换, 多进程、多线程同时写入同一url也不会写坏 """
+        if self.replay:
+            return
+        file_path = self._file_path(url, kind)
+        dir_path = os.path.dirname(file_path)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(file_path) + '.', dir=dir_path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(data, self.level))
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def purge(self):
+        """ 删除过期条目和清空后的目录, 返回删除数量。其他进程同时清理时忽略已被删除的文件 """
+        if self.ttl is None:
+            return 0
+        n = 0
+        now = time.time()
+        for root, _, files in os.walk(self.path, topdown=False):
+            for file_name in files:
+                file_path = os.path.join(root, file_name)
+                try:
+                    if now - os.path.getmtime(file_path) > self.ttl:
+                        os.remove(file_path)
+                        n += 1
+                except OSError:
+                    continue
+            if root != self.path:
+                try:
+                    os.rmdir(root)  # 只能删除空目录
+                except OSError:
+                    pass
+        return n
@@ -0,0 +1,108 @@
+# 本方法为按host的限速和重试调度
+
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+# 需要降速并重试的状态码, None代表网络异常
+RETRY_STATUS = {None, 429, 500, 502, 503, 504}
+
+
+def retry_delay(attempt, base=1.0, cap=30.0):
+    """ 带随机抖动的指数退避(full jitter), attempt从0开始 """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class HostThrottle:
+    """
+    单个host的自适应令牌桶
+
+    - 令牌按rate(次/秒)补充, 最多积攒burst个
+    - 同时在途请求数不超过limit
+    - 出现429/5xx/异常时rate和limit减半(cooldown秒内只减一次, 避免同一批在途请求连续减半),
+      正常且延迟低于latency_target时逐步回升
+    """
+    def __init__(self, rate=5.0, burst=5, max_concurrency=8, min_rate=0.5, max_rate=50.0, latency_target=3.0,
+                 cooldown=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self._last_decrease = 0.0
+        self.in_flight = 0
+        self.n_ok = 0
+        self.n_throttled = 0
+        self._next = time.monotonic()  # 下一个令牌可用的时间
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """ 等待并发名额和令牌 """
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+            now = time.monotonic()
+            interval = 1.0 / self.rate
+            start = max(self._next, now - (self.burst - 1) * interval)
+            self._next = start + interval
+        wait = start - now
+        if wait > 0:
+            time.sleep(wait)
+
+    def release(self, status, latency):
+        """
+        请求结束后归还名额, 并根据结果调整速度
+
+        :param status: http状态码, 网络异常为None
+        :param latency: 请求耗时(秒)
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if status in RETRY_STATUS:
+                self.n_throttled += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self._last_decrease = now
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    self.limit = max(1, self.limit // 2)
+            elif latency > self.latency_target:
+                self.rate = max(self.min_rate, self.rate * 0.9)
+            else:
+                self.n_ok += 1
+                self.rate = min(self.max_rate, self.rate + 0.1)
+                if self.n_ok % 10 == 0:
+                    self.limit = min(self.max_concurrency, self.limit + 1)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {'rate': round(self.rate, 2), 'limit': self.limit, 'ok': self.n_ok, 'throttled': self.n_throttled}
+
+
+class HostScheduler:
+    """ 按host分配HostThrottle """
+    def __init__(self, **throttle_kwargs):
+        """ :param throttle_kwargs: 传给HostThrottle的参数 """
+        self.throttle_kwargs = throttle_kwargs
+        self._throttles = dict()
+        self._lock = threading.Lock()
+
+    def get(self, url) -> HostThrottle:
+        host = urlsplit(url).netloc
+        with self._lock:
+            throttle = self._throttles.get(host)
+            if throttle is None:
+                throttle = HostThrottle(**self.throttle_kwargs)
+                self._throttles[host] = throttle
+        return throttle
+
+    def stats(self) -> dict:
+        with self._lock:
+            throttles = dict(self._throttles)
+        return {host: throttle.stats() for host, throttle in throttles.items()}